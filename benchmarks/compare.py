@@ -0,0 +1,54 @@
+import argparse
+import json
+import statistics
+import sys
+from typing import Dict, List, Tuple
+
+
+def _medians(report: dict) -> Dict[Tuple[str, str], float]:
+    runs: Dict[Tuple[str, str], List[float]] = {}
+    for result in report["results"]:
+        if result.get("succeeded"):
+            runs.setdefault((result["scenario"], result["size"]), []).append(result["wall_seconds"])
+    return {key: statistics.median(values) for key, values in runs.items()}
+
+
+def compare_reports(baseline: dict, current: dict, threshold: float = 0.1) -> List[dict]:
+    """
+    Compares the median wall time of every scenario and size that both reports contain.
+    :param baseline: Report of the earlier version.
+    :param current: Report of the new version.
+    :param threshold: Relative slowdown that counts as a regression, e.g. 0.1 for 10 %.
+    :return: One comparison per scenario and size.
+    """
+    before, after = _medians(baseline), _medians(current)
+    comparisons = []
+    for key in sorted(before.keys() & after.keys()):
+        change = (after[key] - before[key]) / before[key] if before[key] else 0.0
+        comparisons.append({"scenario": key[0], "size": key[1], "baseline_seconds": before[key],
+                            "current_seconds": after[key], "change": round(change, 3),
+                            "regression": change > threshold})
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares two benchmark reports and fails on regressions.")
+    parser.add_argument("baseline", help="JSON report of the earlier version.")
+    parser.add_argument("current", help="JSON report of the new version.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown that fails, default 0.1.")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    comparisons = compare_reports(baseline, current, args.threshold)
+    for comparison in comparisons:
+        marker = "REGRESSION" if comparison["regression"] else ""
+        print(f"{comparison['scenario']:<15} {comparison['size']:>6} {comparison['baseline_seconds']:>9.2f}s "
+              f"-> {comparison['current_seconds']:>9.2f}s {comparison['change']:+.1%} {marker}")
+    sys.exit(1 if any(comparison["regression"] for comparison in comparisons) else 0)
+
+
+if __name__ == "__main__":
+    main()
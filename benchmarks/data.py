@@ -0,0 +1,97 @@
+import os
+import random
+import sqlite3
+
+# Rows inserted per transaction while generating
+BATCH_ROWS = 5000
+WORDS = ("backup", "restore", "order", "invoice", "customer", "shipment", "payment", "refund", "account", "session",
+         "login", "logout", "update", "delete", "insert", "report", "export", "import", "warning", "error")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    created INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    id INTEGER PRIMARY KEY,
+    event_id INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_by_user ON events (user_id, created);
+"""
+
+
+def parse_size(size: str) -> int:
+    """
+    Parses a size like '64M', '1G' or '512K' into bytes.
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size: int) -> str:
+    for unit, factor in (("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return str(size)
+
+
+def generate_database(path: str, size: int, seed: int = 0, blob_ratio: float = 0.1) -> str:
+    """
+    Generates a synthetic SQLite database of about the given size. Text rows compress like typical application
+    data, random attachments don't compress at all. The same size and seed always give the same content.
+    :param path: Path of the database file.
+    :param size: Target size in bytes.
+    :param seed: Seed of the random content.
+    :param blob_ratio: Share of the size taken by incompressible attachments.
+    :return: Path of the database file.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("PRAGMA journal_mode=OFF")
+        connection.execute("PRAGMA synchronous=OFF")
+        connection.executescript(SCHEMA)
+        event_id = 0
+        blob_bytes = 0
+        while os.path.getsize(path) < size:
+            events = []
+            for _ in range(BATCH_ROWS):
+                event_id += 1
+                message = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 30)))
+                events.append((event_id, 1700000000 + event_id, rng.randint(1, 100000), rng.choice(WORDS), message))
+            connection.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?)", events)
+            attachments = []
+            while blob_bytes < os.path.getsize(path) * blob_ratio:
+                data = rng.randbytes(rng.randint(1024, 16384))
+                attachments.append((rng.randint(1, event_id), data))
+                blob_bytes += len(data)
+            connection.executemany("INSERT INTO attachments (event_id, data) VALUES (?, ?)", attachments)
+            connection.commit()
+    finally:
+        connection.close()
+    return path
+
+
+def get_database(data_dir: str, size: int, seed: int = 0) -> str:
+    """
+    Returns the generated database of the size, generating it only if it doesn't exist yet.
+    :param data_dir: Folder of the generated databases.
+    :param size: Target size in bytes.
+    :param seed: Seed of the random content.
+    :return: Path of the database file.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"bench_{format_size(size)}_{seed}.db")
+    if not os.path.exists(path):
+        print(f"Generating {format_size(size)} database {path}")
+        generate_database(f"{path}.tmp", size, seed)
+        os.replace(f"{path}.tmp", path)
+    return path
@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+# Control commands and their arguments, they must not wait for the backup modules
+COMMANDS = {
+    "stop": ["--stop"],
+    "status": ["--status"],
+    "help": ["--help"],
+}
+# Modules that only the backups need, importing one of them in a control command fails the benchmark
+FORBIDDEN = ("paramiko", "requests", "cryptography", "PyQt5", "src.db.database_backup")
+
+
+def parse_importtime(output: str) -> Dict[str, int]:
+    """
+    Parses the output of python -X importtime.
+    :return: Cumulative import time in microseconds of every top-level import, by module name.
+    """
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented below the import that triggered them
+        if name.startswith("  ") or not cumulative.strip().isdigit():
+            continue
+        imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def _imported_modules(output: str) -> List[str]:
+    return [line.rsplit("|", 1)[1].strip() for line in output.splitlines()
+            if line.startswith("import time:") and "|" in line]
+
+
+def measure(args: List[str], cwd: str) -> dict:
+    """
+    Runs main.py with the arguments and measures the imports that the interpreter startup doesn't do anyway.
+    """
+    start = time.monotonic()
+    command = subprocess.run([sys.executable, "-X", "importtime", MAIN, *args], cwd=cwd,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.monotonic() - start
+    baseline = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], cwd=cwd,
+                              stderr=subprocess.PIPE, text=True)
+    startup = parse_importtime(baseline.stderr)
+    imports = {name: duration for name, duration in parse_importtime(command.stderr).items() if name not in startup}
+    modules = _imported_modules(command.stderr)
+    return {
+        "wall_ms": wall * 1000,
+        "import_ms": sum(imports.values()) / 1000,
+        "slowest": sorted(imports.items(), key=lambda item: item[1], reverse=True)[:5],
+        "forbidden": [prefix for prefix in FORBIDDEN
+                      if any(module == prefix or module.startswith(f"{prefix}.") for module in modules)],
+    }
+
+
+def run_importtime(commands: List[str], repeat: int, budget_ms: float) -> List[dict]:
+    """
+    Measures every control command repeat times.
+    :return: One result per command with the median import time and whether it stayed within the budget.
+    """
+    results = []
+    # An empty working directory, so no PID file or service is found
+    with tempfile.TemporaryDirectory(prefix="db-backup-importtime-") as cwd:
+        for name in commands:
+            runs = [measure(COMMANDS[name], cwd) for _ in range(repeat)]
+            import_ms = statistics.median(run["import_ms"] for run in runs)
+            results.append({
+                "command": name,
+                "import_ms": round(import_ms, 1),
+                "wall_ms": round(statistics.median(run["wall_ms"] for run in runs), 1),
+                "slowest": [{"module": module, "ms": round(duration / 1000, 1)}
+                            for module, duration in runs[-1]["slowest"]],
+                "forbidden": runs[-1]["forbidden"],
+                "within_budget": import_ms <= budget_ms and not runs[-1]["forbidden"],
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the import time of the CLI control commands.")
+    parser.add_argument("--commands", default=",".join(COMMANDS),
+                        help=f"Comma-separated commands of: {', '.join(COMMANDS)}.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command, the median counts.")
+    parser.add_argument("--budget-ms", type=float, default=50.0,
+                        help="Import time a command may take on top of the interpreter startup, default 50.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    commands = [command.strip() for command in args.commands.split(",") if command.strip()]
+    unknown = [command for command in commands if command not in COMMANDS]
+    if unknown:
+        parser.error(f"Unknown commands: {', '.join(unknown)}")
+    results = run_importtime(commands, args.repeat, args.budget_ms)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            marker = "" if result["within_budget"] else "OVER BUDGET"
+            print(f"{result['command']:<8} imports {result['import_ms']:>7.1f} ms, wall {result['wall_ms']:>7.1f} ms "
+                  f"{marker}")
+            for slow in result["slowest"]:
+                print(f"    {slow['module']:<30} {slow['ms']:>7.1f} ms")
+            if result["forbidden"]:
+                print(f"    imports {', '.join(result['forbidden'])}")
+    sys.exit(0 if all(result["within_budget"] for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import paramiko
+
+from benchmarks.data import format_size, get_database, parse_size
+from benchmarks.standins import HTTPStandIn, SFTPStandIn
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory isn't reported there
+    resource = None
+
+# Destinations and configuration of each scenario, on top of the default configuration files
+SCENARIOS = {
+    "local": {"use_local_backup": True},
+    "local-gzip": {"use_local_backup": True, "backup": {"compression": "gzip"}},
+    "local-zstd": {"use_local_backup": True, "backup": {"compression": "zstd"}},
+    "repository": {"use_local_backup": True, "backup": {"storage_mode": "repository"}},
+    "verify": {"use_local_backup": True, "backup": {"verification_mode": "quick"}},
+    "sftp": {"send_to_server": True},
+    "sftp-parallel": {"send_to_server": True, "ssh": {"upload_streams": 4, "upload_part_mb": 16}},
+    "api": {"send_to_api": True},
+    "api-chunked": {"send_to_api": True, "api": {"upload_mode": "chunked"}},
+    "all": {"use_local_backup": True, "send_to_server": True, "send_to_api": True},
+    "streaming": {"use_local_backup": True, "send_to_server": True, "send_to_api": True,
+                  "backup": {"use_streaming": True, "compression": "zstd"}},
+}
+DEFAULT_SCENARIOS = ("local", "local-zstd", "sftp", "api", "streaming")
+DESTINATIONS = ("api", "ssh")
+MB = 1024 * 1024
+# Longest wait for the verification of the 'verify' scenario
+VERIFICATION_TIMEOUT = 3600
+
+
+def _peak_rss_mb(who: int) -> float:
+    peak = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (MB if sys.platform == "darwin" else 1024), 1)
+
+
+def _wait_for_verification(job_name: str, timeout: float):
+    from src.db.verification import STATUS_SKIPPED
+    from src.service.metrics import metrics
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if metrics.get_histogram("verification_duration_seconds", job=job_name) or \
+                metrics.get("verifications_total", job=job_name, result=STATUS_SKIPPED):
+            return
+        time.sleep(0.05)
+
+
+def _stage(name: str, **labels):
+    from src.service.metrics import metrics
+
+    histogram = metrics.get_histogram(name, **labels)
+    return round(histogram[0], 3) if histogram else None
+
+
+def run_scenario(spec: dict) -> dict:
+    """
+    Runs one backup of a scenario with scheduled_backup and collects its metrics.
+    Runs in a fresh process, so the peak memory and the imports of one run don't affect the next.
+    :param spec: Scenario, database and stand-in settings.
+    :return: Result of the run.
+    """
+    from src.configuration.config import load_all_configs
+    from src.db.database_backup import BackupJob, scheduled_backup
+    from src.db.verification import MODE_NONE, configure_verification, verification_pool
+    from src.service.metrics import metrics
+    from src.transfer.ssh_pool import configure_pool, ssh_pool
+
+    scenario = SCENARIOS[spec["scenario"]]
+    configs = load_all_configs()
+    configs["db"].update(type="SQLite", dbname=spec["database"], extra_options="", parallel_jobs=1)
+    configs["backup"].update(backup_path=spec["backup_path"])
+    configs["ssh"].update(host="127.0.0.1", port=spec["sftp_port"], username="bench",
+                          private_key_path=spec["key_path"], server_folder_path=spec["remote_path"])
+    configs["api"].update(url=spec["api_url"], api_key="")
+    for section in ("db", "backup", "api", "ssh"):
+        configs[section].update(scenario.get(section, {}))
+    configure_pool(configs["ssh"])
+    configure_verification(configs["backup"])
+    job = BackupJob.from_configs(configs, send_to_api=scenario.get("send_to_api", False),
+                                 send_to_server=scenario.get("send_to_server", False),
+                                 use_local_backup=scenario.get("use_local_backup", False))
+
+    output = sys.stdout if spec["verbose"] else open(os.devnull, "w")
+    with contextlib.redirect_stdout(output):
+        start = time.monotonic()
+        scheduled_backup(job)
+        if configs["backup"].get("verification_mode", MODE_NONE) != MODE_NONE:
+            _wait_for_verification(job.name, VERIFICATION_TIMEOUT)
+        wall = time.monotonic() - start
+        verification_pool.shutdown()
+        ssh_pool.close_all()
+
+    database_bytes = os.path.getsize(spec["database"])
+    dump = _stage("dump_duration_seconds", job=job.name)
+    return {
+        "succeeded": bool(metrics.get("runs_total", job=job.name, result="success")),
+        "wall_seconds": round(wall, 3),
+        "stages": {
+            "dump": dump,
+            **{f"upload_{destination}": _stage("upload_duration_seconds", job=job.name, destination=destination)
+               for destination in DESTINATIONS},
+            "retention": _stage("retention_duration_seconds", job=job.name),
+            "verification": _stage("verification_duration_seconds", job=job.name),
+        },
+        "database_bytes": database_bytes,
+        "backup_bytes": metrics.get("dump_bytes", job=job.name),
+        "throughput_mb_s": round(database_bytes / MB / wall, 2) if wall else None,
+        "dump_throughput_mb_s": round(database_bytes / MB / dump, 2) if dump else None,
+        "upload_throughput_mb_s": {
+            destination: round(throughput / MB, 2)
+            for destination in DESTINATIONS
+            if (throughput := metrics.get("upload_throughput_bytes_per_second", job=job.name,
+                                          destination=destination)) is not None
+        },
+        "compression_ratio": metrics.get("compression_ratio", job=job.name),
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        # The dump tool and the verification run in child processes
+        "peak_child_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+
+
+def _run_in_process(spec: dict, results: multiprocessing.Queue):
+    try:
+        results.put(run_scenario(spec))
+    except Exception as e:
+        results.put({"succeeded": False, "error": str(e)})
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(sizes, scenarios, repeat: int = 1, data_dir: str = None, seed: int = 0,
+                   verbose: bool = False) -> dict:
+    """
+    Runs every scenario against generated databases of every size, with local SFTP and HTTP stand-ins as destinations.
+    :param sizes: Database sizes in bytes.
+    :param scenarios: Names of the scenarios in SCENARIOS.
+    :param repeat: Number of runs per scenario and size.
+    :param data_dir: Folder of the generated databases, they are reused by later benchmarks.
+    :param seed: Seed of the generated databases.
+    :param verbose: Show the output of the backups.
+    :return: Environment and the results of all runs.
+    """
+    data_dir = data_dir or os.path.join(tempfile.gettempdir(), "dbbackup-benchmarks")
+    os.makedirs(data_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="run_", dir=data_dir)
+    key_path = os.path.join(work_dir, "id_rsa")
+    paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+    sftp = SFTPStandIn().start()
+    http = HTTPStandIn().start()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for size in sizes:
+            database = get_database(data_dir, size, seed)
+            for scenario in scenarios:
+                for run in range(1, repeat + 1):
+                    backup_path = os.path.join(work_dir, "backups")
+                    remote_path = os.path.join(work_dir, "remote")
+                    for path in (backup_path, remote_path):
+                        shutil.rmtree(path, ignore_errors=True)
+                        os.makedirs(path)
+                    spec = {"scenario": scenario, "database": database, "backup_path": backup_path,
+                            "remote_path": remote_path, "key_path": key_path, "sftp_port": sftp.port,
+                            "api_url": http.url, "verbose": verbose}
+                    sftp_before, http_before = sftp.wire.bytes, http.wire.bytes
+                    queue = context.Queue()
+                    process = context.Process(target=_run_in_process, args=(spec, queue))
+                    process.start()
+                    result = queue.get()
+                    process.join()
+                    result = {"scenario": scenario, "size": format_size(size), "run": run, **result,
+                              "wire_bytes": {"ssh": sftp.wire.bytes - sftp_before,
+                                             "api": http.wire.bytes - http_before}}
+                    results.append(result)
+                    print(f"{scenario} {format_size(size)} run {run}: "
+                          + (f"{result['wall_seconds']:.2f}s, {result['throughput_mb_s']} MB/s"
+                             if "error" not in result else f"error: {result['error']}"), file=sys.stderr)
+    finally:
+        sftp.stop()
+        http.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "environment": {
+            "commit": _git_commit(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end backup benchmarks with local SFTP and HTTP stand-ins.")
+    parser.add_argument("--sizes", default="64M", help="Comma-separated database sizes, e.g. 64M,1G,20G.")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS),
+                        help=f"Comma-separated scenarios: {', '.join(SCENARIOS)}.")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario and size.")
+    parser.add_argument("--data-dir", help="Folder of the generated databases, reused between benchmarks.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated databases.")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the backups.")
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+    report = run_benchmarks([parse_size(size) for size in args.sizes.split(",")], scenarios, repeat=args.repeat,
+                            data_dir=args.data_dir, seed=args.seed, verbose=args.verbose)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import paramiko
+
+# Bytes read from the request bodies at once
+READ_SIZE = 1024 * 1024
+
+
+class WireCounter:
+    """
+    Thread-safe count of the bytes a stand-in received, including protocol overhead.
+    """
+
+    def __init__(self):
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, count: int):
+        with self._lock:
+            self._bytes += count
+
+    @property
+    def bytes(self) -> int:
+        with self._lock:
+            return self._bytes
+
+
+class _CountingSocket:
+    """
+    Socket wrapper that counts the received bytes of an SSH connection.
+    """
+
+    def __init__(self, sock: socket.socket, counter: WireCounter):
+        self._sock = sock
+        self._counter = counter
+
+    def recv(self, size: int) -> bytes:
+        data = self._sock.recv(size)
+        self._counter.add(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class _SSHServer(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return "publickey,password"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+def _sftp_errors(method):
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+    return wrapper
+
+
+class _SFTPInterface(paramiko.SFTPServerInterface):
+    """
+    Serves the local file system, paths are used as they are.
+    """
+
+    @_sftp_errors
+    def list_folder(self, path):
+        entries = []
+        for name in os.listdir(path):
+            attributes = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+            attributes.filename = name
+            entries.append(attributes)
+        return entries
+
+    @_sftp_errors
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    lstat = stat
+
+    @_sftp_errors
+    def open(self, path, flags, attr):
+        fd = os.open(path, flags, 0o644)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    @_sftp_errors
+    def remove(self, path):
+        os.remove(path)
+        return paramiko.SFTP_OK
+
+    @_sftp_errors
+    def rename(self, oldpath, newpath):
+        os.replace(oldpath, newpath)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+    @_sftp_errors
+    def mkdir(self, path, attr):
+        os.mkdir(path)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+class SFTPStandIn:
+    """
+    Local SFTP server that accepts any credentials and writes the uploads to the local file system.
+    """
+
+    def __init__(self):
+        # Clients closing their connection at the end of a run are logged as socket errors
+        logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+        self.wire = WireCounter()
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.listen(32)
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _address = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(_CountingSocket(connection, self.wire))
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _SFTPInterface)
+            transport.start_server(server=_SSHServer())
+            self._transports.append(transport)
+
+    def start(self) -> "SFTPStandIn":
+        threading.Thread(target=self._accept, name="sftp-stand-in", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+
+class _CountingReader:
+    """
+    Wraps the request stream of the HTTP stand-in to count the received bytes.
+    """
+
+    def __init__(self, stream, counter: WireCounter):
+        self._stream = stream
+        self._counter = counter
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._counter.add(len(data))
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        data = self._stream.readline(size)
+        self._counter.add(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _UploadHandler(BaseHTTPRequestHandler):
+    """
+    Accepts multipart uploads and resumable tus uploads. The received data is counted and discarded,
+    so the stand-in doesn't slow down the client or fill the disk.
+    """
+    protocol_version = "HTTP/1.1"
+    server: "HTTPStandIn"
+
+    def setup(self):
+        super().setup()
+        self.rfile = _CountingReader(self.rfile, self.server.wire)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _discard_body(self) -> int:
+        received = 0
+        if self.headers.get("Transfer-Encoding", "").casefold() == "chunked":
+            while True:
+                length = int(self.rfile.readline().split(b";")[0], 16)
+                if length == 0:
+                    self.rfile.readline()
+                    return received
+                received += self._discard(length)
+                self.rfile.readline()
+        return self._discard(int(self.headers.get("Content-Length", 0)))
+
+    def _discard(self, length: int) -> int:
+        remaining = length
+        while remaining:
+            data = self.rfile.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+        return length - remaining
+
+    def _respond(self, status: int, **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name.replace("_", "-"), value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if "Upload-Length" in self.headers:
+            upload_id = uuid.uuid4().hex
+            self.server.offsets[upload_id] = 0
+            self._respond(201, Location=f"/files/{upload_id}")
+        else:
+            self._discard_body()
+            self._respond(200)
+
+    def do_HEAD(self):
+        offset = self.server.offsets.get(self.path.rsplit("/", 1)[-1])
+        if offset is None:
+            self._respond(404)
+        else:
+            self._respond(200, Upload_Offset=str(offset))
+
+    def do_PATCH(self):
+        upload_id = self.path.rsplit("/", 1)[-1]
+        if upload_id not in self.server.offsets:
+            self._respond(404)
+            return
+        self.server.offsets[upload_id] += self._discard_body()
+        self._respond(204, Upload_Offset=str(self.server.offsets[upload_id]))
+
+
+class HTTPStandIn(ThreadingHTTPServer):
+    """
+    Local HTTP upload server for the API destination.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _UploadHandler)
+        self.wire = WireCounter()
+        self.offsets = {}
+        self.port = self.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/upload"
+
+    def start(self) -> "HTTPStandIn":
+        threading.Thread(target=self.serve_forever, name="http-stand-in", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -6,10 +6,14 @@ import threading
 import subprocess
 import time
 
-from src.configuration.config import load_all_configs, save_all_configs
-from src.db.database_backup import run_backup_service, start_service, stop_service
+from src.service.control import default_socket_path, send_command
+
+# The backup modules pull in paramiko and requests, which take most of the startup time. They are imported
+# in the code paths that run backups, so control commands like --stop start quickly.
 
 PID_FILE = "backup_service.pid"
+# Outside the working directory, so the service and the commands find it from anywhere
+CONTROL_SOCKET = default_socket_path()
 
 
 def start_in_background():
@@ -20,6 +24,14 @@ def start_in_background():
 
 
 def stop_background_service():
+    # A service with a control socket stops gracefully, older ones or hanging ones are terminated
+    try:
+        print(send_command(CONTROL_SOCKET, "stop")["message"])
+        if os.path.exists(PID_FILE):
+            os.remove(PID_FILE)
+        return
+    except (ConnectionError, OSError, ValueError, KeyError):
+        pass
     try:
         with open(PID_FILE, "r") as pid_file:
             pid = int(pid_file.read().strip())
@@ -33,7 +45,41 @@ def stop_background_service():
     except Exception as e:
         print(f"Error stopping the service: {e}")
 
+def print_status(status: dict):
+    print(f"Service: {status['service']}")
+    print(f"Running: {', '.join(status['running']) or '-'}")
+    print(f"Queued: {', '.join(status['queued']) or '-'}")
+    for job, next_run in status["next_runs"].items():
+        print(f"Next run of {job}: {next_run or '-'}")
+    for job, event in status["progress"].items():
+        done = f"{event['done'] / 1024 / 1024:.1f} MB"
+        if event["total"]:
+            done += f" of {event['total'] / 1024 / 1024:.1f} MB"
+        print(f"{job}: {event['stage']} {done} at {event['rate'] / 1024 / 1024:.1f} MB/s")
+
+
+def control_service(command: str) -> bool:
+    """
+    Sends a command to the service running in the background and prints its answer.
+    :return: True if the service ran the command.
+    """
+    try:
+        response = send_command(CONTROL_SOCKET, command)
+    except (ConnectionError, OSError) as e:
+        print(f"Error contacting the backup service: {e}")
+        return False
+    if not response["ok"]:
+        print(f"Error: {response['error']}")
+    elif command == "status":
+        print_status(response)
+    else:
+        print(response["message"])
+    return response["ok"]
+
+
 def save_parsed_args(args):
+    from src.configuration.config import load_all_configs, save_all_configs
+
     configs = load_all_configs()
     if args.api_url:
         configs["api"]["url"] = args.api_url
@@ -70,11 +116,62 @@ def save_parsed_args(args):
 
     save_all_configs(configs)
 
+
+def decrypt_file(path: str) -> bool:
+    """
+    Decrypts an encrypted backup next to it, with the key configured in backup_config.json.
+    :return: True if the file was decrypted.
+    """
+    from src.configuration.config import load_all_configs
+    from src.pipeline.encryption import ENCRYPTED_SUFFIX, encryption_key, open_decrypted
+
+    if not path.endswith(ENCRYPTED_SUFFIX):
+        print(f"Error: {path} doesn't end with {ENCRYPTED_SUFFIX}.")
+        return False
+    target = path[:-len(ENCRYPTED_SUFFIX)]
+    try:
+        key = encryption_key(load_all_configs()["backup"])
+        if key is None:
+            print("Error: No encryption_key_file is configured in backup_config.json.")
+            return False
+        with open_decrypted(path, key) as source, open(target + ".part", "wb") as f:
+            while chunk := source.read(1024 * 1024):
+                f.write(chunk)
+        os.replace(target + ".part", target)
+    except (OSError, ValueError) as e:
+        if os.path.exists(target + ".part"):
+            os.remove(target + ".part")
+        print(f"Error decrypting {path}: {e}")
+        return False
+    print(f"Decrypted {path} to {target}")
+    return True
+
+
+def generate_key(path: str) -> bool:
+    from src.pipeline.encryption import generate_key_file
+
+    try:
+        generate_key_file(path)
+    except OSError as e:
+        print(f"Error writing the key file: {e}")
+        return False
+    print(f"Encryption key written to {path}, keep a copy of it outside the backups.")
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser(description="Database Backup Service")
     parser.add_argument('--start', action='store_true', help="Start the backup service.")
     parser.add_argument('--stop', action='store_true', help="Stop the backup service.")
     parser.add_argument('--background', action='store_true', help="Run the service in the background.")
+    parser.add_argument('--jobs', action='store_true', help="Back up all database targets from jobs_config.json.")
+    parser.add_argument('--status', action='store_true', help="Show the running, queued and scheduled backups.")
+    parser.add_argument('--run-now', metavar="JOB", help="Back up a job of the running service now.")
+    parser.add_argument('--reload', action='store_true', help="Apply the configuration files to the running service.")
+    parser.add_argument('--drain', action='store_true',
+                        help="Finish the queued and running backups, then stop the service.")
+    parser.add_argument('--decrypt', metavar="FILE", help="Decrypt an encrypted backup next to it.")
+    parser.add_argument('--generate-key', metavar="FILE", help="Write a new random encryption key to the file.")
     parser.add_argument("--api_url", help="API URL to send the backups to.")
     parser.add_argument("--api_key", help="API Key for authentication.")
     parser.add_argument("--interval_minutes", type=int, help="Interval in minutes for the backup service.")
@@ -108,14 +205,28 @@ def main():
         stop_background_service()
         return
 
+    for command, requested in (("status", args.status), (f"run-now {args.run_now}", args.run_now),
+                               ("reload", args.reload), ("drain", args.drain)):
+        if requested:
+            sys.exit(0 if control_service(command) else 1)
+
+    if args.generate_key:
+        sys.exit(0 if generate_key(args.generate_key) else 1)
+    if args.decrypt:
+        sys.exit(0 if decrypt_file(args.decrypt) else 1)
+
     save_parsed_args(args)
-    configs = load_all_configs()
 
     if args.start:
+        from src.configuration.config import load_all_configs
+        from src.db.database_backup import run_backup_service, start_service, stop_service
+
+        configs = load_all_configs()
         start_service()
         send_to_api = bool(configs["api"]["url"] and configs["api"]["api_key"])
-
-        backup_thread = threading.Thread(target=run_backup_service, args=(send_to_api,), daemon=True)
+        backup_thread = threading.Thread(target=run_backup_service, args=(send_to_api,),
+                                         kwargs={"jobs_from_config": args.jobs, "control_socket": CONTROL_SOCKET},
+                                         daemon=True)
         backup_thread.start()
         print("Backup service started in console mode. Press Ctrl+C to stop.")
         try:
@@ -1,31 +1,202 @@
+import copy
 import json
 import os
+import tempfile
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 CONFIG_DIR = os.path.dirname(__file__)
+SECTION_FILES = {"db": "db_config.json", "backup": "backup_config.json", "api": "api_config.json",
+                 "ssh": "ssh_config.json"}
+# Seconds between two checks of the configuration files for changes
+WATCH_INTERVAL = 2.0
+
+
+def _signature(file_path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ConfigStore:
+    """
+    In-memory cache of the configuration files. A file is only parsed again when its modification time or size
+    changed, and only files whose content changed are written. Saves can be delayed, so a burst of edits
+    (e.g. typing into a field of the UI) ends in a single write. Files are written to a temporary file that
+    replaces the old one, so a reader never sees a half-written file.
+    """
+
+    def __init__(self, config_dir: str = CONFIG_DIR):
+        self.config_dir = config_dir
+        self._cache: Dict[str, dict] = {}
+        self._signatures: Dict[str, Optional[Tuple[int, int]]] = {}
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._timer: Optional[threading.Timer] = None
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.config_dir, filename)
+
+    def _cached(self, filename: str) -> dict:
+        # Unsaved changes are newer than the file
+        if filename not in self._dirty:
+            signature = _signature(self.path(filename))
+            if filename not in self._cache or signature != self._signatures.get(filename):
+                with open(self.path(filename), 'r') as file:
+                    self._cache[filename] = json.load(file)
+                self._signatures[filename] = signature
+        return self._cache[filename]
+
+    def load(self, filename: str) -> dict:
+        """
+        Returns a copy of the configuration file, changes to it are only kept by save().
+        """
+        with self._lock:
+            return copy.deepcopy(self._cached(filename))
+
+    def save(self, filename: str, data: dict, delay: float = 0):
+        """
+        Saves a configuration file if its content changed.
+        :param filename: Name of the file in the configuration folder.
+        :param data: New content.
+        :param delay: Seconds to wait for further changes before writing, 0 writes immediately.
+        """
+        with self._lock:
+            try:
+                unchanged = self._cached(filename) == data
+            except FileNotFoundError:
+                unchanged = False
+            if not unchanged:
+                self._cache[filename] = copy.deepcopy(data)
+                self._dirty.add(filename)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            if delay > 0:
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self.flush()
+
+    def _write(self, filename: str, data: dict):
+        fd, temp_path = tempfile.mkstemp(prefix=f".{filename}.", dir=self.config_dir)
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(data, file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path(filename))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def flush(self):
+        """
+        Writes all unsaved changes.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            for filename in sorted(self._dirty):
+                self._write(filename, self._cache[filename])
+                self._signatures[filename] = _signature(self.path(filename))
+            self._dirty.clear()
+
+
+config_store = ConfigStore()
 
 
 def load_config(filename):
-    file_path = os.path.join(CONFIG_DIR, filename)
-    with open(file_path, 'r') as file:
-        return json.load(file)
+    return config_store.load(filename)
 
 
-def save_config(filename, data):
-    file_path = os.path.join(CONFIG_DIR, filename)
-    with open(file_path, 'w') as file:
-        json.dump(data, file, indent=4)
+def save_config(filename, data, delay=0):
+    config_store.save(filename, data, delay=delay)
 
 
 def load_all_configs():
-    db_config = load_config('db_config.json')
-    backup_config = load_config('backup_config.json')
-    api_config = load_config('api_config.json')
-    ssh_config = load_config('ssh_config.json')
-    return {"db": db_config, "backup": backup_config, "api": api_config, "ssh": ssh_config}
-
-
-def save_all_configs(configs):
-    save_config('db_config.json', configs['db'])
-    save_config('backup_config.json', configs['backup'])
-    save_config('api_config.json', configs['api'])
-    save_config('ssh_config.json', configs['ssh'])
+    return {section: load_config(filename) for section, filename in SECTION_FILES.items()}
+
+
+def save_all_configs(configs, delay=0):
+    """
+    Saves the sections whose content changed.
+    :param configs: Configurations as returned by load_all_configs.
+    :param delay: Seconds to wait for further changes before writing, 0 writes immediately.
+    """
+    for section, filename in SECTION_FILES.items():
+        save_config(filename, configs[section], delay=delay)
+
+
+class ConfigWatcher:
+    """
+    Checks the configuration files for changes in a background thread and reports the files whose content changed,
+    e.g. edits in the UI or with a text editor while the service runs. Only the modification time and size are
+    checked on every round, a file is only parsed after they changed.
+    """
+
+    def __init__(self, filenames: Iterable[str], callback: Callable[[List[str]], None],
+                 interval: float = WATCH_INTERVAL, store: ConfigStore = config_store):
+        """
+        :param filenames: Names of the watched files in the configuration folder.
+        :param callback: Called in the watcher thread with the names of the changed files.
+        :param interval: Seconds between two checks.
+        :param store: Store the files are read from.
+        """
+        self.filenames = list(filenames)
+        self.callback = callback
+        self.interval = interval
+        self.store = store
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name="config-watcher", daemon=True)
+        self._contents = {}
+        self._signatures = {}
+        for filename in self.filenames:
+            self._signatures[filename] = _signature(self.store.path(filename))
+            try:
+                self._contents[filename] = self.store.load(filename)
+            except (FileNotFoundError, ValueError):
+                self._contents[filename] = None
+
+    def check(self) -> List[str]:
+        """
+        Returns the names of the files whose content changed since the last check.
+        """
+        changed = []
+        for filename in self.filenames:
+            signature = _signature(self.store.path(filename))
+            if signature == self._signatures[filename]:
+                continue
+            try:
+                content = self.store.load(filename)
+            except (FileNotFoundError, ValueError):
+                # Missing or being edited, the next check sees the finished file
+                continue
+            self._signatures[filename] = signature
+            if content != self._contents[filename]:
+                self._contents[filename] = content
+                changed.append(filename)
+        return changed
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            changed = self.check()
+            if changed:
+                try:
+                    self.callback(changed)
+                except Exception as e:
+                    print(f"Error applying the changed configuration: {e}")
+
+    def start(self) -> "ConfigWatcher":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
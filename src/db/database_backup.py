@@ -1,107 +1,530 @@
-from typing import Dict, Tuple
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Tuple
 
-import schedule
-import time
+import json
 import paramiko
 import os
+import shutil
+import sqlite3
 import subprocess
-import requests
+import tempfile
+import time
 from datetime import datetime
 from src.configuration.config import load_all_configs
+from src.pipeline.checksum import (MANIFEST_SUFFIX, create_checksum_stage, hash_file, read_manifest,
+                                   write_manifest)
+from src.pipeline.compression import COMPRESSION_SUFFIXES, create_compressor
+from src.pipeline.encryption import ENCRYPTED_SUFFIX, create_encryptor
+from src.pipeline.progress import (STAGE_DUMP, STAGE_UPLOAD, BackupCancelled, ProgressTracker, cancellation, progress,
+                                   wait_for_process)
+from src.pipeline.stream import (LocalFileSink, StreamResult, StreamSink, run_source_pipeline, run_stream_pipeline,
+                                 tar_stream)
+from src.storage.catalog import (STATUS_COMPLETE, STATUS_EXPIRED, STATUS_FAILED, STORAGE_FILE, STORAGE_REMOTE,
+                                 STORAGE_REPOSITORY, BackupCatalog, RetentionPolicy, open_catalog)
+from src.storage.repository import BackupRepository, RepositorySink, create_chunker, open_repository
+from src.db.mysql_parallel import DEFAULT_LOCK_WAIT_TIMEOUT, MySQLDumpError, dump_database
+from src.db.sqlite_backup import (DEFAULT_PAGES_PER_STEP, DEFAULT_STEP_SLEEP_MS, ENGINE_NATIVE, backup_database,
+                                  change_tracker)
+from src.db.verification import (MODE_NONE, STATUS_PASSED, STATUS_SKIPPED, configure_verification,
+                                 verification_pool, verify_backup)
+from src.transfer.api_upload import ApiStreamSink, upload_data, upload_file
+from src.transfer.sftp_delta import DELTA_SUFFIX, DeltaResult, DeltaUploader, SignatureCache
+from src.transfer.sftp_parallel import create_parallel_uploader, remote_sha256
+from src.transfer.sftp_retention import RETENTION_CATALOG, RETENTION_NONE, apply_remote_retention
+from src.transfer.ssh_pool import configure_pool, ssh_pool
+from src.transfer.destinations import STATUS_SUCCESS, STATUS_TIMEOUT, run_destinations
+from src.service.metrics import metrics, start_metrics_server
 
-configs = load_all_configs()
+service_running = True
+# Job engine of the running service, used by stop_service to wake it up
+_engine = None
 
-DB_CONFIG = configs["db"]
-BACKUP_CONFIG = configs["backup"]
-API_CONFIG = configs["api"]
-SSH_CONFIG = configs["ssh"]
+# Parallel PostgreSQL and MySQL dumps are directories that are packed into one tar archive
+BACKUP_SUFFIXES = tuple(f".{extension}{suffix}{encrypted}" for extension in ("sql", "tar")
+                        for suffix in COMPRESSION_SUFFIXES.values() for encrypted in ("", ENCRYPTED_SUFFIX))
 
-service_running = True
 
+@dataclass
+class BackupJob:
+    """
+    A database target with its own configuration and destinations. All backup functions take the job
+    they work on, so one process can back up many databases at the same time.
+    """
+    name: str
+    db: dict
+    backup: dict
+    api: dict
+    ssh: dict
+    send_to_api: bool = False
+    send_to_server: bool = False
+    use_local_backup: bool = False
+
+    @classmethod
+    def from_configs(cls, configs: dict, name: str = None, send_to_api=False, send_to_server=False,
+                     use_local_backup=False) -> "BackupJob":
+        """
+        Creates a job from the loaded configuration files.
+        :param configs: Configurations as returned by load_all_configs.
+        :param name: Name of the job, defaults to the database name.
+        """
+        # SQLite databases are configured by their path, only the file name belongs into the backup name
+        job = cls(
+            name=name or os.path.basename(configs["db"]["dbname"]),
+            db=configs["db"],
+            backup=configs["backup"],
+            api=configs["api"],
+            ssh=configs["ssh"],
+            send_to_api=send_to_api,
+            send_to_server=send_to_server,
+            use_local_backup=use_local_backup
+        )
+        job.validate()
+        return job
+
+    def validate(self):
+        """
+        :raises ValueError: If settings of the job can't be combined.
+        """
+        # Every encrypted file has its own random salt, so its chunks and blocks never match those of another backup
+        if use_encryption(self) and use_repository(self):
+            raise ValueError(f"Job {self.name}: encryption_key_file can't be combined with storage_mode "
+                             f"'repository', encrypted backups can't be deduplicated.")
+        if use_encryption(self) and use_delta_transfer(self):
+            raise ValueError(f"Job {self.name}: encryption_key_file can't be combined with transfer_mode 'delta', "
+                             f"encrypted backups have no blocks in common with the last one.")
 
-def get_dump_command(dump_path: str) -> Tuple:
+    @property
+    def db_host(self) -> str:
+        """
+        Host the dump runs against, SQLite databases are local files.
+        """
+        if self.db["type"].casefold() == "sqlite":
+            return "localhost"
+        return self.db.get("host") or "localhost"
+
+    @property
+    def backup_prefix(self) -> str:
+        return f"{self.name}_backup_"
+
+
+def get_dump_command(job: BackupJob, dump_path: str) -> Tuple:
     """
     Returns the command to dump the database based on the database type.
+    :param job: Backup job.
     :param dump_path: Database (e.g. 'postgresql', 'mysql', 'sqlite', 'mssql' or 'oracle')
     :return: Tuple of dump command and environment variables.
     """
-    extra_options = DB_CONFIG.get("extra_options", "").split()
+    extra_options = job.db.get("extra_options", "").split()
 
-    match DB_CONFIG["type"].casefold():
+    match job.db["type"].casefold():
         case 'postgresql':
             dump_command = [
                                "pg_dump",
-                               "-h", DB_CONFIG["host"],
-                               "-p", str(DB_CONFIG["port"]),
-                               "-U", DB_CONFIG["user"],
+                               "-h", job.db["host"],
+                               "-p", str(job.db["port"]),
+                               "-U", job.db["user"],
                                "-F", "c",
-                               "-d", DB_CONFIG["dbname"],
+                               "-d", job.db["dbname"],
                                "-f", dump_path
                            ] + extra_options
             env = os.environ.copy()
-            env["PGPASSWORD"] = DB_CONFIG["password"]
+            env["PGPASSWORD"] = job.db["password"]
         case 'mysql':
             dump_command = [
                                "mysqldump",
-                               "-h", DB_CONFIG["host"],
-                               "-P", str(DB_CONFIG["port"]),
-                               "-u", DB_CONFIG["user"],
-                               f"--password={DB_CONFIG['password']}",
-                               DB_CONFIG["dbname"],
+                               "-h", job.db["host"],
+                               "-P", str(job.db["port"]),
+                               "-u", job.db["user"],
+                               f"--password={job.db['password']}",
+                               job.db["dbname"],
                                f"--result-file={dump_path}"
                            ] + extra_options
             env = None
         case 'sqlite':
             dump_command = [
                                "sqlite3",
-                               DB_CONFIG["dbname"],
+                               job.db["dbname"],
                                f".backup {dump_path}"
                            ] + extra_options
             env = None
         case 'mssql':
             dump_command = [
                                "sqlcmd",
-                               "-S", f"{DB_CONFIG['host']},{DB_CONFIG['port']}",
-                               "-U", DB_CONFIG["user"],
-                               "-P", DB_CONFIG["password"],
-                               "-Q", f"BACKUP DATABASE [{DB_CONFIG['dbname']}] TO DISK = '{dump_path}'"
+                               "-S", f"{job.db['host']},{job.db['port']}",
+                               "-U", job.db["user"],
+                               "-P", job.db["password"],
+                               "-Q", f"BACKUP DATABASE [{job.db['dbname']}] TO DISK = '{dump_path}'"
                            ] + extra_options
             env = None
 
         case 'oracle':
             dump_command = [
                                "expdp",
-                               f"{DB_CONFIG['user']}/{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['service_name']}",
+                               f"{job.db['user']}/{job.db['password']}@{job.db['host']}:{job.db['port']}/{job.db['service_name']}",
                                f"directory=DATA_PUMP_DIR",
                                f"dumpfile={os.path.basename(dump_path)}",
-                               f"schemas={DB_CONFIG['schema']}"
+                               f"schemas={job.db['schema']}"
                            ] + extra_options
             env = os.environ.copy()
 
             # Oracle's Data Pump Export requires environment variables for configuration, if needed.
-            env["ORACLE_HOME"] = DB_CONFIG.get("home", "")
+            env["ORACLE_HOME"] = job.db.get("home", "")
             env["PATH"] = f"{env['ORACLE_HOME']}/bin:" + env.get("PATH", "")
         case _:
-            raise ValueError(f"Unsupported database type: {DB_CONFIG['type']}")
+            raise ValueError(f"Unsupported database type: {job.db['type']}")
 
     return dump_command, env
 
 
-def create_db_dump():
+def get_stream_command(job: BackupJob) -> Tuple:
+    """
+    Returns the command to dump the database to stdout, used by the streaming pipeline.
+    MSSQL and Oracle write their backups on the database server, so they can't be streamed.
+    :param job: Backup job.
+    :return: Tuple of dump command and environment variables.
+    """
+    extra_options = job.db.get("extra_options", "").split()
+    # Let the compression stage do the work instead of compressing twice
+    if job.backup.get("compression", "none").casefold() != "none" and job.db["type"].casefold() == "postgresql":
+        extra_options = ["-Z", "0"] + extra_options
+
+    match job.db["type"].casefold():
+        case 'postgresql':
+            dump_command = [
+                               "pg_dump",
+                               "-h", job.db["host"],
+                               "-p", str(job.db["port"]),
+                               "-U", job.db["user"],
+                               "-F", "c",
+                               "-d", job.db["dbname"]
+                           ] + extra_options
+            env = os.environ.copy()
+            env["PGPASSWORD"] = job.db["password"]
+        case 'mysql':
+            dump_command = [
+                               "mysqldump",
+                               "-h", job.db["host"],
+                               "-P", str(job.db["port"]),
+                               "-u", job.db["user"],
+                               f"--password={job.db['password']}",
+                               job.db["dbname"]
+                           ] + extra_options
+            env = None
+        case 'sqlite':
+            # .backup needs a target file, .dump writes the whole database as SQL to stdout
+            dump_command = [
+                               "sqlite3",
+                               job.db["dbname"],
+                               ".dump"
+                           ] + extra_options
+            env = None
+        case _:
+            raise ValueError(f"Streaming is not supported for database type: {job.db['type']}")
+
+    return dump_command, env
+
+
+def get_backup_file_name(job: BackupJob, compression: str = "none", extension: str = "sql",
+                         encrypted: bool = False) -> str:
+    """
+    Returns the file name for a new backup of the job's database.
+    :param job: Backup job.
+    :param compression: Compression algorithm of the backup, adds '.gz' or '.zst' to the name.
+    :param extension: 'sql' for dump files, 'tar' for archived dump directories.
+    :param encrypted: Whether the backup is encrypted, adds '.enc' to the name.
+    :return: File name including the timestamp.
+    """
+    suffix = COMPRESSION_SUFFIXES[compression.casefold()] + (ENCRYPTED_SUFFIX if encrypted else "")
+    return f"{job.backup_prefix}{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}{suffix}"
+
+
+def get_parallel_jobs(job: BackupJob) -> int:
+    """
+    Returns the number of parallel dump workers of PostgreSQL and MySQL, 1 means a regular single-threaded dump.
+    "parallel_jobs": 0 in the database configuration picks the number of CPU cores.
+    :param job: Backup job.
+    """
+    if job.db["type"].casefold() not in ("postgresql", "mysql"):
+        return 1
+    parallel_jobs = int(job.db.get("parallel_jobs", 1))
+    if parallel_jobs == 0:
+        # Every worker holds its own database connection, so don't go beyond a few cores
+        parallel_jobs = min(os.cpu_count() or 1, 8)
+    return max(parallel_jobs, 1)
+
+
+def get_parallel_dump_command(job: BackupJob, directory: str) -> Tuple:
+    """
+    Returns the command for a parallel PostgreSQL dump in the directory format.
+    :param job: Backup job.
+    :param directory: Empty directory the dump is written to.
+    :return: Tuple of dump command and environment variables.
+    """
+    extra_options = job.db.get("extra_options", "").split()
+    # Let the compression stage do the work instead of compressing twice
+    if job.backup.get("compression", "none").casefold() != "none":
+        extra_options = ["-Z", "0"] + extra_options
+
+    dump_command = [
+                       "pg_dump",
+                       "-h", job.db["host"],
+                       "-p", str(job.db["port"]),
+                       "-U", job.db["user"],
+                       "-F", "d",
+                       "-j", str(get_parallel_jobs(job)),
+                       "-d", job.db["dbname"],
+                       "-f", directory
+                   ] + extra_options
+    env = os.environ.copy()
+    env["PGPASSWORD"] = job.db["password"]
+    return dump_command, env
+
+
+def run_parallel_dump(job: BackupJob, file_name: str, sinks: List[StreamSink],
+                      transforms: List[Callable[[Iterator[bytes]], Iterator[bytes]]],
+                      tracker: ProgressTracker = None) -> Optional[StreamResult]:
+    """
+    Dumps the PostgreSQL or MySQL database with parallel workers into a temporary directory and streams
+    the directory as one tar archive into the sinks, so the rest of the pipeline handles it as a single backup.
+    :param job: Backup job.
+    :param file_name: Name of the backup, the directory inside the archive is named after it.
+    :param sinks: Destinations of the archive.
+    :param transforms: Pipeline stages, e.g. compression and checksums.
+    :param tracker: Progress of the dump, updated while the archive is streamed.
+    :return: StreamResult or None if the dump failed.
+    """
+    directory = tempfile.mkdtemp(prefix=job.backup_prefix, dir=job.backup["backup_path"])
+    try:
+        dumped = 0
+        if job.db["type"].casefold() == "mysql":
+            try:
+                dump_result = dump_database(job.db, directory, get_parallel_jobs(job),
+                                            job.db.get("extra_options", "").split(),
+                                            job.db.get("mysql_lock_wait_timeout", DEFAULT_LOCK_WAIT_TIMEOUT),
+                                            progress=tracker.add if tracker else None)
+            except MySQLDumpError as e:
+                print(f"Error while creating backup: {e}")
+                return None
+            print(f"Dumped {dump_result.tables} tables with {dump_result.rows} rows from one snapshot with "
+                  f"{dump_result.workers} workers in {dump_result.duration:.1f}s, "
+                  f"the read lock was held for {dump_result.lock_duration:.2f}s")
+            dumped = dump_result.bytes
+        else:
+            _dump_command, _env = get_parallel_dump_command(job, directory)
+            returncode = wait_for_process(subprocess.Popen(_dump_command, env=_env))
+            if returncode != 0:
+                print(f"Error while creating backup: {subprocess.CalledProcessError(returncode, _dump_command)}")
+                return None
+        chunk_size = job.backup.get("stream_chunk_size_kb", 1024) * 1024
+        return run_source_pipeline(
+            tar_stream(directory, file_name.split(".tar")[0], chunk_size), sinks,
+            chunk_size=chunk_size,
+            buffer_size=job.backup.get("stream_buffer_mb", 64) * 1024 * 1024,
+            transforms=transforms,
+            # The archive's bytes are counted after the bytes the workers wrote
+            progress=(lambda count: tracker.update(dumped + count)) if tracker else None
+        )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def expected_dump_size(job: BackupJob) -> Optional[int]:
+    """
+    Returns the expected size of the uncompressed dump for the progress, None if it isn't known in advance.
+    """
+    if job.db["type"].casefold() == "sqlite" and os.path.exists(job.db["dbname"]):
+        return os.path.getsize(job.db["dbname"])
+    return None
+
+
+def print_compression_summary(job: BackupJob, compressor):
+    """
+    Prints the compression summary and records the ratio and throughput in the metrics.
+    """
+    print(compressor.summary())
+    metrics.set("compression_ratio", compressor.ratio, job=job.name)
+    metrics.set("compression_throughput_bytes_per_second", compressor.throughput * 1024 * 1024, job=job.name)
+
+
+def print_encryption_summary(job: BackupJob, encryptor):
+    """
+    Prints the encryption summary and records the time spent encrypting in the metrics.
+    """
+    print(encryptor.summary())
+    metrics.set("encryption_seconds", encryptor.duration, job=job.name)
+
+
+def use_encryption(job: BackupJob) -> bool:
+    return bool(job.backup.get("encryption_key_file", ""))
+
+
+def create_transforms(compressor, encryptor, checksum) -> List[Callable[[Iterator[bytes]], Iterator[bytes]]]:
+    """
+    Returns the pipeline stages of a backup in order. Encrypted data doesn't compress, so the compression comes first,
+    and the checksum covers the bytes that are stored.
+    :param compressor: BlockCompressor or None.
+    :param encryptor: ChunkEncryptor or None.
+    :param checksum: ChecksumStage.
+    """
+    transforms = [compressor.compress] if compressor else []
+    if encryptor:
+        transforms.append(encryptor.encrypt)
+    return transforms + [checksum.update]
+
+
+def encrypt_backup_file(job: BackupJob, dump_path: str) -> str:
+    """
+    Encrypts a backup that the dump tool wrote itself, for database types that can't be dumped to a stream.
+    Unlike the encryption stage of the pipeline this reads and writes the backup a second time.
+    :param job: Backup job.
+    :param dump_path: Path of the plaintext backup, it is removed.
+    :return: Path to the encrypted backup, it doesn't exist if the encryption failed.
+    """
+    encryptor = create_encryptor(job.backup)
+    checksum = create_checksum_stage(job.backup)
+    encrypted_path = dump_path + ENCRYPTED_SUFFIX
+    chunk_size = job.backup.get("stream_chunk_size_kb", 1024) * 1024
+    try:
+        with open(dump_path, "rb") as f:
+            result = run_source_pipeline(iter(lambda: f.read(chunk_size), b""), [LocalFileSink(encrypted_path)],
+                                         chunk_size=chunk_size, transforms=[encryptor.encrypt, checksum.update])
+    finally:
+        remove_backup_file(dump_path)
+    for name, error in result.sink_errors.items():
+        print(f"Error writing backup to {name}: {error}")
+    if result.succeeded:
+        write_manifest(encrypted_path, checksum.manifest(os.path.basename(encrypted_path)))
+        print_encryption_summary(job, encryptor)
+    return encrypted_path
+
+
+def create_parallel_db_dump(job: BackupJob):
+    """
+    Creates a backup of a PostgreSQL or MySQL database with parallel workers, archived into one tar file.
+    :param job: Backup job.
+    :return: Path to the archive.
+    """
+    compressor = create_compressor(job.backup)
+    encryptor = create_encryptor(job.backup)
+    checksum = create_checksum_stage(job.backup)
+    dump_path = os.path.join(job.backup['backup_path'],
+                             get_backup_file_name(job, compressor.algorithm if compressor else "none", "tar",
+                                                  encryptor is not None))
+    delete_old_backups(job)
+
+    transforms = create_transforms(compressor, encryptor, checksum)
+    tracker = progress.tracker(job.name, STAGE_DUMP)
+    result = run_parallel_dump(job, os.path.basename(dump_path), [LocalFileSink(dump_path)], transforms, tracker)
+    tracker.finish()
+    if result is None:
+        return dump_path
+    if result.succeeded:
+        write_manifest(dump_path, checksum.manifest(os.path.basename(dump_path)))
+        print(f"Successfully created backup with {get_parallel_jobs(job)} parallel jobs: {dump_path}")
+        if compressor:
+            print_compression_summary(job, compressor)
+        if encryptor:
+            print_encryption_summary(job, encryptor)
+    for name, error in result.sink_errors.items():
+        print(f"Error writing backup to {name}: {error}")
+    return dump_path
+
+
+def create_compressed_db_dump(job: BackupJob):
+    """
+    Creates a compressed or encrypted backup by streaming the dump output through the compression and encryption
+    stages into the backup path.
+    :param job: Backup job.
+    :return: Path to the backup file or None if the database type can't be dumped to a stream.
+    """
+    try:
+        _dump_command, _env = get_stream_command(job)
+    except ValueError:
+        print(f"Compression and encryption on the fly are not supported for database type: {job.db['type']}")
+        return None
+
+    compressor = create_compressor(job.backup)
+    encryptor = create_encryptor(job.backup)
+    checksum = create_checksum_stage(job.backup)
+    dump_path = os.path.join(job.backup['backup_path'],
+                             get_backup_file_name(job, compressor.algorithm if compressor else "none",
+                                                  encrypted=encryptor is not None))
+    delete_old_backups(job)
+
+    tracker = progress.tracker(job.name, STAGE_DUMP, expected_dump_size(job))
+    result = run_stream_pipeline(
+        _dump_command, _env, [LocalFileSink(dump_path)],
+        chunk_size=job.backup.get("stream_chunk_size_kb", 1024) * 1024,
+        buffer_size=job.backup.get("stream_buffer_mb", 64) * 1024 * 1024,
+        transforms=create_transforms(compressor, encryptor, checksum),
+        progress=tracker.update
+    )
+    tracker.finish()
+    if result.succeeded:
+        write_manifest(dump_path, checksum.manifest(os.path.basename(dump_path)))
+        print(f"Successfully created backup: {dump_path}")
+        if compressor:
+            print_compression_summary(job, compressor)
+        if encryptor:
+            print_encryption_summary(job, encryptor)
+    else:
+        print(f"Error while creating backup: dump process exited with code {result.returncode}")
+        for name, error in result.sink_errors.items():
+            print(f"Error writing backup to {name}: {error}")
+    return dump_path
+
+
+def create_db_dump(job: BackupJob):
     """
     This function creates a backup of the database.
+    :param job: Backup job.
     :return:
     """
-    dump_path = os.path.join(
-        BACKUP_CONFIG['backup_path'],
-        f"{DB_CONFIG['dbname']}_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.sql"
-    )
-    delete_old_backups()
+    if get_parallel_jobs(job) > 1:
+        return create_parallel_db_dump(job)
 
-    _dump_command, _env = get_dump_command(dump_path)
+    if job.backup.get("compression", "none").casefold() != "none" or use_encryption(job):
+        dump_path = create_compressed_db_dump(job)
+        if dump_path:
+            return dump_path
+
+    dump_path = os.path.join(job.backup['backup_path'], get_backup_file_name(job))
+    delete_old_backups(job)
+
+    if use_native_sqlite(job):
+        try:
+            create_sqlite_dump(job, dump_path)
+            write_manifest(dump_path, hash_file(dump_path, job.backup.get("fast_hash", "none")).manifest(
+                os.path.basename(dump_path)))
+            print(f"Successfully created backup: {dump_path}")
+        except sqlite3.Error as e:
+            print(f"Error while creating backup: {e}")
+        return dump_path
+
+    _dump_command, _env = get_dump_command(job, dump_path)
+    tracker = progress.tracker(job.name, STAGE_DUMP, expected_dump_size(job))
+
+    def _report_size():
+        if os.path.exists(dump_path):
+            tracker.update(os.path.getsize(dump_path))
 
     try:
-        subprocess.run(_dump_command, env=_env, check=True)
+        try:
+            returncode = wait_for_process(subprocess.Popen(_dump_command, env=_env), poll=_report_size)
+        except BackupCancelled:
+            remove_backup_file(dump_path)
+            raise
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, _dump_command)
+        _report_size()
+        tracker.finish()
+        if use_encryption(job):
+            dump_path = encrypt_backup_file(job, dump_path)
+        else:
+            # The dump tool writes the file itself, so it is hashed once here instead of on its way to the file
+            write_manifest(dump_path, hash_file(dump_path, job.backup.get("fast_hash", "none")).manifest(
+                os.path.basename(dump_path)))
         print(f"Successfully created backup: {dump_path}")
     except subprocess.CalledProcessError as e:
         print(f"Error while creating backup: {e}")
@@ -109,147 +532,906 @@ def create_db_dump():
     return dump_path
 
 
-def delete_old_backups():
+def use_native_sqlite(job: BackupJob) -> bool:
     """
-    Deletes old backup files if the number of files exceeds the limit specified in the configuration.
+    Returns True if the SQLite database is copied with the built-in online backup engine instead of the sqlite3 tool.
+    """
+    return job.db["type"].casefold() == "sqlite" and job.db.get("sqlite_engine", ENGINE_NATIVE) == ENGINE_NATIVE
+
+
+def create_sqlite_dump(job: BackupJob, dump_path: str):
+    """
+    Copies the SQLite database with the online backup API, pages_per_step pages at a time so writers aren't starved.
+    :param job: Backup job.
+    :param dump_path: Path of the backup file.
+    :raises BackupCancelled: If the backups were cancelled, the partial copy is removed.
+    :raises sqlite3.Error: If the database can't be copied.
+    """
+    tracker = progress.tracker(job.name, STAGE_DUMP, expected_dump_size(job))
+
+    def _report(remaining: int, total: int, page_size: int):
+        tracker.update((total - remaining) * page_size, total * page_size)
+
+    try:
+        result = backup_database(job.db["dbname"], dump_path,
+                                 pages_per_step=job.db.get("sqlite_pages_per_step", DEFAULT_PAGES_PER_STEP),
+                                 step_sleep=job.db.get("sqlite_step_sleep_ms", DEFAULT_STEP_SLEEP_MS) / 1000,
+                                 progress=_report)
+    except BaseException:
+        remove_backup_file(dump_path)
+        raise
+    tracker.finish()
+    restarts = f", restarted {result.restarts} times by writers" if result.restarts else ""
+    print(f"Copied {result.pages} pages of {result.page_size} bytes in {result.steps} steps{restarts} "
+          f"({result.duration:.1f}s)")
+
+
+def get_sqlite_signature(job: BackupJob) -> Optional[tuple]:
+    """
+    Returns the change state of a SQLite database if unchanged runs are skipped for the job, otherwise None.
+    """
+    if job.db["type"].casefold() != "sqlite" or not job.db.get("sqlite_skip_unchanged", False):
+        return None
+    return change_tracker.signature(job.db["dbname"])
+
+
+def _import_backup_files(job: BackupJob, catalog: BackupCatalog):
+    """
+    Adds the backup files that were created before the catalog existed, so the retention covers them too.
+    """
+    for f in os.listdir(job.backup["backup_path"]):
+        if f.startswith(job.backup_prefix) and f.endswith(BACKUP_SUFFIXES):
+            path = os.path.join(job.backup["backup_path"], f)
+            catalog.record(job.name, f, STORAGE_FILE, path=path, size=os.path.getsize(path),
+                           created=os.path.getctime(path))
+
+
+def delete_old_backups(job: BackupJob):
+    """
+    Deletes the backup files that the retention policy doesn't keep: the newest max_backup_files and,
+    if configured, the newest backup of each of the last retention_hourly/daily/weekly/monthly periods.
+    The backups are looked up in the catalog, the backup folder is only scanned once to import existing files.
+    :param job: Backup job.
     :return:
     """
-    backup_files = sorted(
-        [f for f in os.listdir(BACKUP_CONFIG["backup_path"]) if f.endswith(".sql")],
-        key=lambda f: os.path.getctime(os.path.join(BACKUP_CONFIG["backup_path"], f))
-    )
-    # Delete the oldest files if the number of files exceeds the limit (max_backup_files)
-    backup_files_to_delete = backup_files[:-BACKUP_CONFIG["max_backup_files"]]
-    for file in backup_files_to_delete:
-        os.remove(os.path.join(BACKUP_CONFIG["backup_path"], file))
-        print(f"Deleted old backup: {file}")
+    with metrics.timer("retention_duration_seconds", job=job.name):
+        catalog = open_catalog(job.backup)
+        # Backups of any storage mean the catalog was in use before, so the folder doesn't have to be scanned
+        if not catalog.has_backups(job.name):
+            _import_backup_files(job, catalog)
+
+        expired = catalog.expired(job.name, STORAGE_FILE, RetentionPolicy.from_config(job.backup))
+        for entry in expired:
+            if entry.path and os.path.exists(entry.path):
+                os.remove(entry.path)
+                print(f"Deleted old backup: {entry.name}")
+            if entry.path and os.path.exists(f"{entry.path}{MANIFEST_SUFFIX}"):
+                os.remove(f"{entry.path}{MANIFEST_SUFFIX}")
+        catalog.remove(expired)
+
+
+def record_backup(job: BackupJob, name: str, storage: str, path: str = None, size: int = None,
+                  checksum: str = None, destinations: dict = None, status: str = STATUS_COMPLETE):
+    """
+    Adds a backup to the catalog.
+    :param job: Backup job.
+    :param name: Name of the backup.
+    :param storage: Where the backup is kept locally, STORAGE_FILE, STORAGE_REPOSITORY or STORAGE_REMOTE.
+    :param path: Path of the backup file.
+    :param size: Size in bytes, defaults to the size of the file.
+    :param checksum: SHA-256 of the backup.
+    :param destinations: Status of the backup per destination.
+    :param status: Status of the backup.
+    """
+    if size is None:
+        size = os.path.getsize(path) if path and os.path.exists(path) else 0
+    try:
+        open_catalog(job.backup).record(job.name, name, storage, path=path, size=size, checksum=checksum,
+                                        destinations=destinations, status=status)
+    except Exception as e:
+        print(f"Error adding {name} to the backup catalog: {e}")
 
 
-def send_backup_to_api(dump_path):
+def use_repository(job: BackupJob) -> bool:
+    """
+    Returns True if local backups are kept in the deduplicating repository instead of as files.
+    """
+    return job.backup.get("storage_mode", "files").casefold() == "repository"
+
+
+def store_backup_in_repository(job: BackupJob, dump_path: str, checksum: str = None, destinations: dict = None):
+    """
+    Stores a backup file in the deduplicating repository and applies the retention to the repository.
+    :param job: Backup job.
+    :param dump_path: Path to the local backup file.
+    :param checksum: SHA-256 of the backup, recorded in the catalog.
+    :param destinations: Status of the backup per destination, recorded in the catalog.
+    """
+    repository = open_repository(job.backup)
+    result = repository.store_file(os.path.basename(dump_path), dump_path)
+    print(f"Stored {result.name} in the repository: {result.size} bytes, "
+          f"{result.new_bytes} new bytes in {result.new_chunks} of {result.chunks} chunks")
+    record_backup(job, result.name, STORAGE_REPOSITORY, size=result.size, checksum=checksum,
+                  destinations=destinations)
+    prune_repository(job, repository)
+
+
+def prune_repository(job: BackupJob, repository: BackupRepository):
+    """
+    Deletes the backups of the database from the repository that the retention policy doesn't keep,
+    chunks that are no longer referenced are garbage collected.
+    :param job: Backup job.
+    :param repository: Backup repository.
+    """
+    with metrics.timer("retention_duration_seconds", job=job.name):
+        catalog = open_catalog(job.backup)
+        if not catalog.has_backups(job.name, STORAGE_REPOSITORY):
+            for name in repository.list_backups(job.backup_prefix):
+                manifest = repository.load_manifest(name)
+                catalog.record(job.name, name, STORAGE_REPOSITORY, size=manifest["size"],
+                               created=manifest["created"])
+
+        expired = catalog.expired(job.name, STORAGE_REPOSITORY, RetentionPolicy.from_config(job.backup))
+        for entry in expired:
+            try:
+                repository.delete_backup(entry.name)
+                print(f"Deleted old backup from the repository: {entry.name}")
+            except FileNotFoundError:
+                pass
+        catalog.remove(expired)
+        if expired or repository.gc_pending:
+            if repository.collect_garbage() is None:
+                print("Skipped the repository garbage collection while other backups are stored, "
+                      "it runs after the next backup.")
+
+
+def send_backup_to_api(job: BackupJob, dump_path) -> bool:
     """
     Sends a backup file to an API endpoint using a POST request.
+    The file is streamed in chunks, with "upload_mode": "chunked" as a resumable upload.
+    :param job: Backup job.
     :param dump_path: Path to the backup file.
-    :return:
+    :return: True if the API accepted the backup.
     """
-    with open(dump_path, 'rb') as f:
-        try:
-            headers = {}
-            if API_CONFIG.get('api_key'):
-                headers['Authorization'] = f"Bearer {API_CONFIG['api_key']}"
-
-            response = requests.post(
-                API_CONFIG['url'],
-                headers=headers,
-                files={'file': f}
-            )
+    try:
+        tracker = progress.tracker(job.name, STAGE_UPLOAD, os.path.getsize(dump_path), destination="api")
+        upload_file(job.api, dump_path, progress=tracker.update)
+        tracker.finish()
+        manifest = read_manifest(dump_path)
+        if manifest:
+            send_manifest_to_api(job, manifest)
+        print("Backup successfully sent to the API.")
+        return True
+    except IOError as e:
+        print(f"Error while sending the backup to the API: {e}")
+    except Exception as e:
+        print(f"API-Connection error: {e}")
+    return False
+
+
+def send_manifest_to_api(job: BackupJob, manifest: dict):
+    """
+    Sends the manifest with the checksums of a backup to the API, next to the backup.
+    :param job: Backup job.
+    :param manifest: Manifest of the backup.
+    """
+    upload_data(job.api, f"{manifest['file']}{MANIFEST_SUFFIX}", json.dumps(manifest, indent=4).encode())
+
+
+def _ensure_server_folder(job: BackupJob, sftp: paramiko.SFTPClient):
+    """
+    Creates the configured backup folder on the SSH server if it doesn't exist yet.
+    :param job: Backup job.
+    :param sftp: SFTP session of the SSH server.
+    """
+    dir_path = job.ssh["server_folder_path"]
+    try:
+        sftp.stat(dir_path)
+    except FileNotFoundError:
+        sftp.mkdir(dir_path)
+
+
+def get_remote_backup_path(job: BackupJob, file_name: str) -> str:
+    """
+    Returns the path of a backup file inside the configured server folder.
+    :param job: Backup job.
+    :param file_name: Name of the backup file.
+    :return: Remote path of the backup file.
+    """
+    remote_path = job.ssh["server_folder_path"]
+    # Add / if the remote path does not end with /
+    if not remote_path.endswith("/"):
+        remote_path += "/"
+    return remote_path + file_name
+
+
+def use_delta_transfer(job: BackupJob) -> bool:
+    """
+    Returns True if backups are sent to the SSH server as deltas against the last full backup.
+    """
+    return job.ssh.get("transfer_mode", "full").casefold() == "delta"
+
+
+def _create_delta_uploader(job: BackupJob, sftp: paramiko.SFTPClient) -> DeltaUploader:
+    return DeltaUploader(
+        sftp,
+        job.ssh["server_folder_path"],
+        job.backup_prefix,
+        SignatureCache(os.path.join(job.backup["backup_path"], ".signatures"), job.backup_prefix),
+        chunker=create_chunker(job.backup),
+        full_every=job.ssh.get("delta_full_every", 24),
+        max_literal_ratio=job.ssh.get("delta_max_literal_ratio", 0.5)
+    )
 
-            if response.status_code == 200:
-                print("Backup successfully sent to the API.")
-            else:
-                print(f"Error while sending the backup to the API: {response.status_code} - {response.text}")
 
+def _print_delta_result(result: DeltaResult):
+    if result.full:
+        print(f"Full backup with signature saved on the server at: {result.remote_path}")
+    else:
+        print(f"Delta saved on the server at: {result.remote_path} "
+              f"({result.sent_bytes} of {result.size} bytes sent, {result.literal_bytes} literal bytes)")
+
+
+def save_manifest_to_server(job: BackupJob, sftp: paramiko.SFTPClient, manifest: dict):
+    """
+    Writes the manifest with the checksums of a backup next to the backup on the SSH server.
+    :param job: Backup job.
+    :param sftp: SFTP session of the SSH server.
+    :param manifest: Manifest of the backup.
+    """
+    with sftp.open(get_remote_backup_path(job, f"{manifest['file']}{MANIFEST_SUFFIX}"), "w") as f:
+        f.write(json.dumps(manifest, indent=4))
+
+
+def verify_server_backup(sftp: paramiko.SFTPClient, remote_path: str, size: int, sha256: Optional[str]) -> str:
+    """
+    Checks an uploaded file on the SSH server. The size is read from the file attributes and the SHA-256 is computed
+    by sha256sum on the server, so the file doesn't travel back over the network.
+    :param sftp: SFTP session of the SSH server.
+    :param remote_path: Path of the uploaded file.
+    :param size: Size of the local file.
+    :param sha256: SHA-256 of the local file, None only checks the size.
+    :return: 'checksum verified', or 'size verified' if the server doesn't allow running sha256sum.
+    :raises IOError: If the file on the server has a different size or checksum.
+    """
+    remote_size = sftp.stat(remote_path).st_size
+    if remote_size != size:
+        raise IOError(f"{remote_path} has {remote_size} bytes on the server instead of {size} bytes.")
+    if sha256:
+        remote_checksum = remote_sha256(sftp, remote_path, size)
+        if remote_checksum is not None:
+            if remote_checksum != sha256:
+                raise IOError(f"The SHA-256 of {remote_path} on the server doesn't match the local backup.")
+            return "checksum verified"
+    return "size verified"
+
+
+def use_remote_retention(job: BackupJob) -> bool:
+    """
+    Returns True if the retention policy is applied to the backups on the SSH server too.
+    """
+    return job.ssh.get("remote_retention", RETENTION_NONE).casefold() != RETENTION_NONE
+
+
+def delete_old_server_backups(job: BackupJob, file_name: str, sftp: paramiko.SFTPClient = None):
+    """
+    Deletes the backups of the database on the SSH server that the retention policy doesn't keep, with one directory
+    listing and pipelined remove requests over a pooled SFTP session. The counts of the local policy apply unless
+    ssh_config.json sets max_backup_files or retention_* itself. With "remote_retention": "catalog" the age and status
+    of a backup come from the catalog, backups it doesn't know and "mtime" use the modification time on the server.
+    Errors are only printed, the upload itself succeeded.
+    :param job: Backup job.
+    :param file_name: Name of the backup that was just uploaded, it is always kept.
+    :param sftp: SFTP session of the upload, a session is borrowed from the pool if it isn't given.
+    """
+    with metrics.timer("retention_duration_seconds", job=job.name, destination="ssh"):
+        try:
+            catalog = open_catalog(job.backup)
+            entries = catalog.list_backups(job.name)
+            created, failed = {}, set()
+            if job.ssh.get("remote_retention", RETENTION_NONE).casefold() == RETENTION_CATALOG:
+                for entry in entries:
+                    created[entry.name] = min(created.get(entry.name, entry.created), entry.created)
+                complete = {entry.name for entry in entries if entry.status != STATUS_FAILED}
+                failed = {entry.name for entry in entries if entry.name not in complete}
+            with nullcontext(sftp) if sftp else ssh_pool.sftp(job.ssh) as session:
+                result = apply_remote_retention(
+                    session, job.ssh["server_folder_path"], job.backup_prefix, BACKUP_SUFFIXES,
+                    RetentionPolicy.from_config({**job.backup, **job.ssh}), created=created, failed=failed,
+                    protected=[file_name]
+                )
         except Exception as e:
-            print(f"API-Connection error: {e}")
+            print(f"Error applying the retention on the server: {e}")
+            return
+    for name in result.deleted:
+        print(f"Deleted old backup from the server: {name}")
+    for name, error in result.errors.items():
+        print(f"Error deleting {name} from the server: {error}")
+    if result.deleted:
+        print(f"Server retention: {len(result.deleted)} of {result.backups} backups deleted, listed in "
+              f"{result.list_duration * 1000:.0f} ms, deleted in {result.delete_duration * 1000:.0f} ms")
+    # Backups that only existed on the server are gone from the catalog with them
+    deleted = set(result.deleted)
+    catalog.remove(entry for entry in entries if entry.storage == STORAGE_REMOTE and entry.name in deleted)
 
 
-def save_backup_to_server(dump_path: str):
+def save_backup_to_server(job: BackupJob, dump_path: str) -> bool:
     """
     Uploads a backup file to a remote server via SCP using SSH.
+    The SSH connection is borrowed from the shared connection pool. The uploaded file is hashed on the server and
+    compared with the local backup, see verify_server_backup.
+    :param job: Backup job.
     :param dump_path: Path to the local backup file.
-    :raises Exception: If the connection fails or the file upload encounters an issue.
+    :return: True if the backup was uploaded.
     """
-    # Initialize SSH client
-    global sftp
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    manifest = read_manifest(dump_path)
+    file_name = os.path.basename(dump_path)
+    try:
+        tracker = progress.tracker(job.name, STAGE_UPLOAD, os.path.getsize(dump_path), destination="ssh")
+        with ssh_pool.sftp(job.ssh) as sftp:
+            _ensure_server_folder(job, sftp)
+            if use_delta_transfer(job):
+                with open(dump_path, "rb") as f:
+                    result = _create_delta_uploader(job, sftp).upload(
+                        file_name, tracker.wrap(iter(lambda: f.read(1024 * 1024), b""))
+                    )
+                tracker.finish()
+                _print_delta_result(result)
+                # A delta is checked against the delta file that was sent, the backup is only rebuilt on restore
+                remote_path = result.remote_path
+                verified = verify_server_backup(sftp, remote_path, result.file_size, result.file_sha256)
+            else:
+                # Get the filename from the dump path and add it to the remote path
+                remote_path = get_remote_backup_path(job, file_name)
+                print(remote_path)
+                if job.ssh.get("upload_streams", 1) > 1:
+                    result = create_parallel_uploader(ssh_pool, job.ssh).upload(
+                        dump_path, remote_path, manifest.get("sha256") if manifest else None,
+                        progress=tracker.update)
+                    # The parallel uploader checks the assembled file before it is renamed
+                    verified = "checksum verified" if result.checksum_verified else "size verified"
+                    print(f"Uploaded {result.size} bytes in {result.streams} streams at "
+                          f"{result.throughput:.1f} MB/s")
+                else:
+                    sftp.put(dump_path, remote_path, callback=tracker.update)
+                    verified = verify_server_backup(sftp, remote_path, os.path.getsize(dump_path),
+                                                    manifest.get("sha256") if manifest else None)
+                tracker.finish()
+            if manifest:
+                save_manifest_to_server(job, sftp, manifest)
+            print(f"Backup successfully saved on the server at: {remote_path} ({verified})")
+            if use_remote_retention(job):
+                delete_old_server_backups(job, file_name, sftp)
+        return True
 
-    remote_path = SSH_CONFIG["server_folder_path"]
+    except Exception as e:
+        print(f"Error uploading backup: {e}")
+        return False
 
-    try:
-        ssh.connect(
-            hostname=SSH_CONFIG["host"],
-            port=SSH_CONFIG.get("port", 22),
-            username=SSH_CONFIG["username"],
-            # Use private key for authentication
-            key_filename=SSH_CONFIG["private_key_path"]
-        )
-        sftp = ssh.open_sftp()
-        dir_path = SSH_CONFIG["server_folder_path"]
+
+class SftpStreamSink(StreamSink):
+    """
+    Writes the dump stream directly into a file on the SSH server.
+    """
+    name = "ssh"
+
+    def __init__(self, job: BackupJob, file_name: str):
+        self.job = job
+        self.file_name = file_name
+        self.remote_path = get_remote_backup_path(job, file_name)
+        self.part_path = f"{self.remote_path}.part"
+        self.delta_result: Optional[DeltaResult] = None
+
+    def consume(self, chunks: Iterator[bytes]):
+        with ssh_pool.sftp(self.job.ssh) as sftp:
+            _ensure_server_folder(self.job, sftp)
+            if use_delta_transfer(self.job):
+                self.delta_result = _create_delta_uploader(self.job, sftp).upload(self.file_name, chunks)
+                _print_delta_result(self.delta_result)
+                return
+            with sftp.open(self.part_path, "wb") as remote_file:
+                # Don't wait for an acknowledgement of every write request
+                remote_file.set_pipelined(True)
+                for chunk in chunks:
+                    remote_file.write(chunk)
+            sftp.posix_rename(self.part_path, self.remote_path)
+        print(f"Backup successfully streamed to the server at: {self.remote_path}")
+
+    def discard(self):
+        with ssh_pool.sftp(self.job.ssh) as sftp:
+            for part_path in (self.part_path, f"{self.remote_path}{DELTA_SUFFIX}.part"):
+                try:
+                    sftp.remove(part_path)
+                except IOError:
+                    # Nothing to clean up if the partial file was never created
+                    pass
+
+    def verify(self, size: int, sha256: str) -> str:
+        """
+        Checks the streamed file on the server once the pipeline is done, see verify_server_backup.
+        :param size: Number of bytes streamed.
+        :param sha256: SHA-256 of the streamed bytes.
+        """
+        with ssh_pool.sftp(self.job.ssh) as sftp:
+            if self.delta_result:
+                return verify_server_backup(sftp, self.delta_result.remote_path, self.delta_result.file_size,
+                                            self.delta_result.file_sha256)
+            return verify_server_backup(sftp, self.remote_path, size, sha256)
+
+
+def use_verification(job: BackupJob) -> bool:
+    """
+    Returns True if every backup is verified after it was created.
+    """
+    return job.backup.get("verification_mode", MODE_NONE).casefold() != MODE_NONE
+
+
+def remove_backup_file(dump_path: str):
+    """
+    Removes a local backup file together with its manifest and upload state.
+    """
+    for path in (dump_path, f"{dump_path}.upload", f"{dump_path}{MANIFEST_SUFFIX}"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def submit_verification(job: BackupJob, name: str, storage: str, path: str = None, manifest: dict = None,
+                        remove_after: bool = False):
+    """
+    Queues the verification of a backup in the verification pool, so the next dump doesn't wait for it.
+    The result is recorded in the catalog.
+    :param job: Backup job.
+    :param name: Name of the backup.
+    :param storage: Storage of the backup, backups in the repository are restored into a temporary file first.
+    :param path: Path of the backup file.
+    :param manifest: Manifest of the backup.
+    :param remove_after: Remove the backup file after the verification, for backups that aren't kept locally.
+    """
+    mode = job.backup.get("verification_mode", MODE_NONE).casefold()
+
+    def _verify():
+        work_dir = None
         try:
-            sftp.stat(dir_path)
-        except FileNotFoundError:
-            sftp.mkdir(dir_path)
-
-        # Add / if the remote path does not end with /
-        if not remote_path.endswith("/"):
-            remote_path += "/"
-        # Get the filename from the dump path and add it to the remote path
-        remote_path += os.path.basename(dump_path)
-        print(remote_path)
-        sftp.put(dump_path, remote_path)
-        print(f"Backup successfully saved on the server at: {remote_path}")
+            backup_path = path
+            if storage == STORAGE_REPOSITORY:
+                work_dir = tempfile.mkdtemp(prefix="verify_", dir=job.backup["backup_path"])
+                backup_path = os.path.join(work_dir, name)
+                with open(backup_path, "wb") as f:
+                    open_repository(job.backup).restore(name, f)
+            catalog = open_catalog(job.backup)
+            if not os.path.exists(backup_path):
+                # Removed by the retention before a worker got to it
+                catalog.set_verification(job.name, storage, name, STATUS_SKIPPED, {})
+                return
+            result = verify_backup(
+                job, backup_path, mode, manifest=manifest,
+                previous=catalog.last_verified(job.name, STATUS_PASSED),
+                max_shrink_ratio=job.backup.get("verification_max_shrink_ratio", 0.5)
+            )
+            catalog.set_verification(job.name, storage, name, result.status, result.details())
+            metrics.observe("verification_duration_seconds", result.duration, job=job.name)
+            metrics.inc("verifications_total", job=job.name, result=result.status)
+            checks = ", ".join(f"{check}: {message}" for check, message in result.checks.items())
+            print(f"Verification of {name} {result.status} after {result.duration:.1f}s ({checks})")
+        finally:
+            if work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            if remove_after:
+                remove_backup_file(path)
+
+    def _skip():
+        open_catalog(job.backup).set_verification(job.name, storage, name, STATUS_SKIPPED, {})
+        metrics.inc("verifications_total", job=job.name, result=STATUS_SKIPPED)
+        if remove_after:
+            remove_backup_file(path)
+
+    verification_pool.submit(name, _verify, _skip)
 
+
+def save_manifest(job: BackupJob, manifest: dict, local_path: Optional[str], destinations: dict):
+    """
+    Saves the manifest of a streamed backup next to the backup in every destination that received it.
+    :param job: Backup job.
+    :param manifest: Manifest of the backup.
+    :param local_path: Path of the local backup file, None if the backup wasn't stored as a file.
+    :param destinations: Status of the backup per destination.
+    """
+    if local_path:
+        write_manifest(local_path, manifest)
+    try:
+        if destinations.get(ApiStreamSink.name) == STATUS_SUCCESS:
+            send_manifest_to_api(job, manifest)
+        if destinations.get(SftpStreamSink.name) == STATUS_SUCCESS:
+            with ssh_pool.sftp(job.ssh) as sftp:
+                save_manifest_to_server(job, sftp, manifest)
     except Exception as e:
-        print(f"Error uploading backup: {e}")
+        print(f"Error saving the manifest of {manifest['file']}: {e}")
+
+
+def record_dump_metrics(job: BackupJob, duration: float, size: int):
+    metrics.observe("dump_duration_seconds", duration, job=job.name)
+    if size:
+        # A failed dump keeps the size of the last backup
+        metrics.set("dump_bytes", size, job=job.name)
+        metrics.inc("dump_bytes_total", size, job=job.name)
+
+
+def record_upload_metrics(job: BackupJob, destination: str, status: str, duration: float, size: int):
+    metrics.observe("upload_duration_seconds", duration, job=job.name, destination=destination)
+    metrics.inc("uploads_total", job=job.name, destination=destination, status=status)
+    if status == STATUS_SUCCESS and duration:
+        metrics.set("upload_throughput_bytes_per_second", size / duration, job=job.name, destination=destination)
+
+
+def streaming_backup(job: BackupJob) -> Optional[bool]:
+    """
+    Streams the dump output directly to all enabled destinations without staging the full file on disk.
+    :param job: Backup job.
+    :return: None if the database type can't be streamed, otherwise whether the backup succeeded.
+    """
+    parallel = get_parallel_jobs(job) > 1
+    if not parallel:
+        try:
+            _dump_command, _env = get_stream_command(job)
+        except ValueError as e:
+            print(e)
+            return None
+
+    compressor = create_compressor(job.backup)
+    encryptor = create_encryptor(job.backup)
+    checksum = create_checksum_stage(job.backup)
+    # Hash the bytes as they reach the destinations, i.e. after the compression and encryption
+    transforms = create_transforms(compressor, encryptor, checksum)
+    file_name = get_backup_file_name(job, compressor.algorithm if compressor else "none",
+                                     "tar" if parallel else "sql", encryptor is not None)
+    sinks = []
+    repository = None
+    storage, local_path = STORAGE_REMOTE, None
+    if job.use_local_backup and use_repository(job):
+        repository = open_repository(job.backup)
+        sinks.append(RepositorySink(repository, file_name))
+        storage = STORAGE_REPOSITORY
+    elif job.use_local_backup:
+        delete_old_backups(job)
+        local_path = os.path.join(job.backup['backup_path'], file_name)
+        sinks.append(LocalFileSink(local_path))
+        storage = STORAGE_FILE
+    if job.send_to_api:
+        sinks.append(ApiStreamSink(job.api, file_name))
+    if job.send_to_server:
+        sinks.append(SftpStreamSink(job, file_name))
+
+    tracker = progress.tracker(job.name, STAGE_DUMP, None if parallel else expected_dump_size(job))
+    if parallel:
+        # Parallel dumps are written to a directory, only the finished directory is streamed
+        result = run_parallel_dump(job, file_name, sinks, transforms, tracker)
+        if result is None:
+            record_backup(job, file_name, storage, size=0, status=STATUS_FAILED)
+            return False
+    else:
+        result = run_stream_pipeline(
+            _dump_command, _env, sinks,
+            chunk_size=job.backup.get("stream_chunk_size_kb", 1024) * 1024,
+            buffer_size=job.backup.get("stream_buffer_mb", 64) * 1024 * 1024,
+            transforms=transforms,
+            progress=tracker.update
+        )
+    tracker.finish()
+    if result.returncode != 0:
+        print(f"Error while creating backup: dump process exited with code {result.returncode}")
+    for name, error in result.sink_errors.items():
+        print(f"Error streaming backup to {name}: {error}")
+    if result.succeeded:
+        print(f"Successfully streamed backup {file_name} ({result.bytes_written} bytes in {result.duration:.1f}s)")
+        if compressor:
+            print_compression_summary(job, compressor)
+        if encryptor:
+            print_encryption_summary(job, encryptor)
+    local_sinks = {sink.name for sink in sinks if isinstance(sink, (LocalFileSink, RepositorySink))}
+    destinations = {sink.name: STATUS_FAILED if sink.name in result.sink_errors else STATUS_SUCCESS
+                    for sink in sinks if sink.name not in local_sinks}
+    succeeded = result.returncode == 0 and not local_sinks & result.sink_errors.keys()
+    for sink in sinks:
+        if isinstance(sink, SftpStreamSink) and destinations[sink.name] == STATUS_SUCCESS and result.returncode == 0:
+            try:
+                verified = sink.verify(result.bytes_written, checksum.sha256)
+                print(f"Backup streamed to the server: {verified}")
+            except Exception as e:
+                print(f"Error verifying the backup on the server: {e}")
+                destinations[sink.name] = STATUS_FAILED
+    # The dump and the uploads run in one pipeline, so they share its duration
+    record_dump_metrics(job, result.duration, result.bytes_written if succeeded else 0)
+    for destination, status in destinations.items():
+        record_upload_metrics(job, destination, status, result.duration, result.bytes_written)
+    if result.returncode == 0:
+        save_manifest(job, checksum.manifest(file_name), local_path if succeeded else None, destinations)
+    record_backup(job, file_name, storage, path=local_path, size=result.bytes_written if succeeded else 0,
+                  checksum=checksum.sha256 if succeeded else None, destinations=destinations,
+                  status=STATUS_COMPLETE if succeeded else STATUS_FAILED)
+    if destinations.get(SftpStreamSink.name) == STATUS_SUCCESS and use_remote_retention(job):
+        delete_old_server_backups(job, file_name)
+    if succeeded and storage != STORAGE_REMOTE and use_verification(job):
+        submit_verification(job, file_name, storage, local_path, checksum.manifest(file_name))
+    if repository and result.returncode == 0:
+        prune_repository(job, repository)
+    return succeeded and all(status == STATUS_SUCCESS for status in destinations.values())
+
+
+def scheduled_backup(job: BackupJob):
+    """
+    Runs one backup of the job: dump, upload to all enabled destinations and apply the local retention.
+    The duration and result of the run are recorded in the metrics.
+    :param job: Backup job.
+    """
+    start = time.monotonic()
+    succeeded = False
+    try:
+        succeeded = run_backup(job)
+    except BackupCancelled:
+        pass
     finally:
-        sftp.close()
-        ssh.close()
+        finish_run(job, start, succeeded, cancellation.cancelled)
+
+
+def finish_run(job: BackupJob, start: float, succeeded: bool, cancelled: bool = False):
+    """
+    Records the duration and result of a backup run in the metrics and ends its progress.
+    :param job: Backup job.
+    :param start: time.monotonic() when the run started.
+    :param succeeded: Whether the dump and all uploads succeeded.
+    :param cancelled: Whether the run was cancelled.
+    """
+    result = "success" if succeeded else "failure"
+    if cancelled:
+        result = "cancelled"
+        print(f"Backup of job {job.name} was cancelled.")
+    metrics.observe("backup_duration_seconds", time.monotonic() - start, job=job.name)
+    metrics.inc("runs_total", job=job.name, result=result)
+    if succeeded:
+        metrics.set("last_success_timestamp_seconds", time.time(), job=job.name)
+    progress.done(job.name)
+
+
+def run_backup(job: BackupJob) -> bool:
+    """
+    Dumps the database, uploads the backup and applies the local retention.
+    :param job: Backup job.
+    :return: True if the dump and all uploads succeeded, or the database didn't change since the last backup.
+    """
+    signature = get_sqlite_signature(job)
+    if change_tracker.unchanged(job.name, signature):
+        print(f"Skipping backup of {job.name}, the database didn't change since the last backup.")
+        return True
+    succeeded = _dump_and_upload(job)
+    if succeeded:
+        change_tracker.backed_up(job.name, signature)
+    return succeeded
+
+
+def _dump_and_upload(job: BackupJob) -> bool:
+    if job.backup.get("use_streaming", False):
+        succeeded = streaming_backup(job)
+        if succeeded is not None:
+            return succeeded
+        print("Falling back to a local dump file.")
+
+    dump_start = time.monotonic()
+    dump_path = create_db_dump(job)
+    return complete_backup(job, dump_path, time.monotonic() - dump_start)
+
 
+def complete_backup(job: BackupJob, dump_path: str, dump_duration: float) -> bool:
+    """
+    Uploads a finished dump file, records it in the catalog and applies the local retention.
+    :param job: Backup job.
+    :param dump_path: Path of the dump file, it doesn't exist if the dump failed.
+    :param dump_duration: Seconds the dump took.
+    :return: True if the dump and all uploads succeeded.
+    """
+    dump_size = os.path.getsize(dump_path) if os.path.exists(dump_path) else 0
+    record_dump_metrics(job, dump_duration, dump_size)
+    if cancellation.is_cancelled(job.name):
+        remove_backup_file(dump_path)
+        raise BackupCancelled("The backup was cancelled.")
+    destinations = {}
+    if job.send_to_api:
+        destinations["api"] = lambda: send_backup_to_api(job, dump_path)
+    if job.send_to_server:
+        destinations["ssh"] = lambda: save_backup_to_server(job, dump_path)
+
+    timeout = job.backup.get("destination_timeout_minutes", 0) * 60 or None
+    results = run_destinations(destinations, timeout=timeout)
+    for result in results:
+        error = f" ({result.error})" if result.error else ""
+        print(f"Destination {result.name}: {result.status} after {result.duration:.1f}s{error}")
+        record_upload_metrics(job, result.name, result.status, result.duration, dump_size)
 
-def scheduled_backup(send_to_api=False, send_to_server=False, use_local_backup=False):
-    dump_path = create_db_dump()
-    if send_to_api:
-        send_backup_to_api(dump_path)
-    if send_to_server:
-        save_backup_to_server(dump_path)
+    if job.send_to_server:
+        stats = ssh_pool.stats()
+        print(f"SSH connection pool: {stats['handshakes']} handshakes, reuse ratio {stats['reuse_ratio']:.0%}")
+
+    file_name = os.path.basename(dump_path)
+    destination_status = {result.name: result.status for result in results}
+    manifest = read_manifest(dump_path) or {}
+    if not os.path.exists(dump_path):
+        record_backup(job, file_name, STORAGE_FILE if job.use_local_backup else STORAGE_REMOTE,
+                      destinations=destination_status, status=STATUS_FAILED)
+        return False
+    verify = use_verification(job)
+    if job.use_local_backup and use_repository(job):
+        store_backup_in_repository(job, dump_path, manifest.get("sha256"), destination_status)
+        if verify:
+            submit_verification(job, file_name, STORAGE_REPOSITORY, manifest=manifest)
+    elif job.use_local_backup:
+        record_backup(job, file_name, STORAGE_FILE, path=dump_path, checksum=manifest.get("sha256"),
+                      destinations=destination_status)
+        if verify:
+            submit_verification(job, file_name, STORAGE_FILE, dump_path, manifest)
+    else:
+        record_backup(job, file_name, STORAGE_REMOTE, size=os.path.getsize(dump_path),
+                      checksum=manifest.get("sha256"), destinations=destination_status)
 
-    if not use_local_backup:
-        os.remove(dump_path)
+    if not job.use_local_backup or use_repository(job):
+        if any(result.status == STATUS_TIMEOUT for result in results):
+            # An upload is still reading the file, the next retention run removes it
+            print(f"Keeping {dump_path} because an upload is still running.")
+            record_backup(job, file_name, STORAGE_FILE, path=dump_path, status=STATUS_EXPIRED)
+        elif verify and not job.use_local_backup:
+            # The verification removes the dump once it is done with it
+            submit_verification(job, file_name, STORAGE_REMOTE, dump_path, manifest, remove_after=True)
+        else:
+            remove_backup_file(dump_path)
+    # Only successful dumps have a manifest
+    return bool(manifest) and all(result.status == STATUS_SUCCESS for result in results)
 
 
 def start_service():
     global service_running
     service_running = True
+    cancellation.reset()
 
 
-def stop_service():
+def stop_service(cancel: bool = False):
+    """
+    Stops the backup service. Running backups finish first, unless they are cancelled.
+    :param cancel: Cancel the running backups, their dump processes are killed and uploads stop at the next chunk.
+    """
     global service_running
     service_running = False
+    if cancel:
+        cancellation.cancel()
+    if _engine is not None:
+        _engine.shutdown()
 
 
-def run_backup_service(send_to_api=False, send_to_server=False, use_local_backup=False):
-    from croniter import croniter
-    global DB_CONFIG, BACKUP_CONFIG, API_CONFIG, SSH_CONFIG, configs, service_running
+def create_control_commands(engine, apply_config: Callable[[], None]) -> dict:
+    """
+    Creates the handlers of the control socket commands:
+    'run-now <job>' queues a backup of the job without changing its schedule,
+    'status' returns the running, queued and scheduled jobs and the progress of the running backups,
+    'reload' applies the configuration files at once, keeping the next run time of unchanged schedules,
+    'drain' finishes the queued and running backups and stops the service,
+    'stop' cancels the running backups and stops the service.
+    :param engine: JobEngine of the service.
+    :param apply_config: Reads the configuration files and applies them to the service.
+    """
+    from src.service.control import ControlError
+
+    def run_now(*names: str) -> dict:
+        if len(names) != 1:
+            raise ControlError("Usage: run-now <job>")
+        if not service_running:
+            raise ControlError("The service is stopping.")
+        if not engine.run_now(names[0]):
+            raise ControlError(f"Unknown job '{names[0]}', jobs: {', '.join(sorted(engine.jobs))}")
+        return {"message": f"Queued a backup of {names[0]}."}
+
+    def status() -> dict:
+        return {"service": "running" if service_running else "stopping", **engine.status(),
+                "progress": {job: {**vars(event), "fraction": event.fraction, "eta": event.eta}
+                             for job, event in progress.running().items()}}
+
+    def reload() -> dict:
+        apply_config()
+        return {"message": "Configuration reloaded.", "jobs": sorted(engine.jobs)}
+
+    def drain() -> dict:
+        global service_running
+        service_running = False
+        engine.drain()
+        engine_status = engine.status()
+        return {"message": f"Draining {len(engine_status['running'])} running and "
+                           f"{len(engine_status['queued'])} queued backups, the service stops afterwards."}
+
+    def stop() -> dict:
+        stop_service(cancel=True)
+        return {"message": "Stopping the service, running backups are cancelled."}
+
+    return {"run-now": run_now, "status": status, "reload": reload, "drain": drain, "stop": stop}
+
+
+def run_backup_service(send_to_api=False, send_to_server=False, use_local_backup=False, jobs=None,
+                       jobs_from_config=False, control_socket=None):
+    """
+    Runs the backup service until stop_service is called.
+    Changes to the configuration files are applied while the service runs, without a restart.
+    :param jobs: Backup jobs to run, defaults to a single job for the configured database.
+    :param jobs_from_config: Run the jobs of jobs_config.json instead, they are reloaded when the file changes.
+    :param control_socket: Path of a Unix domain socket to answer control commands on, see create_control_commands.
+    """
+    from src.configuration.config import SECTION_FILES, ConfigWatcher, load_config
+    from src.service.control import start_control_server
+    from src.service.job_engine import JobEngine, load_jobs
+
+    global _engine
     configs = load_all_configs()
-    DB_CONFIG = configs["db"]
-    BACKUP_CONFIG = configs["backup"]
-    API_CONFIG = configs["api"]
-    SSH_CONFIG = configs["ssh"]
-
-    if BACKUP_CONFIG["use_cron"]:
-        cron_expression = BACKUP_CONFIG.get("cron_expression", "")
-        if not croniter.is_valid(cron_expression):
-            print("Invalid cron expression! Please check your configuration.")
-            return
+    configure_pool(configs["ssh"])
+    configure_verification(configs["backup"])
+    jobs_config = load_config('jobs_config.json')
+    # Jobs passed by the caller can't be rebuilt from the configuration
+    reload_jobs = jobs is None or jobs_from_config
 
-        cron_schedule = croniter(cron_expression, datetime.now())
+    def create_jobs(configs: dict, jobs_config: dict) -> List[BackupJob]:
+        if jobs_from_config:
+            return load_jobs(jobs_config, configs)
+        return [BackupJob.from_configs(configs, send_to_api=send_to_api, send_to_server=send_to_server,
+                                       use_local_backup=use_local_backup)]
 
-        def cron_task():
-            next_run_time = cron_schedule.get_next(datetime)
-            while service_running:
-                now = datetime.now()
-                if now >= next_run_time:
-                    scheduled_backup(send_to_api=send_to_api, send_to_server=send_to_server, use_local_backup=use_local_backup)
-                    next_run_time = cron_schedule.get_next(datetime)
-                time.sleep(1)
+    if reload_jobs:
+        jobs = create_jobs(configs, jobs_config)
+    runtime = jobs_config.get("runtime", "threads").casefold()
+    if runtime == "asyncio":
+        from src.service.async_engine import AsyncJobEngine
 
-        print(f"Starting backup service with cron expression: {cron_expression}")
-        cron_task()
+        engine = AsyncJobEngine(
+            jobs,
+            max_concurrent_dumps=jobs_config.get("max_concurrent_dumps", 4),
+            max_dumps_per_host=jobs_config.get("max_dumps_per_host", 1),
+            io_workers=jobs_config.get("io_workers", 16)
+        )
     else:
-        schedule.every(BACKUP_CONFIG["interval_minutes"]).minutes.do(scheduled_backup, send_to_api=send_to_api,
-                                                                     send_to_server=send_to_server, use_local_backup=use_local_backup)
+        engine = JobEngine(
+            jobs,
+            max_concurrent_dumps=jobs_config.get("max_concurrent_dumps", 4),
+            max_dumps_per_host=jobs_config.get("max_dumps_per_host", 1)
+        )
+
+    def apply_config():
+        configs = load_all_configs()
+        jobs_config = load_config('jobs_config.json')
+        configure_pool(configs["ssh"])
+        configure_verification(configs["backup"])
+        engine.set_limits(jobs_config.get("max_concurrent_dumps", 4), jobs_config.get("max_dumps_per_host", 1))
+        if reload_jobs:
+            engine.reload(create_jobs(configs, jobs_config))
+
+    def apply_config_changes(changed: List[str]):
+        print(f"Configuration changed: {', '.join(changed)}")
+        apply_config()
+
+    watcher = ConfigWatcher([*SECTION_FILES.values(), 'jobs_config.json'], apply_config_changes)
+    metrics_server = None
+    metrics_host, metrics_port = jobs_config.get("metrics_host", "127.0.0.1"), jobs_config.get("metrics_port", 0)
+    if metrics_port:
+        metrics_server = start_metrics_server(metrics_host, metrics_port)
+        print(f"Serving metrics on http://{metrics_host}:{metrics_port}/metrics")
+    control_server = None
+    if control_socket:
+        control_server = start_control_server(control_socket, create_control_commands(engine, apply_config))
+        if control_server:
+            print(f"Listening for control commands on {control_socket}")
+    _engine = engine
+    # stop_service may have been called before the engine was registered
+    if service_running:
+        watcher.start()
+        engine.run()
+    watcher.stop()
+    _engine = None
 
-    print(f"Starting scheduled backups every {BACKUP_CONFIG['interval_minutes']} minutes.")
-    while service_running:
-        schedule.run_pending()
-        time.sleep(1)
+    verification_pool.shutdown()
+    ssh_pool.close_all()
+    if metrics_server:
+        metrics_server.shutdown()
+    if control_server:
+        control_server.shutdown()
+        control_server.server_close()
@@ -0,0 +1,380 @@
+import json
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, Iterator, List, Sequence
+
+from src.pipeline.progress import cancellation, wait_for_process
+
+# Files of a dump directory, restored in this order. The data files can be restored in parallel.
+SCHEMA_FILE = "schema.sql"
+DATA_DIRECTORY = "data"
+POST_DATA_FILE = "post_data.sql"
+RESTORE_MANIFEST = "restore.json"
+MANIFEST_FORMAT = 1
+
+DEFAULT_LOCK_WAIT_TIMEOUT = 60
+# Upper bound for the size of one INSERT statement, well below the default max_allowed_packet
+INSERT_SIZE = 1024 * 1024
+
+# Engines whose tables are read from the snapshot, all other tables are dumped while the read lock is held
+_TRANSACTIONAL_ENGINES = {"innodb"}
+# Column types that can't contain line breaks as SQL literals, all others are dumped as hex strings
+_QUOTED_TYPES = {"tinyint", "smallint", "mediumint", "int", "integer", "bigint", "decimal", "numeric", "float",
+                 "double", "real", "date", "datetime", "timestamp", "time", "year", "json"}
+_SNAPSHOT = ("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ; SET time_zone = '+00:00'; "
+             "START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+_DATA_HEADER = """/*!40101 SET NAMES utf8mb4 */;
+SET time_zone = '+00:00';
+SET foreign_key_checks = 0;
+SET unique_checks = 0;
+SET sql_mode = 'NO_AUTO_VALUE_ON_ZERO';
+"""
+_ESCAPES = {"\\\\": "\\", "\\t": "\t", "\\n": "\n", "\\0": "\0"}
+
+
+class MySQLDumpError(Exception):
+    """Raised if the database can't be dumped or a dump directory is incomplete."""
+
+
+@dataclass
+class MySQLTable:
+    name: str
+    engine: str
+    data_length: int = 0
+    columns: List[tuple] = field(default_factory=list)
+
+    @property
+    def transactional(self) -> bool:
+        return self.engine.casefold() in _TRANSACTIONAL_ENGINES
+
+
+@dataclass
+class MySQLDumpResult:
+    tables: int = 0
+    rows: int = 0
+    bytes: int = 0
+    workers: int = 0
+    # Seconds the read lock was held
+    lock_duration: float = 0.0
+    duration: float = 0.0
+
+
+def connection_options(db: dict) -> List[str]:
+    return ["-h", db["host"], "-P", str(db["port"]), "-u", db["user"], f"--password={db['password']}"]
+
+
+def quote_identifier(name: str) -> str:
+    return "`" + name.replace("`", "``") + "`"
+
+
+def _unescape(value: str) -> str:
+    # The mysql client escapes tabs, line breaks and backslashes in batch mode
+    return re.sub(r"\\[\\tn0]", lambda match: _ESCAPES[match.group()], value)
+
+
+class MySQLSession:
+    """
+    A connection to the database through the mysql client. Queries are written to its stdin, the rows are read
+    from stdout, one line per row. A marker query after every statement tells where its result ends, so the
+    connection and with it the transaction stays open between statements.
+    """
+
+    def __init__(self, db: dict, raw: bool = False):
+        """
+        :param db: Database configuration.
+        :param raw: Read the rows unescaped, for values that are already SQL literals.
+        """
+        command = ["mysql"] + connection_options(db) + [
+            "--batch", "--skip-column-names", "--unbuffered", "--quick", "--default-character-set=utf8mb4",
+            "--max-allowed-packet=1G"
+        ] + (["--raw"] if raw else []) + [db["dbname"]]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+
+    def _error(self) -> MySQLDumpError:
+        self.kill()
+        cancellation.check()
+        message = self.process.stderr.read().decode(errors="replace").strip().splitlines()
+        return MySQLDumpError(message[-1] if message else f"mysql exited with code {self.process.returncode}")
+
+    def query(self, sql: str) -> Iterator[bytes]:
+        """
+        Runs a statement and returns its rows as they arrive, the result must be read completely before the next
+        statement.
+        :raises MySQLDumpError: If the statement failed, the mysql client exits on the first error.
+        """
+        marker = uuid.uuid4().hex.encode()
+        try:
+            self.process.stdin.write(sql.encode() + b";\nSELECT '" + marker + b"';\n")
+            self.process.stdin.flush()
+        except OSError:
+            raise self._error()
+        for line in self.process.stdout:
+            line = line.rstrip(b"\n")
+            if line == marker:
+                return
+            yield line
+        raise self._error()
+
+    def execute(self, sql: str):
+        for _row in self.query(sql):
+            pass
+
+    def rows(self, sql: str) -> List[List[str]]:
+        """
+        Runs a query and returns its rows with the columns split, for sessions that aren't raw.
+        """
+        return [[_unescape(value) for value in row.decode().split("\t")] for row in self.query(sql)]
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.kill()
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+
+def _open_session(stack: ExitStack, db: dict, raw: bool = False) -> MySQLSession:
+    session = MySQLSession(db, raw)
+    stack.callback(session.close)
+    # Cancelling kills the client, which ends the running query
+    stack.enter_context(cancellation.process(session.process))
+    return session
+
+
+def _list_tables(session: MySQLSession) -> List[MySQLTable]:
+    tables = {}
+    for name, engine, data_length in session.rows(
+            "SELECT TABLE_NAME, IFNULL(ENGINE, ''), IFNULL(DATA_LENGTH, 0) FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE' ORDER BY DATA_LENGTH DESC"):
+        tables[name] = MySQLTable(name, engine, int(data_length))
+    # Generated columns are computed again on restore. Columns with an expression default are reported as
+    # 'DEFAULT_GENERATED' since MySQL 8.0.13, they hold data like any other column.
+    for table, column, data_type in session.rows(
+            "SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND EXTRA NOT LIKE '%VIRTUAL GENERATED%' "
+            "AND EXTRA NOT LIKE '%STORED GENERATED%' ORDER BY TABLE_NAME, ORDINAL_POSITION"):
+        if table in tables:
+            tables[table].columns.append((column, data_type.casefold()))
+    return list(tables.values())
+
+
+def _literal(column: str, data_type: str) -> str:
+    """
+    Returns the expression that selects the column as an SQL literal without line breaks.
+    """
+    column = quote_identifier(column)
+    if data_type in _QUOTED_TYPES:
+        return f"QUOTE({column})"
+    if data_type == "bit":
+        return f"IFNULL(CAST({column} AS UNSIGNED), 'NULL')"
+    return f"IF({column} IS NULL, 'NULL', CONCAT('X''', HEX({column}), ''''))"
+
+
+def _data_file(index: int, table: str) -> str:
+    return f"{DATA_DIRECTORY}/{index:04d}_{re.sub(r'[^A-Za-z0-9_.-]', '_', table)}.sql"
+
+
+def _dump_table(session: MySQLSession, table: MySQLTable, path: str,
+                progress: Callable[[int], None] = None) -> int:
+    """
+    Writes the rows of the table from the session's snapshot as INSERT statements.
+    :return: Number of rows.
+    """
+    columns = ", ".join(quote_identifier(column) for column, _type in table.columns)
+    select = (f"SELECT CONCAT('(', CONCAT_WS(',', {', '.join(_literal(*column) for column in table.columns)}), ')') "
+              f"FROM {quote_identifier(table.name)}")
+    insert = f"INSERT INTO {quote_identifier(table.name)} ({columns}) VALUES\n".encode()
+    rows = 0
+    statement: List[bytes] = []
+    size = 0
+    with open(path, "wb") as f:
+        f.write(f"-- Data of table {quote_identifier(table.name)}\n{_DATA_HEADER}".encode())
+
+        def _write():
+            data = insert + b",\n".join(statement) + b";\n"
+            f.write(data)
+            statement.clear()
+            if progress is not None:
+                progress(len(data))
+
+        for row in session.query(select):
+            if row == b"NULL":
+                # CONCAT returns NULL for results above the server's max_allowed_packet
+                raise MySQLDumpError(f"A row of table {table.name} is larger than max_allowed_packet.")
+            if statement and size + len(row) > INSERT_SIZE:
+                _write()
+                size = 0
+            statement.append(row)
+            size += len(row) + 2
+            rows += 1
+        if statement:
+            _write()
+    return rows
+
+
+def _run_mysqldump(db: dict, path: str, options: Sequence[str]):
+    command = ["mysqldump"] + connection_options(db) + ["--single-transaction"] + list(options) + [
+        db["dbname"], f"--result-file={path}"]
+    returncode = wait_for_process(subprocess.Popen(command))
+    if returncode != 0:
+        raise MySQLDumpError(f"mysqldump exited with code {returncode} while writing {os.path.basename(path)}")
+
+
+def dump_database(db: dict, directory: str, workers: int, extra_options: Sequence[str] = (),
+                  lock_wait_timeout: int = DEFAULT_LOCK_WAIT_TIMEOUT,
+                  progress: Callable[[int], None] = None) -> MySQLDumpResult:
+    """
+    Dumps a MySQL database with parallel workers from one consistent snapshot.
+    A coordinator connection takes a global read lock, every worker connection starts a transaction with a
+    consistent snapshot and the lock is released, so all workers see the same state while writers continue.
+    Tables of engines without transactions, e.g. MyISAM, are dumped first and the lock is held until they are done.
+    The tables are dumped largest first, one file per table. mysqldump writes the schema and the triggers, the lock
+    is held until it is done too, so no DDL can change the schema after the workers' snapshots started.
+    :param db: Database configuration.
+    :param directory: Empty directory the dump is written to, see RESTORE_MANIFEST for the restore order.
+    :param workers: Number of worker connections.
+    :param extra_options: Options for the mysqldump of the schema, e.g. '--routines'.
+    :param lock_wait_timeout: Seconds to wait for the global read lock, it waits for running statements.
+    :param progress: Called with the number of bytes written since the last call, from the worker threads.
+    :return: MySQLDumpResult with the number of tables and rows.
+    :raises MySQLDumpError: If the database can't be dumped, e.g. without the RELOAD privilege for the lock.
+    """
+    result = MySQLDumpResult()
+    start = time.monotonic()
+    os.makedirs(os.path.join(directory, DATA_DIRECTORY), exist_ok=True)
+    with ExitStack() as stack:
+        coordinator = _open_session(stack, db)
+        # The workers connect before the lock is taken, so it is only held while their snapshots start
+        sessions = [_open_session(stack, db, raw=True) for _ in range(max(1, workers))]
+        coordinator.execute(f"SET SESSION lock_wait_timeout = {int(lock_wait_timeout)}")
+        try:
+            coordinator.execute("FLUSH TABLES WITH READ LOCK")
+        except MySQLDumpError as e:
+            raise MySQLDumpError(f"Could not lock the tables for a consistent snapshot, "
+                                 f"the user needs the RELOAD privilege: {e}") from e
+        lock_start = time.monotonic()
+        tables = _list_tables(coordinator)
+        sessions = sessions[:max(1, len(tables))]
+        for session in sessions:
+            session.execute(_SNAPSHOT)
+
+        unlock = threading.Lock()
+        # The schema dump and the tables without transactions, the lock is released when all of them are done
+        locked = [1 + sum(1 for table in tables if not table.transactional)]
+
+        def _release():
+            with unlock:
+                locked[0] -= 1
+                if not locked[0]:
+                    coordinator.execute("UNLOCK TABLES")
+                    result.lock_duration = time.monotonic() - lock_start
+
+        files = {table.name: _data_file(index, table.name) for index, table in enumerate(tables, 1)}
+        rows = {}
+        tasks = queue.SimpleQueue()
+        for table in sorted(tables, key=lambda table: table.transactional):
+            tasks.put(table)
+
+        def _work(session: MySQLSession):
+            while True:
+                try:
+                    table = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                rows[table.name] = _dump_table(session, table, os.path.join(directory, files[table.name]), progress)
+                if not table.transactional:
+                    _release()
+
+        with ThreadPoolExecutor(max_workers=len(sessions), thread_name_prefix="mysql-dump") as executor:
+            futures = [executor.submit(_work, session) for session in sessions]
+            try:
+                # mysqldump reads the schema under the lock while the workers dump the data
+                _run_mysqldump(db, os.path.join(directory, SCHEMA_FILE), ["--no-data", "--skip-triggers"]
+                               + list(extra_options))
+                # Triggers are created after the data, so restoring the rows doesn't fire them
+                _run_mysqldump(db, os.path.join(directory, POST_DATA_FILE), ["--no-data", "--no-create-info",
+                                                                              "--triggers"])
+                _release()
+                done, _pending = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+            except BaseException:
+                # Ends the queries of the other workers
+                for session in sessions:
+                    session.kill()
+                raise
+
+    manifest_tables = []
+    for table in tables:
+        size = os.path.getsize(os.path.join(directory, files[table.name]))
+        manifest_tables.append({"table": table.name, "file": files[table.name], "rows": rows[table.name],
+                                "bytes": size})
+        result.rows += rows[table.name]
+        result.bytes += size
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "database": db["dbname"],
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "workers": len(sessions),
+        "stages": [
+            {"name": "schema", "parallel": False, "files": [SCHEMA_FILE]},
+            {"name": "data", "parallel": True, "files": [entry["file"] for entry in manifest_tables]},
+            {"name": "post-data", "parallel": False, "files": [POST_DATA_FILE]},
+        ],
+        "tables": manifest_tables,
+    }
+    # Written last, a dump directory without it is incomplete
+    with open(os.path.join(directory, RESTORE_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=4)
+    result.tables = len(tables)
+    result.workers = len(sessions)
+    result.duration = time.monotonic() - start
+    return result
+
+
+def check_dump(directory: str) -> List[str]:
+    """
+    Checks that a dump directory is complete.
+    :param directory: Directory written by dump_database.
+    :return: Paths of the files in restore order.
+    :raises MySQLDumpError: If the manifest or a file is missing or a data file has the wrong size.
+    """
+    try:
+        with open(os.path.join(directory, RESTORE_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise MySQLDumpError(f"The restore manifest is missing or invalid: {e}") from e
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise MySQLDumpError(f"Unsupported restore manifest format {manifest.get('format')}.")
+    sizes = {entry["file"]: entry["bytes"] for entry in manifest.get("tables", [])}
+    paths = []
+    for stage in manifest["stages"]:
+        for file_name in stage["files"]:
+            path = os.path.join(directory, file_name)
+            if not os.path.isfile(path):
+                raise MySQLDumpError(f"{file_name} is missing.")
+            if file_name in sizes and os.path.getsize(path) != sizes[file_name]:
+                raise MySQLDumpError(f"{file_name} has {os.path.getsize(path)} bytes, "
+                                     f"the manifest lists {sizes[file_name]} bytes.")
+            paths.append(path)
+    return paths
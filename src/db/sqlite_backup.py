@@ -0,0 +1,161 @@
+import os
+import pathlib
+import sqlite3
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+ENGINE_NATIVE = "native"
+ENGINE_CLI = "cli"
+
+DEFAULT_PAGES_PER_STEP = 1024
+DEFAULT_STEP_SLEEP_MS = 0
+# Restarts of a stepped copy before the copy is done in a single step
+MAX_RESTARTS = 3
+# The file change counter is a 4-byte big-endian integer at offset 24 of the database header
+_CHANGE_COUNTER_OFFSET = 24
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def read_only_uri(path: str) -> str:
+    """
+    Returns the URI that opens a database file read-only. The path is escaped, so '?' or '#' in it stay part of it.
+    """
+    return pathlib.Path(os.path.abspath(path)).as_uri() + "?mode=ro"
+
+
+@dataclass
+class SqliteBackupResult:
+    pages: int = 0
+    page_size: int = 0
+    steps: int = 0
+    restarts: int = 0
+    duration: float = 0.0
+
+    @property
+    def size(self) -> int:
+        return self.pages * self.page_size
+
+
+def backup_database(source_path: str, target_path: str, pages_per_step: int = DEFAULT_PAGES_PER_STEP,
+                    step_sleep: float = 0.0,
+                    progress: Callable[[int, int, int], None] = None) -> SqliteBackupResult:
+    """
+    Copies a live SQLite database with the online backup API, without the sqlite3 command-line tool.
+    The copy advances pages_per_step pages at a time and only holds a read lock during a step, so writers can
+    commit in between. A write by another connection restarts the copy at the next step. After MAX_RESTARTS
+    restarts the database is copied in a single step, which holds the read lock until the copy is done.
+    :param source_path: Path of the database.
+    :param target_path: Path of the backup, an existing file is overwritten.
+    :param pages_per_step: Pages copied per step, 0 or less copies the whole database in one step.
+    :param step_sleep: Seconds to sleep between two steps, gives writers room on a busy database.
+    :param progress: Called after every step with the number of remaining and total pages and the page size.
+    :return: SqliteBackupResult with the number of pages copied.
+    """
+    result = SqliteBackupResult()
+    start = time.monotonic()
+    last_remaining = None
+
+    def _step(_status: int, remaining: int, total: int):
+        nonlocal last_remaining
+        result.steps += 1
+        result.pages = total
+        if last_remaining is not None and remaining > last_remaining:
+            result.restarts += 1
+            if result.restarts >= MAX_RESTARTS:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+        if progress is not None:
+            progress(remaining, total, result.page_size)
+        if step_sleep > 0 and remaining:
+            time.sleep(step_sleep)
+
+    source = sqlite3.connect(read_only_uri(source_path), uri=True)
+    try:
+        result.page_size = source.execute("PRAGMA page_size").fetchone()[0]
+        target = sqlite3.connect(target_path)
+        try:
+            try:
+                source.backup(target, pages=pages_per_step if pages_per_step > 0 else -1, progress=_step)
+            except _TooManyRestarts:
+                source.backup(target, pages=-1, progress=_step)
+            result.pages = target.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            target.close()
+    finally:
+        source.close()
+    result.duration = time.monotonic() - start
+    return result
+
+
+def _change_counter(path: str) -> Optional[int]:
+    try:
+        with open(path, "rb") as f:
+            f.seek(_CHANGE_COUNTER_OFFSET)
+            data = f.read(4)
+    except OSError:
+        return None
+    return struct.unpack(">I", data)[0] if len(data) == 4 else None
+
+
+class ChangeTracker:
+    """
+    Tells whether a SQLite database changed since its last backup, without reading it.
+    The file change counter in the header is increased by every commit in rollback journal mode. Commits in WAL mode
+    only reach the file on a checkpoint, so 'PRAGMA data_version' of a connection that stays open is checked as well,
+    it changes whenever another connection committed. The state is kept in memory, so the first run after a restart
+    always backs up.
+    """
+
+    def __init__(self):
+        self._connections: Dict[str, sqlite3.Connection] = {}
+        self._backed_up: Dict[str, Tuple] = {}
+        self._lock = threading.Lock()
+
+    def signature(self, path: str) -> Optional[Tuple]:
+        """
+        Returns the change state of the database, None if it can't be read.
+        """
+        with self._lock:
+            connection = self._connections.get(path)
+            try:
+                if connection is None:
+                    connection = sqlite3.connect(read_only_uri(path), uri=True, check_same_thread=False)
+                    self._connections[path] = connection
+                data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+                stat = os.stat(path)
+            except (sqlite3.Error, OSError):
+                self._connections.pop(path, None)
+                return None
+        return data_version, _change_counter(path), stat.st_size, stat.st_mtime_ns
+
+    def unchanged(self, name: str, signature: Optional[Tuple]) -> bool:
+        """
+        :param name: Name of the job that backs up the database.
+        :param signature: Current signature of the database.
+        :return: True if the database didn't change since the last successful backup of the job.
+        """
+        with self._lock:
+            return signature is not None and self._backed_up.get(name) == signature
+
+    def backed_up(self, name: str, signature: Optional[Tuple]):
+        """
+        Remembers the signature the database had when the job's backup started.
+        """
+        if signature is not None:
+            with self._lock:
+                self._backed_up[name] = signature
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+
+
+change_tracker = ChangeTracker()
@@ -0,0 +1,469 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Dict, List, Optional
+
+from src.db.mysql_parallel import MySQLDumpError, check_dump
+from src.db.sqlite_backup import read_only_uri
+from src.pipeline.compression import open_decompressed
+from src.pipeline.encryption import ENCRYPTED_SUFFIX, encryption_key
+
+MODE_NONE = "none"
+# Reads the backup's table of contents or checks its integrity without restoring it
+MODE_QUICK = "quick"
+# Restores PostgreSQL and MySQL backups into a scratch database
+MODE_RESTORE = "restore"
+
+STATUS_PASSED = "passed"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+
+DEFAULT_MAX_SHRINK_RATIO = 0.5
+_SQLITE_HEADER = b"SQLite format 3\x00"
+_MYSQL_TRAILER = b"-- Dump completed"
+
+
+@dataclass
+class VerificationResult:
+    name: str
+    status: str = STATUS_PASSED
+    checks: Dict[str, str] = field(default_factory=dict)
+    tables: Optional[int] = None
+    rows: Optional[int] = None
+    duration: float = 0.0
+
+    def passed(self, check: str, message: str = "ok"):
+        self.checks[check] = message
+
+    def failed(self, check: str, message: str):
+        self.checks[check] = message
+        self.status = STATUS_FAILED
+
+    def details(self) -> dict:
+        return {"checks": self.checks, "tables": self.tables, "rows": self.rows, "duration": round(self.duration, 3)}
+
+
+def _throttled(command: List[str]) -> List[str]:
+    # Idle IO priority, the CPU priority is inherited from the lowered worker thread
+    if shutil.which("ionice"):
+        return ["ionice", "-c", "3"] + command
+    return command
+
+
+def _run(command: List[str], env: Optional[dict] = None, stdin: Optional[BinaryIO] = None) -> subprocess.CompletedProcess:
+    """
+    Runs a throttled verification command, stdin is copied from a file object, e.g. a decompressing reader.
+    """
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(_throttled(command), env=env, stdin=subprocess.PIPE if stdin else None,
+                                   stdout=subprocess.PIPE, stderr=errors)
+
+        # Feed stdin from a thread so a full stdout pipe can't block the copy
+        def _copy():
+            try:
+                shutil.copyfileobj(stdin, process.stdin, 1024 * 1024)
+            except BrokenPipeError:
+                pass
+            finally:
+                process.stdin.close()
+
+        feeder = threading.Thread(target=_copy, daemon=True)
+        if stdin:
+            feeder.start()
+        stdout = process.stdout.read()
+        process.stdout.close()
+        if stdin:
+            feeder.join()
+        process.wait()
+        errors.seek(0)
+        return subprocess.CompletedProcess(command, process.returncode, stdout, errors.read())
+
+
+def _error(completed: subprocess.CompletedProcess) -> str:
+    message = completed.stderr.decode(errors="replace").strip().splitlines()
+    return f"exit code {completed.returncode}: {message[-1] if message else ''}"
+
+
+def _pg_env(job) -> dict:
+    env = os.environ.copy()
+    env["PGPASSWORD"] = job.db["password"]
+    return env
+
+
+def _pg_connection(job) -> List[str]:
+    return ["-h", job.db["host"], "-p", str(job.db["port"]), "-U", job.db["user"]]
+
+
+def _scratch_database(job) -> str:
+    """
+    Returns a new scratch database name. Verifications of the same job can run at the same time, so every one gets
+    its own database. Identifiers are limited to 63 characters in PostgreSQL and 64 in MySQL.
+    """
+    prefix = job.db.get("verification_database") or f"{job.db['dbname']}_verify"
+    return f"{prefix[:50]}_{uuid.uuid4().hex[:12]}"
+
+
+def _extract(archive: tarfile.TarFile, work_dir: str):
+    """
+    Extracts an archived dump directory. Members that would end up outside of work_dir are rejected, by tarfile's
+    'data' filter where it exists (Python 3.12, and 3.8.17, 3.9.17, 3.10.12, 3.11.4 or later), else by checking
+    that the archive only has files and directories inside work_dir, like the ones tar_stream writes.
+    :raises tarfile.TarError: If the archive has an unsafe member.
+    """
+    if hasattr(tarfile, "data_filter"):
+        archive.extractall(work_dir, filter="data")
+        return
+    root = os.path.realpath(work_dir)
+    for member in archive:
+        target = os.path.realpath(os.path.join(root, member.name))
+        if not (member.isfile() or member.isdir()) or os.path.commonpath([root, target]) != root:
+            raise tarfile.TarError(f"Unexpected member in the dump archive: {member.name}")
+        archive.extract(member, root)
+
+
+def _verify_postgresql(job, path: str, mode: str, result: VerificationResult):
+    env = _pg_env(job)
+    key = encryption_key(job.backup)
+    with tempfile.TemporaryDirectory(prefix="verify_", dir=os.path.dirname(path)) as work_dir:
+        if ".tar" in os.path.basename(path):
+            # Parallel dumps are archived dump directories
+            with open_decompressed(path, key) as f, tarfile.open(fileobj=f, mode="r|") as archive:
+                _extract(archive, work_dir)
+            entries = os.listdir(work_dir)
+            archive_path, stdin = os.path.join(work_dir, entries[0]) if entries else work_dir, None
+        elif path.endswith(".sql"):
+            archive_path, stdin = path, None
+        else:
+            archive_path, stdin = None, open_decompressed(path, key)
+
+        try:
+            listing = _run(["pg_restore", "--list"] + ([archive_path] if archive_path else []), env, stdin)
+        finally:
+            if stdin:
+                stdin.close()
+        if listing.returncode != 0:
+            result.failed("pg_restore --list", _error(listing))
+            return
+        result.tables = sum(1 for line in listing.stdout.splitlines() if b" TABLE DATA " in line)
+        result.passed("pg_restore --list", f"{result.tables} tables")
+        if mode != MODE_RESTORE:
+            return
+
+        database = _scratch_database(job)
+        connection = _pg_connection(job)
+        stdin = None
+        try:
+            created = _run(["createdb"] + connection + [database], env)
+            if created.returncode != 0:
+                result.failed("restore", f"Could not create scratch database {database}, {_error(created)}")
+                return
+            stdin = None if archive_path else open_decompressed(path, key)
+            restore = _run(["pg_restore", "--no-owner", "--exit-on-error", "-d", database] + connection
+                           + ([archive_path] if archive_path else []), env, stdin)
+            if restore.returncode != 0:
+                result.failed("restore", _error(restore))
+                return
+            result.passed("restore")
+            counts = _run(["psql", "-X", "-tA", "-d", database] + connection + [
+                "-c", "ANALYZE", "-c", "SELECT coalesce(sum(n_live_tup), 0) FROM pg_stat_user_tables"], env)
+            if counts.returncode == 0:
+                result.rows = int(counts.stdout.split()[-1])
+        finally:
+            if stdin:
+                stdin.close()
+            _run(["dropdb", "--if-exists"] + connection + [database], env)
+
+
+def _mysql_connection(job) -> List[str]:
+    return ["-h", job.db["host"], "-P", str(job.db["port"]), "-u", job.db["user"], f"--password={job.db['password']}"]
+
+
+def _check_mysql_dump(path: str, work_dir: str, key: Optional[bytes], result: VerificationResult) -> List[str]:
+    """
+    Returns the files of the dump in restore order, an empty list if it is incomplete.
+    """
+    if ".tar" in os.path.basename(path):
+        # Parallel dumps are archived dump directories with a restore manifest
+        with open_decompressed(path, key) as f, tarfile.open(fileobj=f, mode="r|") as archive:
+            _extract(archive, work_dir)
+        entries = os.listdir(work_dir)
+        try:
+            files = check_dump(os.path.join(work_dir, entries[0]) if entries else work_dir)
+        except MySQLDumpError as e:
+            result.failed("dump completed", str(e))
+            return []
+    else:
+        files = [path]
+    # mysqldump ends every complete dump with a '-- Dump completed' comment, the data files of parallel dumps
+    # are covered by the sizes in the manifest
+    for file in files[:1] + files[-1:]:
+        tail = b""
+        with open_decompressed(file, key) as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                tail = (tail + chunk)[-4096:]
+        if _MYSQL_TRAILER not in tail:
+            result.failed("dump completed",
+                          f"{os.path.basename(file)} is truncated, the completion comment is missing.")
+            return []
+    result.passed("dump completed")
+    return files
+
+
+def _verify_mysql(job, path: str, mode: str, result: VerificationResult):
+    key = encryption_key(job.backup)
+    with tempfile.TemporaryDirectory(prefix="verify_", dir=os.path.dirname(path)) as work_dir:
+        files = _check_mysql_dump(path, work_dir, key, result)
+        if files and mode == MODE_RESTORE:
+            _restore_mysql(job, files, key, result)
+
+
+def _restore_mysql(job, files: List[str], key: Optional[bytes], result: VerificationResult):
+    database = _scratch_database(job)
+    connection = _mysql_connection(job)
+    try:
+        created = _run(["mysql"] + connection + ["-e", f"CREATE DATABASE `{database}`"])
+        if created.returncode != 0:
+            result.failed("restore", f"Could not create scratch database {database}, {_error(created)}")
+            return
+        for file in files:
+            with open_decompressed(file, key) as f:
+                restore = _run(["mysql"] + connection + [database], stdin=f)
+            if restore.returncode != 0:
+                result.failed("restore", f"{os.path.basename(file)}, {_error(restore)}")
+                return
+        result.passed("restore")
+        counts = _run(["mysql"] + connection + ["-N", "-B", "-e",
+                                                f"SELECT COUNT(*), COALESCE(SUM(TABLE_ROWS), 0) FROM information_schema.TABLES "
+                                                f"WHERE TABLE_SCHEMA = '{database}'"])
+        if counts.returncode == 0:
+            tables, rows = counts.stdout.split()[:2]
+            result.tables, result.rows = int(tables), int(rows)
+    finally:
+        _run(["mysql"] + connection + ["-e", f"DROP DATABASE IF EXISTS `{database}`"])
+
+
+def _sqlite_counts(database_path: str, mode: str, result: VerificationResult):
+    pragma = "integrity_check" if mode == MODE_RESTORE else "quick_check"
+    connection = sqlite3.connect(read_only_uri(database_path), uri=True)
+    try:
+        messages = [row[0] for row in connection.execute(f"PRAGMA {pragma}")]
+        if messages != ["ok"]:
+            result.failed(pragma, "; ".join(messages[:5]))
+            return
+        result.passed(pragma)
+        tables = [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        result.tables = len(tables)
+        result.rows = sum(connection.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables)
+    except sqlite3.DatabaseError as e:
+        result.failed(pragma, str(e))
+    finally:
+        connection.close()
+
+
+def _verify_sqlite(path: str, mode: str, key: Optional[bytes], result: VerificationResult):
+    with open_decompressed(path, key) as f:
+        header = f.read(len(_SQLITE_HEADER))
+    if header == _SQLITE_HEADER and not path.endswith((".gz", ".zst", ENCRYPTED_SUFFIX)):
+        # Backup created with .backup, a database file that can be checked directly
+        _sqlite_counts(path, mode, result)
+        return
+
+    # Backup created with .dump, load the SQL into a scratch database first
+    with tempfile.TemporaryDirectory(prefix="verify_", dir=os.path.dirname(path)) as work_dir:
+        database_path = os.path.join(work_dir, "verify.db")
+        with open_decompressed(path, key) as f:
+            if header == _SQLITE_HEADER:
+                with open(database_path, "wb") as target:
+                    shutil.copyfileobj(f, target, 1024 * 1024)
+                restore = None
+            else:
+                restore = _run(["sqlite3", "-bail", database_path], stdin=f)
+        if restore is not None:
+            if restore.returncode != 0:
+                result.failed("restore", _error(restore))
+                return
+            result.passed("restore")
+        _sqlite_counts(database_path, mode, result)
+
+
+def _file_format(job, name: str) -> str:
+    # Backup names are the job's prefix, a timestamp like 20240101_120000 and the extension, e.g. '.sql.gz'
+    return name[len(job.backup_prefix) + len("20240101_120000"):]
+
+
+def _check_sizes(job, path: str, manifest: Optional[dict], previous, max_shrink_ratio: float,
+                 result: VerificationResult):
+    size = os.path.getsize(path)
+    if previous is not None and _file_format(job, previous.name) != _file_format(job, result.name):
+        # Sizes of e.g. compressed and uncompressed backups can't be compared
+        previous = None
+    if size == 0:
+        result.failed("size", "The backup is empty.")
+        return
+    if manifest and manifest.get("size") != size:
+        result.failed("size", f"{size} bytes, the manifest lists {manifest.get('size')} bytes.")
+        return
+    if previous is not None and previous.size and size < previous.size * (1 - max_shrink_ratio):
+        result.failed("size", f"{size} bytes, shrunk from {previous.size} bytes of {previous.name}.")
+        return
+    result.passed("size", f"{size} bytes")
+
+
+def _check_rows(previous, max_shrink_ratio: float, result: VerificationResult):
+    previous_rows = previous.verification_details.get("rows") if previous is not None else None
+    if result.rows is None or not previous_rows:
+        return
+    if result.rows < previous_rows * (1 - max_shrink_ratio):
+        result.failed("rows", f"{result.rows} rows, shrunk from {previous_rows} rows of {previous.name}.")
+    else:
+        result.passed("rows", f"{result.rows} rows")
+
+
+def verify_backup(job, path: str, mode: str = MODE_QUICK, manifest: Optional[dict] = None, previous=None,
+                  max_shrink_ratio: float = DEFAULT_MAX_SHRINK_RATIO) -> VerificationResult:
+    """
+    Checks that a backup file can be restored.
+    PostgreSQL backups are listed with pg_restore --list, SQLite backups get an integrity check and
+    MySQL dumps must be complete. In restore mode PostgreSQL and MySQL backups are restored into a
+    scratch database. The size and the number of rows are compared with the last verified backup.
+    :param job: Backup job.
+    :param path: Path to the backup file.
+    :param mode: MODE_QUICK or MODE_RESTORE.
+    :param manifest: Manifest of the backup, its size must match the file.
+    :param previous: Catalog entry of the last verified backup of the job.
+    :param max_shrink_ratio: Share the backup may shrink compared to the previous one.
+    :return: VerificationResult with the result of every check.
+    """
+    result = VerificationResult(os.path.basename(path))
+    start = time.monotonic()
+    try:
+        _check_sizes(job, path, manifest, previous, max_shrink_ratio, result)
+        if result.status == STATUS_PASSED:
+            match job.db["type"].casefold():
+                case 'postgresql':
+                    _verify_postgresql(job, path, mode, result)
+                case 'mysql':
+                    _verify_mysql(job, path, mode, result)
+                case 'sqlite':
+                    _verify_sqlite(path, mode, encryption_key(job.backup), result)
+                case _:
+                    result.passed("restore", f"Not supported for database type: {job.db['type']}")
+        if result.status == STATUS_PASSED:
+            _check_rows(previous, max_shrink_ratio, result)
+    except Exception as e:
+        result.failed("error", str(e))
+    result.duration = time.monotonic() - start
+    return result
+
+
+def _lower_thread_priority(niceness: int):
+    # On Linux the niceness applies to the calling thread only, the processes it starts inherit it
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError):
+        pass
+
+
+class VerificationPool:
+    """
+    Runs backup verifications on a few low-priority worker threads, so they never delay the next dump.
+    The queue is bounded: if verifications pile up, the oldest pending one is skipped,
+    so the pool keeps up with the schedule instead of falling further behind.
+    """
+
+    def __init__(self, max_workers: int = 1, max_pending: int = 16, niceness: int = 10):
+        """
+        :param max_workers: Number of verifications running at the same time.
+        :param max_pending: Number of verifications waiting for a worker.
+        :param niceness: CPU niceness of the worker threads and their processes.
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.niceness = niceness
+        self._pending = deque()
+        self._workers: List[threading.Thread] = []
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def submit(self, name: str, task: Callable[[], None], on_skip: Callable[[], None] = None):
+        """
+        Queues a verification.
+        :param name: Name of the verified backup.
+        :param task: Runs the verification.
+        :param on_skip: Called instead of task if the verification is dropped from the full queue.
+        """
+        skipped = None
+        with self._condition:
+            if self._stopped:
+                skipped = (name, task, on_skip)
+            else:
+                if len(self._pending) >= self.max_pending:
+                    skipped = self._pending.popleft()
+                self._pending.append((name, task, on_skip))
+                self._workers = [worker for worker in self._workers if worker.is_alive()]
+                if len(self._workers) < self.max_workers:
+                    worker = threading.Thread(target=self._work, name="verification", daemon=True)
+                    self._workers.append(worker)
+                    worker.start()
+                self._condition.notify()
+        if skipped:
+            print(f"Skipped verification of {skipped[0]}, the verification queue is full.")
+            if skipped[2]:
+                skipped[2]()
+
+    def _work(self):
+        _lower_thread_priority(self.niceness)
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                name, task, _on_skip = self._pending.popleft()
+            try:
+                task()
+            except Exception as e:
+                print(f"Error verifying {name}: {e}")
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def shutdown(self):
+        """
+        Stops the workers after their current verification, pending verifications are skipped.
+        """
+        with self._condition:
+            self._stopped = True
+            skipped = list(self._pending)
+            self._pending.clear()
+            self._condition.notify_all()
+        for _name, _task, on_skip in skipped:
+            if on_skip:
+                on_skip()
+
+    def start(self):
+        with self._condition:
+            self._stopped = False
+
+
+verification_pool = VerificationPool()
+
+
+def configure_verification(backup_config: dict):
+    """
+    Applies the worker settings of the backup configuration to the shared verification pool.
+    :param backup_config: Backup configuration.
+    """
+    verification_pool.max_workers = max(1, backup_config.get("verification_workers", 1))
+    verification_pool.max_pending = max(1, backup_config.get("verification_max_pending", 16))
+    verification_pool.start()
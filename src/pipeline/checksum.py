@@ -0,0 +1,132 @@
+import hashlib
+import json
+import zlib
+from datetime import datetime
+from typing import Iterator, Optional
+
+MANIFEST_SUFFIX = ".manifest.json"
+FAST_HASHES = ("none", "crc32", "xxh3")
+
+
+class _Crc32:
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data: bytes):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self) -> str:
+        return f"{self._value:08x}"
+
+
+class ChecksumStage:
+    """
+    Hashes the stream while it passes from the dump to the destinations, so the checksums of a backup
+    are known as soon as it is written and verifying it doesn't need another full read.
+    Computes SHA-256 and optionally a fast non-cryptographic hash (CRC32 or XXH3) for quick comparisons.
+    """
+
+    def __init__(self, fast_hash: str = "none"):
+        """
+        :param fast_hash: 'none', 'crc32' or 'xxh3' (requires the 'xxhash' package).
+        """
+        fast_hash = fast_hash.casefold()
+        if fast_hash not in FAST_HASHES:
+            raise ValueError(f"Unsupported fast hash: {fast_hash}")
+        self.fast_hash = fast_hash
+        self._sha256 = hashlib.sha256()
+        self._fast = None
+        if fast_hash == "crc32":
+            self._fast = _Crc32()
+        elif fast_hash == "xxh3":
+            try:
+                import xxhash
+            except ImportError:
+                raise ValueError("The xxh3 hash requires the 'xxhash' package (pip install xxhash).")
+            self._fast = xxhash.xxh3_64()
+        self.size = 0
+
+    def update(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Pipeline stage that hashes every chunk and passes it on unchanged.
+        """
+        for chunk in chunks:
+            self.add(chunk)
+            yield chunk
+
+    def add(self, chunk: bytes):
+        """
+        Hashes the next chunk of the stream.
+        """
+        self._sha256.update(chunk)
+        if self._fast is not None:
+            self._fast.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    @property
+    def fast_digest(self) -> Optional[str]:
+        return self._fast.hexdigest() if self._fast is not None else None
+
+    def manifest(self, file_name: str) -> dict:
+        """
+        Returns the manifest of the hashed stream.
+        :param file_name: Name of the backup the stream was written to.
+        """
+        manifest = {
+            "file": file_name,
+            "size": self.size,
+            "sha256": self.sha256,
+            "created": datetime.now().isoformat(timespec="seconds"),
+        }
+        if self._fast is not None:
+            manifest[self.fast_hash] = self.fast_digest
+        return manifest
+
+
+def hash_file(path: str, fast_hash: str = "none", chunk_size: int = 1024 * 1024) -> ChecksumStage:
+    """
+    Hashes an existing file, for dump tools that write the backup file themselves.
+    :return: ChecksumStage with the checksums of the file.
+    """
+    checksum = ChecksumStage(fast_hash)
+    with open(path, "rb") as f:
+        for _chunk in checksum.update(iter(lambda: f.read(chunk_size), b"")):
+            pass
+    return checksum
+
+
+def create_checksum_stage(backup_config: dict) -> ChecksumStage:
+    """
+    Creates the checksum stage with the fast hash configured in the backup configuration.
+    :param backup_config: Backup configuration.
+    """
+    return ChecksumStage(backup_config.get("fast_hash", "none"))
+
+
+def manifest_path(backup_path: str) -> str:
+    return f"{backup_path}{MANIFEST_SUFFIX}"
+
+
+def write_manifest(backup_path: str, manifest: dict):
+    """
+    Writes the manifest next to the backup file.
+    """
+    with open(manifest_path(backup_path), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def read_manifest(backup_path: str) -> Optional[dict]:
+    """
+    Reads the manifest next to the backup file.
+    :return: The manifest or None if the backup has none.
+    """
+    try:
+        with open(manifest_path(backup_path), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
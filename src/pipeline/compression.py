@@ -0,0 +1,163 @@
+import gzip
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator
+
+COMPRESSION_SUFFIXES = {
+    "none": "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class BlockCompressor:
+    """
+    Compresses a chunk stream in independent blocks on a thread pool.
+    Every block becomes its own gzip member or zstd frame. Concatenated members/frames are valid
+    gzip/zstd files, so the output can be decompressed with the regular gunzip and zstd tools.
+    zlib and zstandard release the GIL while compressing, so the blocks are compressed on all cores.
+    """
+
+    def __init__(self, algorithm: str, level: int = 3, threads: int = 0, block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        :param algorithm: Compression algorithm, 'gzip' or 'zstd'.
+        :param level: Compression level of the algorithm.
+        :param threads: Number of compression threads, 0 uses one per CPU core.
+        :param block_size: Number of input bytes compressed as one block.
+        """
+        if algorithm not in ("gzip", "zstd"):
+            raise ValueError(f"Unsupported compression algorithm: {algorithm}")
+        if algorithm == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zstd compression requires the 'zstandard' package (pip install zstandard).")
+            self._zstandard = zstandard
+            self._local = threading.local()
+
+        self.algorithm = algorithm
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.duration = 0.0
+
+    @property
+    def suffix(self) -> str:
+        return COMPRESSION_SUFFIXES[self.algorithm]
+
+    @property
+    def ratio(self) -> float:
+        return self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+
+    @property
+    def throughput(self) -> float:
+        """
+        Uncompressed MB per second over the lifetime of the stream.
+        """
+        return self.bytes_in / (1024 * 1024) / self.duration if self.duration else 0.0
+
+    def compress_block(self, block: bytes) -> bytes:
+        """
+        Compresses one block into its own gzip member or zstd frame, for callers that schedule the blocks
+        themselves. Doesn't update the statistics. Thread-safe.
+        """
+        if self.algorithm == "gzip":
+            return gzip.compress(block, compresslevel=self.level, mtime=0)
+        # ZstdCompressor objects must not be shared between threads
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = self._zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(block)
+
+    def _blocks(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= self.block_size:
+                yield bytes(buffer[:self.block_size])
+                del buffer[:self.block_size]
+        if buffer:
+            yield bytes(buffer)
+
+    def compress(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Compresses the stream, yielding the compressed blocks in input order.
+        At most two blocks per thread are in flight, so memory stays bounded.
+        :param chunks: Iterator of uncompressed byte chunks.
+        :return: Iterator of compressed blocks.
+        """
+        start = time.monotonic()
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="compress") as executor:
+            for block in self._blocks(chunks):
+                self.bytes_in += len(block)
+                pending.append(executor.submit(self.compress_block, block))
+                if len(pending) >= self.threads * 2:
+                    compressed = pending.popleft().result()
+                    self.bytes_out += len(compressed)
+                    yield compressed
+            while pending:
+                compressed = pending.popleft().result()
+                self.bytes_out += len(compressed)
+                yield compressed
+        self.duration = time.monotonic() - start
+
+    def summary(self) -> str:
+        return (f"Compression ({self.algorithm}): {self.bytes_in / (1024 * 1024):.1f} MB -> "
+                f"{self.bytes_out / (1024 * 1024):.1f} MB, ratio {self.ratio:.2f}x, {self.throughput:.1f} MB/s")
+
+
+def create_compressor(backup_config: dict):
+    """
+    Creates the compression stage configured in the backup configuration.
+    :param backup_config: Backup configuration.
+    :return: BlockCompressor or None if compression is disabled.
+    """
+    algorithm = backup_config.get("compression", "none").casefold()
+    if algorithm == "none":
+        return None
+    return BlockCompressor(
+        algorithm,
+        level=backup_config.get("compression_level", 3),
+        threads=backup_config.get("compression_threads", 0),
+        block_size=backup_config.get("compression_block_size_mb", 4) * 1024 * 1024
+    )
+
+
+def open_decompressed(path: str, key: bytes = None) -> BinaryIO:
+    """
+    Opens a backup file for reading its uncompressed content, based on its '.gz'/'.zst' and '.enc' suffixes.
+    :param path: Path to the backup file.
+    :param key: Master key of encrypted backups.
+    :return: Binary file object.
+    """
+    from src.pipeline.encryption import ENCRYPTED_SUFFIX, open_decrypted
+
+    if path.endswith(ENCRYPTED_SUFFIX):
+        if key is None:
+            raise ValueError(f"{os.path.basename(path)} is encrypted, configure the encryption key to read it.")
+        file = open_decrypted(path, key)
+        path = path[:-len(ENCRYPTED_SUFFIX)]
+    else:
+        file = open(path, "rb")
+    if path.endswith(COMPRESSION_SUFFIXES["gzip"]):
+        decompressed = gzip.GzipFile(fileobj=file, mode="rb")
+        # GzipFile only closes the files it opened itself
+        decompressed.myfileobj = file
+        return decompressed
+    if path.endswith(COMPRESSION_SUFFIXES["zstd"]):
+        try:
+            import zstandard
+        except ImportError:
+            file.close()
+            raise ValueError("zstd compression requires the 'zstandard' package (pip install zstandard).")
+        # Every block is its own frame
+        return zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True, closefd=True)
+    return file
@@ -0,0 +1,317 @@
+import base64
+import io
+import os
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+ENCRYPTED_SUFFIX = ".enc"
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+KEY_SIZE = 32
+# The header is the magic, the chunk size and the salt the file's key is derived with
+MAGIC = b"DBBKENC1"
+_SALT_SIZE = 16
+HEADER_SIZE = len(MAGIC) + 4 + _SALT_SIZE
+TAG_SIZE = 16
+_KEY_INFO = b"DB-BackupBot chunk encryption"
+
+
+def _aead(key: bytes, salt: bytes):
+    """
+    Returns the AES-256-GCM cipher of one file. Every file gets its own key derived from the master key and a random
+    salt, so the chunk numbers can be used as nonces without repeating a nonce under the same key.
+    """
+    try:
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    except ImportError:
+        raise ValueError("Encryption requires the 'cryptography' package (pip install cryptography).")
+    if len(key) != KEY_SIZE:
+        raise ValueError(f"The encryption key must be {KEY_SIZE} bytes, not {len(key)}.")
+    return AESGCM(HKDF(hashes.SHA256(), KEY_SIZE, salt, _KEY_INFO).derive(key))
+
+
+def _nonce_and_aad(header: bytes, index: int, final: bool) -> Tuple[bytes, bytes]:
+    # The header, the position and whether the chunk is the last one are authenticated, so chunks can't be
+    # reordered, mixed between files or cut off at a chunk boundary
+    return index.to_bytes(12, "big"), header + index.to_bytes(8, "big") + (b"\x01" if final else b"\x00")
+
+
+class ChunkEncryptor:
+    """
+    Encrypts a chunk stream with AES-256-GCM in fixed-size chunks, on a thread pool like the BlockCompressor.
+    Every chunk is authenticated on its own, so a file can be decrypted from any chunk on (see open_decrypted).
+    The encrypted stream is the header followed by the chunks, each chunk_size bytes plus a 16 byte tag,
+    the last one may be shorter.
+    """
+
+    def __init__(self, key: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE, threads: int = 0):
+        """
+        :param key: 32 byte master key, see load_key.
+        :param chunk_size: Number of plaintext bytes encrypted as one chunk.
+        :param threads: Number of encryption threads, 0 uses one per CPU core.
+        """
+        salt = os.urandom(_SALT_SIZE)
+        self._aead = _aead(key, salt)
+        self.header = MAGIC + struct.pack(">I", chunk_size) + salt
+        self.chunk_size = chunk_size
+        self.threads = threads or os.cpu_count() or 1
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Seconds spent encrypting, summed over the threads
+        self.duration = 0.0
+        self._lock = threading.Lock()
+        # State of update() and finalize()
+        self._buffer = bytearray()
+        self._index = 0
+        self._header_written = False
+
+    def encrypt_chunk(self, index: int, chunk: bytes, final: bool) -> bytes:
+        """
+        Encrypts the chunk at the index, for callers that schedule the chunks themselves. Thread-safe.
+        """
+        start = time.monotonic()
+        nonce, aad = _nonce_and_aad(self.header, index, final)
+        encrypted = self._aead.encrypt(nonce, chunk, aad)
+        with self._lock:
+            self.duration += time.monotonic() - start
+        return encrypted
+
+    def _chunks(self, chunks: Iterator[bytes]) -> Iterator[Tuple[bytes, bool]]:
+        # A full chunk is only passed on once more data follows, so the last chunk can be marked as final.
+        # An empty stream becomes one empty final chunk.
+        buffer = bytearray()
+        for data in chunks:
+            buffer += data
+            while len(buffer) > self.chunk_size:
+                yield bytes(buffer[:self.chunk_size]), False
+                del buffer[:self.chunk_size]
+        yield bytes(buffer), True
+
+    def encrypt(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Encrypts the stream, yielding the header and then the encrypted chunks in input order.
+        At most two chunks per thread are in flight, so memory stays bounded.
+        :param chunks: Iterator of plaintext byte chunks.
+        :return: Iterator of the encrypted stream.
+        """
+        self.bytes_out += len(self.header)
+        yield self.header
+        if self.threads == 1:
+            for index, (chunk, final) in enumerate(self._chunks(chunks)):
+                self.bytes_in += len(chunk)
+                encrypted = self.encrypt_chunk(index, chunk, final)
+                self.bytes_out += len(encrypted)
+                yield encrypted
+        else:
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="encrypt") as executor:
+                for index, (chunk, final) in enumerate(self._chunks(chunks)):
+                    self.bytes_in += len(chunk)
+                    pending.append(executor.submit(self.encrypt_chunk, index, chunk, final))
+                    if len(pending) >= self.threads * 2:
+                        encrypted = pending.popleft().result()
+                        self.bytes_out += len(encrypted)
+                        yield encrypted
+                while pending:
+                    encrypted = pending.popleft().result()
+                    self.bytes_out += len(encrypted)
+                    yield encrypted
+
+    def update(self, data: bytes) -> bytes:
+        """
+        Encrypts the next part of the stream in the calling thread, for pipelines that write the data themselves.
+        Call finalize() after the last part.
+        :return: The encrypted bytes that are complete so far, including the header on the first call.
+        """
+        output = bytearray()
+        if not self._header_written:
+            output += self.header
+            self._header_written = True
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) > self.chunk_size:
+            output += self.encrypt_chunk(self._index, bytes(self._buffer[:self.chunk_size]), False)
+            del self._buffer[:self.chunk_size]
+            self._index += 1
+        self.bytes_out += len(output)
+        return bytes(output)
+
+    def finalize(self) -> bytes:
+        """
+        :return: The last encrypted chunk.
+        """
+        output = self.update(b"")
+        final = self.encrypt_chunk(self._index, bytes(self._buffer), True)
+        self._buffer.clear()
+        self.bytes_out += len(final)
+        return output + final
+
+    @property
+    def throughput(self) -> float:
+        """
+        Plaintext MB per second of one encryption thread.
+        """
+        return self.bytes_in / (1024 * 1024) / self.duration if self.duration else 0.0
+
+    def summary(self) -> str:
+        return (f"Encryption (AES-256-GCM): {self.bytes_in / (1024 * 1024):.1f} MB in {self.chunk_size // 1024} KB "
+                f"chunks, {self.duration:.2f}s of encryption at {self.throughput:.1f} MB/s")
+
+
+class DecryptingReader(io.RawIOBase):
+    """
+    Reads the plaintext of an encrypted file. Seeking only decrypts the chunk the new position is in,
+    e.g. to read single members of an uncompressed tar archive.
+    """
+
+    def __init__(self, path: str, key: bytes):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            header = self._file.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+                raise ValueError(f"{path} is not an encrypted backup.")
+            self._header = header
+            self._chunk_size = struct.unpack(">I", header[len(MAGIC):len(MAGIC) + 4])[0]
+            self._aead = _aead(key, header[len(MAGIC) + 4:])
+            payload = os.fstat(self._file.fileno()).st_size - HEADER_SIZE
+            stored_chunk = self._chunk_size + TAG_SIZE
+            self._chunks = max(1, -(-payload // stored_chunk))
+            last_chunk = payload - (self._chunks - 1) * stored_chunk
+            if last_chunk < TAG_SIZE:
+                raise ValueError(f"{path} is truncated.")
+            self._size = (self._chunks - 1) * self._chunk_size + last_chunk - TAG_SIZE
+        except BaseException:
+            self._file.close()
+            raise
+        self._position = 0
+        self._cached: Tuple[int, Optional[bytes]] = (-1, None)
+
+    @property
+    def size(self) -> int:
+        """
+        Size of the plaintext.
+        """
+        return self._size
+
+    @property
+    def chunk_size(self) -> int:
+        return self._chunk_size
+
+    def _chunk(self, index: int) -> bytes:
+        if self._cached[0] == index:
+            return self._cached[1]
+        from cryptography.exceptions import InvalidTag
+
+        self._file.seek(HEADER_SIZE + index * (self._chunk_size + TAG_SIZE))
+        stored = self._file.read(self._chunk_size + TAG_SIZE)
+        nonce, aad = _nonce_and_aad(self._header, index, index == self._chunks - 1)
+        try:
+            chunk = self._aead.decrypt(nonce, stored, aad)
+        except InvalidTag:
+            raise ValueError(f"Chunk {index} of {self.path} can't be authenticated, the file is corrupted or "
+                             f"truncated, or the key is wrong.") from None
+        self._cached = (index, chunk)
+        return chunk
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position.")
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer) -> int:
+        if self._position >= self._size:
+            return 0
+        index, offset = divmod(self._position, self._chunk_size)
+        data = self._chunk(index)[offset:offset + len(buffer)]
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def open_decrypted(path: str, key: bytes) -> BinaryIO:
+    """
+    Opens an encrypted backup for reading its plaintext, every chunk is authenticated before it is returned.
+    :param path: Path to the encrypted file.
+    :param key: 32 byte master key the file was encrypted with.
+    :return: Seekable binary file object.
+    :raises ValueError: If the file isn't encrypted, or a chunk that is read can't be authenticated.
+    """
+    reader = DecryptingReader(path, key)
+    return io.BufferedReader(reader, buffer_size=reader.chunk_size)
+
+
+def load_key(path: str) -> bytes:
+    """
+    Reads a master key, the file contains the base64 encoded key or its 32 raw bytes.
+    :raises ValueError: If the file doesn't contain a key.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) == KEY_SIZE:
+        return data
+    try:
+        key = base64.b64decode(data.strip(), validate=True)
+    except ValueError:
+        key = b""
+    if len(key) != KEY_SIZE:
+        raise ValueError(f"{path} doesn't contain a base64 encoded {KEY_SIZE} byte key.")
+    return key
+
+
+def generate_key_file(path: str):
+    """
+    Writes a new random master key to the file, readable only by the current user.
+    :raises FileExistsError: If the file exists, an existing key is never overwritten.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(base64.b64encode(os.urandom(KEY_SIZE)) + b"\n")
+
+
+def create_encryptor(backup_config: dict) -> Optional[ChunkEncryptor]:
+    """
+    Creates the encryption stage configured in the backup configuration, a new one for every backup.
+    :param backup_config: Backup configuration.
+    :return: ChunkEncryptor or None if encryption is disabled.
+    """
+    key_file = backup_config.get("encryption_key_file", "")
+    if not key_file:
+        return None
+    return ChunkEncryptor(
+        load_key(key_file),
+        chunk_size=backup_config.get("encryption_chunk_size_kb", 1024) * 1024,
+        threads=backup_config.get("encryption_threads", 0)
+    )
+
+
+def encryption_key(backup_config: dict) -> Optional[bytes]:
+    """
+    Returns the master key configured in the backup configuration, None if encryption is disabled.
+    """
+    key_file = backup_config.get("encryption_key_file", "")
+    return load_key(key_file) if key_file else None
@@ -0,0 +1,252 @@
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+
+# Shortest time between two progress events of the same stage, so listeners aren't flooded
+REPORT_INTERVAL = 0.1
+
+STAGE_DUMP = "dump"
+STAGE_UPLOAD = "upload"
+# Sent once a backup run ended, successful or not
+STAGE_DONE = "done"
+
+
+class BackupCancelled(Exception):
+    """Raised inside a running backup after cancellation.cancel() was called."""
+
+
+@dataclass
+class ProgressEvent:
+    job: str
+    stage: str
+    done: int = 0
+    # None if the size isn't known in advance, e.g. of a database dump
+    total: Optional[int] = None
+    # Bytes per second since the stage started
+    rate: float = 0.0
+    finished: bool = False
+    destination: Optional[str] = None
+
+    @property
+    def fraction(self) -> Optional[float]:
+        return min(1.0, self.done / self.total) if self.total else None
+
+    @property
+    def eta(self) -> Optional[float]:
+        """
+        Seconds until the stage is done, None if the total isn't known.
+        """
+        if not self.total or not self.rate:
+            return None
+        return max(0.0, (self.total - self.done) / self.rate)
+
+
+class Cancellation:
+    """
+    Cancels the running backups. Progress updates raise BackupCancelled in the worker threads,
+    and registered dump processes are killed, so even a dump that doesn't write anything stops at once.
+    Single jobs can be cancelled too, e.g. when they time out, only their progress updates raise then.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._processes = set()
+        self._jobs = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+
+    def reset(self):
+        self._event.clear()
+
+    def cancel_job(self, job: str):
+        with self._lock:
+            self._jobs.add(job)
+
+    def reset_job(self, job: str):
+        with self._lock:
+            self._jobs.discard(job)
+
+    def is_cancelled(self, job: Optional[str] = None) -> bool:
+        """
+        :return: True if the backups were cancelled, or the given job.
+        """
+        if self._event.is_set():
+            return True
+        with self._lock:
+            return job in self._jobs
+
+    def check(self, job: Optional[str] = None):
+        """
+        :raises BackupCancelled: If the backups were cancelled, or the given job.
+        """
+        if self.is_cancelled(job):
+            raise BackupCancelled("The backup was cancelled.")
+
+    @contextmanager
+    def process(self, process: subprocess.Popen):
+        """
+        Kills the process if the backups are cancelled while the with block runs.
+        """
+        with self._lock:
+            self._processes.add(process)
+        try:
+            if self.cancelled and process.poll() is None:
+                process.kill()
+            yield process
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+
+
+cancellation = Cancellation()
+
+
+class ProgressTracker:
+    """
+    Progress of one stage of a backup. update() can be called for every chunk, events are only
+    sent every REPORT_INTERVAL seconds and once more by finish().
+    Every update checks for cancellation, so loops that report progress stop when the backup is cancelled.
+    """
+
+    def __init__(self, reporter: "ProgressReporter", job: str, stage: str, total: Optional[int] = None,
+                 destination: Optional[str] = None):
+        self.reporter = reporter
+        self.event = ProgressEvent(job, stage, total=total, destination=destination)
+        self._start = time.monotonic()
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def _report(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_report < REPORT_INTERVAL:
+            return
+        self._last_report = now
+        elapsed = now - self._start
+        self.event.rate = self.event.done / elapsed if elapsed > 0 else 0.0
+        self.reporter.emit(ProgressEvent(**vars(self.event)))
+
+    def update(self, done: int, total: Optional[int] = None):
+        """
+        Sets the number of bytes done.
+        :raises BackupCancelled: If the backups or the job were cancelled.
+        """
+        cancellation.check(self.event.job)
+        with self._lock:
+            self.event.done = done
+            if total is not None:
+                self.event.total = total
+            self._report()
+
+    def add(self, count: int):
+        """
+        Adds to the number of bytes done, can be called from several threads.
+        :raises BackupCancelled: If the backups or the job were cancelled.
+        """
+        cancellation.check(self.event.job)
+        with self._lock:
+            self.event.done += count
+            self._report()
+
+    def wrap(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Reports the bytes of the chunks passing through.
+        """
+        for chunk in chunks:
+            self.add(len(chunk))
+            yield chunk
+
+    def finish(self):
+        with self._lock:
+            self.event.finished = True
+            self._report(force=True)
+
+
+class ProgressReporter:
+    """
+    Sends the progress of the running backups to the listeners, e.g. the UI.
+    Listeners are called in the thread of the backup and must return quickly.
+    """
+
+    def __init__(self):
+        self._listeners: List[Callable[[ProgressEvent], None]] = []
+        # Last event of every running backup
+        self._latest: Dict[str, ProgressEvent] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, listener: Callable[[ProgressEvent], None]):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[ProgressEvent], None]):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def emit(self, event: ProgressEvent):
+        with self._lock:
+            if event.stage == STAGE_DONE:
+                self._latest.pop(event.job, None)
+            else:
+                self._latest[event.job] = event
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"Error in progress listener: {e}")
+
+    def running(self) -> Dict[str, ProgressEvent]:
+        """
+        Returns the last event of every backup that is running, by job name.
+        """
+        with self._lock:
+            return dict(self._latest)
+
+    def tracker(self, job: str, stage: str, total: Optional[int] = None,
+                destination: Optional[str] = None) -> ProgressTracker:
+        return ProgressTracker(self, job, stage, total, destination)
+
+    def done(self, job: str):
+        self.emit(ProgressEvent(job, STAGE_DONE, finished=True))
+
+
+progress = ProgressReporter()
+
+
+def wait_for_process(process: subprocess.Popen, poll: Callable[[], None] = None) -> int:
+    """
+    Waits for a process that can be cancelled, calling poll every REPORT_INTERVAL seconds, e.g. to report
+    the size of the file it writes.
+    :return: Return code of the process.
+    :raises BackupCancelled: If the backups were cancelled, the process is killed.
+    """
+    with cancellation.process(process):
+        try:
+            while True:
+                try:
+                    returncode = process.wait(timeout=REPORT_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    if poll is not None:
+                        poll()
+        except BaseException:
+            # poll raised, e.g. BackupCancelled after the job was cancelled
+            process.kill()
+            process.wait()
+            raise
+    cancellation.check()
+    return returncode
@@ -0,0 +1,250 @@
+import os
+import queue
+import subprocess
+import tarfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+from src.pipeline.progress import cancellation
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+
+# Sentinels pushed through the sink queues after the last chunk
+_EOF = object()
+_ABORT = object()
+
+
+class PipelineAborted(Exception):
+    """Raised inside a sink when the dump failed and the partial stream must be discarded."""
+
+
+class StreamSink:
+    """
+    Base class for a destination that consumes the dump stream in its own worker thread.
+    Subclasses implement consume() and, if they leave partial data behind, discard().
+    """
+    name = "sink"
+
+    def consume(self, chunks: Iterator[bytes]):
+        """
+        Consumes the dump stream.
+        :param chunks: Iterator of byte chunks. Raises PipelineAborted if the dump failed.
+        """
+        raise NotImplementedError
+
+    def discard(self):
+        """
+        Removes whatever a failed or aborted consume() left behind.
+        """
+
+
+class LocalFileSink(StreamSink):
+    """
+    Writes the stream to a local file. The data goes to '<path>.part' and is only renamed
+    to its final name once the dump finished successfully.
+    """
+    name = "local"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.part_path = f"{path}.part"
+
+    def consume(self, chunks: Iterator[bytes]):
+        with open(self.part_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(self.part_path, self.path)
+
+    def discard(self):
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+
+@dataclass
+class StreamResult:
+    returncode: Optional[int] = None
+    bytes_read: int = 0
+    bytes_written: int = 0
+    duration: float = 0.0
+    sink_errors: Dict[str, Exception] = field(default_factory=dict)
+
+    @property
+    def succeeded(self) -> bool:
+        return self.returncode == 0 and not self.sink_errors
+
+
+class _SinkWorker:
+    """
+    Feeds one sink from a bounded queue. A slow sink fills its queue and blocks the producer,
+    so the slowest destination sets the pace and memory stays at buffer_size at most.
+    """
+
+    def __init__(self, sink: StreamSink, max_chunks: int):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=f"stream-sink-{sink.name}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, item):
+        # A sink that died must not block the producer, so keep checking while waiting for space
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def join(self):
+        self.thread.join()
+
+    def _chunks(self) -> Iterator[bytes]:
+        while True:
+            item = self.queue.get()
+            if item is _EOF:
+                return
+            if item is _ABORT:
+                raise PipelineAborted("The dump process failed, discarding the partial stream.")
+            yield item
+
+    def _run(self):
+        try:
+            self.sink.consume(self._chunks())
+        except Exception as e:
+            self.error = e
+            try:
+                self.sink.discard()
+            except Exception as discard_error:
+                print(f"Error cleaning up {self.sink.name} destination: {discard_error}")
+
+
+def _read_chunks(stream, chunk_size: int) -> Iterator[bytes]:
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _run_pipeline(source: Iterator[bytes], sinks: List[StreamSink], chunk_size: int, buffer_size: int,
+                  transforms: Sequence[Callable[[Iterator[bytes]], Iterator[bytes]]],
+                  finish: Callable[[], int], cancel: Callable[[], None],
+                  progress: Callable[[int], None] = None) -> StreamResult:
+    max_chunks = max(1, buffer_size // chunk_size)
+    workers = [_SinkWorker(sink, max_chunks) for sink in sinks]
+    result = StreamResult()
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+
+    def _counted(chunks: Iterator[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            result.bytes_read += len(chunk)
+            if progress is not None:
+                progress(result.bytes_read)
+            yield chunk
+
+    stream = _counted(source)
+    for transform in transforms:
+        stream = transform(stream)
+
+    try:
+        for chunk in stream:
+            result.bytes_written += len(chunk)
+            for worker in workers:
+                worker.put(chunk)
+        result.returncode = finish()
+    except BaseException:
+        cancel()
+        for worker in workers:
+            worker.put(_ABORT)
+        for worker in workers:
+            worker.join()
+        raise
+
+    final = _EOF if result.returncode == 0 else _ABORT
+    for worker in workers:
+        worker.put(final)
+    for worker in workers:
+        worker.join()
+        if worker.error is not None and not isinstance(worker.error, PipelineAborted):
+            result.sink_errors[worker.sink.name] = worker.error
+
+    result.duration = time.monotonic() - start
+    return result
+
+
+def run_stream_pipeline(command: List[str], env: Optional[dict], sinks: List[StreamSink],
+                        chunk_size: int = DEFAULT_CHUNK_SIZE, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                        transforms: Sequence[Callable[[Iterator[bytes]], Iterator[bytes]]] = (),
+                        progress: Callable[[int], None] = None) -> StreamResult:
+    """
+    Runs the dump command with its stdout connected to all sinks at once.
+    Every chunk is handed to each sink through a bounded queue, so the dump never has to be staged on disk.
+    :param command: Dump command that writes the backup to stdout.
+    :param env: Environment variables for the dump command.
+    :param sinks: Destinations that consume the stream concurrently.
+    :param chunk_size: Number of bytes read from the dump process at once.
+    :param buffer_size: Upper bound for the bytes buffered between the dump process and the slowest sink.
+    :param transforms: Stages (e.g. compression) applied in order to the dump output before it reaches the sinks.
+    :param progress: Called with the number of bytes read from the dump so far.
+    :return: StreamResult with the return code, the number of bytes streamed and the errors per sink.
+    """
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE)
+
+    def _cancel():
+        process.kill()
+        process.wait()
+
+    # Cancelling kills the dump, which ends the stream like a failed dump
+    try:
+        with cancellation.process(process):
+            return _run_pipeline(_read_chunks(process.stdout, chunk_size), sinks, chunk_size, buffer_size,
+                                 transforms, finish=process.wait, cancel=_cancel, progress=progress)
+    finally:
+        process.stdout.close()
+
+
+def run_source_pipeline(source: Iterator[bytes], sinks: List[StreamSink],
+                        chunk_size: int = DEFAULT_CHUNK_SIZE, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                        transforms: Sequence[Callable[[Iterator[bytes]], Iterator[bytes]]] = (),
+                        progress: Callable[[int], None] = None) -> StreamResult:
+    """
+    Streams the chunks of an iterator (e.g. an archive of a dump directory) to all sinks at once.
+    If the iterator raises, the sinks discard the partial stream and the exception is re-raised.
+    :param progress: Called with the number of bytes read from the iterator so far.
+    :return: StreamResult with return code 0, the number of bytes streamed and the errors per sink.
+    """
+    return _run_pipeline(source, sinks, chunk_size, buffer_size, transforms, finish=lambda: 0, cancel=lambda: None,
+                         progress=progress)
+
+
+def tar_stream(directory: str, arcname: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Packs a directory into an uncompressed tar archive on the fly, without writing the archive to disk.
+    :param directory: Directory to pack.
+    :param arcname: Name of the directory inside the archive.
+    :param chunk_size: Number of bytes read from the files at once.
+    :return: Iterator of the archive's bytes.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            info = tarfile.TarInfo(os.path.join(arcname, os.path.relpath(path, directory)).replace(os.sep, "/"))
+            stat = os.stat(path)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = 0o644
+            yield info.tobuf(format=tarfile.PAX_FORMAT)
+            with open(path, "rb") as f:
+                yield from iter(lambda: f.read(chunk_size), b"")
+            if info.size % tarfile.BLOCKSIZE:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    # End of archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
@@ -0,0 +1,368 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import List, Optional
+
+from src.db.database_backup import (BackupJob, complete_backup, create_checksum_stage, create_compressor,
+                                    create_db_dump, delete_old_backups, encrypt_backup_file, expected_dump_size,
+                                    finish_run, get_backup_file_name, get_dump_command, get_parallel_jobs,
+                                    get_sqlite_signature, get_stream_command, hash_file, print_compression_summary,
+                                    print_encryption_summary, remove_backup_file, run_backup, use_encryption,
+                                    use_native_sqlite, write_manifest)
+from src.pipeline.encryption import create_encryptor
+from src.db.sqlite_backup import change_tracker
+from src.pipeline.progress import REPORT_INTERVAL, STAGE_DUMP, BackupCancelled, cancellation, progress
+from src.service.job_engine import DEFAULT_MAX_CONCURRENT_DUMPS, DEFAULT_MAX_DUMPS_PER_HOST, JobEngine
+from src.service.metrics import metrics
+
+DEFAULT_IO_WORKERS = 16
+
+
+def _kill(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        process.kill()
+
+
+async def _wait_for_dump(process: asyncio.subprocess.Process, dump_path: str, tracker) -> int:
+    """
+    Waits for a dump tool that writes the backup file itself, reporting the size of the file.
+    """
+    while True:
+        try:
+            return await asyncio.wait_for(process.wait(), REPORT_INTERVAL)
+        except asyncio.TimeoutError:
+            if os.path.exists(dump_path):
+                tracker.update(os.path.getsize(dump_path))
+
+
+async def dump_to_file(job: BackupJob, executor: ThreadPoolExecutor) -> str:
+    """
+    Dumps the database into a file in the backup path, like create_db_dump but without blocking the event loop.
+    The dump tool writes the file itself, its exit is awaited.
+    :param job: Backup job.
+    :param executor: Executor for the blocking file and catalog work.
+    :return: Path to the backup file, it doesn't exist if the dump failed.
+    """
+    loop = asyncio.get_running_loop()
+    dump_path = os.path.join(job.backup['backup_path'], get_backup_file_name(job))
+    await loop.run_in_executor(executor, delete_old_backups, job)
+
+    _dump_command, _env = get_dump_command(job, dump_path)
+    tracker = progress.tracker(job.name, STAGE_DUMP, expected_dump_size(job))
+    process = await asyncio.create_subprocess_exec(*_dump_command, env=_env)
+    try:
+        returncode = await _wait_for_dump(process, dump_path, tracker)
+    except BaseException:
+        # Cancelled, timed out or BackupCancelled from the progress. The cleanup happens before the next await,
+        # which could be interrupted by another cancellation.
+        _kill(process)
+        remove_backup_file(dump_path)
+        await process.wait()
+        raise
+    if returncode != 0:
+        print(f"Error while creating backup: Command '{_dump_command[0]}' returned non-zero exit status {returncode}.")
+        return dump_path
+    tracker.update(os.path.getsize(dump_path))
+    tracker.finish()
+    if use_encryption(job):
+        dump_path = await loop.run_in_executor(executor, encrypt_backup_file, job, dump_path)
+    else:
+        checksum = await loop.run_in_executor(executor, hash_file, dump_path, job.backup.get("fast_hash", "none"))
+        write_manifest(dump_path, checksum.manifest(os.path.basename(dump_path)))
+    print(f"Successfully created backup: {dump_path}")
+    return dump_path
+
+
+async def stream_to_file(job: BackupJob, executor: ThreadPoolExecutor) -> Optional[str]:
+    """
+    Reads the dump output from stdout as an async stream, compresses it block by block in the executor, encrypts it
+    and writes it to the backup path, like create_compressed_db_dump but without a thread per dump.
+    :param job: Backup job.
+    :param executor: Executor for the compression, encryption, hashing and writing.
+    :return: Path to the backup file or None if the database type can't be dumped to stdout.
+    """
+    try:
+        _dump_command, _env = get_stream_command(job)
+    except ValueError:
+        print(f"Compression and encryption on the fly are not supported for database type: {job.db['type']}")
+        return None
+
+    loop = asyncio.get_running_loop()
+    compressor = create_compressor(job.backup)
+    encryptor = create_encryptor(job.backup)
+    checksum = create_checksum_stage(job.backup)
+    dump_path = os.path.join(job.backup['backup_path'],
+                             get_backup_file_name(job, compressor.algorithm if compressor else "none",
+                                                  encrypted=encryptor is not None))
+    part_path = f"{dump_path}.part"
+    await loop.run_in_executor(executor, delete_old_backups, job)
+
+    def _store(file, data: bytes, final: bool = False):
+        # The blocks arrive in order, so they are encrypted in the writing thread
+        if encryptor:
+            data = encryptor.finalize() if final else encryptor.update(data)
+        checksum.add(data)
+        file.write(data)
+
+    tracker = progress.tracker(job.name, STAGE_DUMP, expected_dump_size(job))
+    chunk_size = job.backup.get("stream_chunk_size_kb", 1024) * 1024
+    block_size = compressor.block_size if compressor else chunk_size
+    # Blocks being compressed, in output order, at most two per compression thread
+    max_pending = compressor.threads * 2 if compressor else 1
+    pending = deque()
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_exec(*_dump_command, env=_env, stdout=asyncio.subprocess.PIPE)
+    try:
+        with open(part_path, "wb") as file:
+            async def write_next():
+                compressed = await pending.popleft()
+                if compressor:
+                    compressor.bytes_out += len(compressed)
+                await loop.run_in_executor(executor, _store, file, compressed)
+
+            def compress(block: bytes):
+                if compressor:
+                    compressor.bytes_in += len(block)
+                    pending.append(loop.run_in_executor(executor, compressor.compress_block, block))
+                else:
+                    uncompressed = loop.create_future()
+                    uncompressed.set_result(block)
+                    pending.append(uncompressed)
+
+            buffer = bytearray()
+            read = 0
+            while chunk := await process.stdout.read(chunk_size):
+                read += len(chunk)
+                tracker.update(read)
+                buffer += chunk
+                while len(buffer) >= block_size:
+                    compress(bytes(buffer[:block_size]))
+                    del buffer[:block_size]
+                    if len(pending) >= max_pending:
+                        await write_next()
+            if buffer:
+                compress(bytes(buffer))
+            while pending:
+                await write_next()
+            if encryptor:
+                await loop.run_in_executor(executor, _store, file, b"", True)
+        returncode = await process.wait()
+    except BaseException:
+        _kill(process)
+        for future in pending:
+            future.cancel()
+        remove_backup_file(part_path)
+        await process.wait()
+        raise
+    if compressor:
+        compressor.duration = time.monotonic() - start
+    tracker.finish()
+    if returncode != 0:
+        remove_backup_file(part_path)
+        print(f"Error while creating backup: dump process exited with code {returncode}")
+        return dump_path
+    os.replace(part_path, dump_path)
+    write_manifest(dump_path, checksum.manifest(os.path.basename(dump_path)))
+    print(f"Successfully created backup: {dump_path}")
+    if compressor:
+        print_compression_summary(job, compressor)
+    if encryptor:
+        print_encryption_summary(job, encryptor)
+    return dump_path
+
+
+class _JobExecutor(Executor):
+    """
+    Hands the blocking work of one job to the shared executor and keeps track of it. Work that already started can't
+    be interrupted, so a job that times out or is cancelled waits for it before it frees its slots.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor):
+        self._executor = executor
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = self._executor.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+
+    @property
+    def running(self) -> bool:
+        with self._lock:
+            return bool(self._futures)
+
+    async def wait(self):
+        """
+        Waits until all work of the job in the executor ended, its errors are ignored.
+        """
+        with self._lock:
+            futures = [asyncio.wrap_future(future) for future in self._futures]
+        await asyncio.gather(*futures, return_exceptions=True)
+
+
+class AsyncJobEngine(JobEngine):
+    """
+    Runs the backup jobs as tasks on one asyncio event loop instead of a thread per job, so a single process
+    can keep dozens of backups in flight. Dump tools run as asyncio subprocesses and their output is read
+    as async streams. The blocking work (compression, uploads with paramiko and requests, the catalog) runs
+    in a bounded executor.
+    Streaming backups and parallel dumps have thread pipelines, they run in the executor as a whole.
+    Scheduling, limits, reload and drain work like in JobEngine.
+    """
+
+    def __init__(self, jobs: List[BackupJob], max_concurrent_dumps: int = DEFAULT_MAX_CONCURRENT_DUMPS,
+                 max_dumps_per_host: int = DEFAULT_MAX_DUMPS_PER_HOST, io_workers: int = DEFAULT_IO_WORKERS):
+        """
+        :param io_workers: Threads of the executor for the blocking work of all jobs.
+        """
+        super().__init__(jobs, max_concurrent_dumps, max_dumps_per_host)
+        self.io_workers = io_workers
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _wake(self):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    def submit(self, job: BackupJob) -> bool:
+        submitted = super().submit(job)
+        if submitted:
+            self._wake()
+        return submitted
+
+    def set_limits(self, max_concurrent_dumps: int, max_dumps_per_host: int):
+        super().set_limits(max_concurrent_dumps, max_dumps_per_host)
+        self._wake()
+
+    def _cancel_running(self):
+        with self._condition:
+            tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+
+    async def _dispatch(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            with self._condition:
+                while not self._stopped and (job := self._next_runnable()) is not None:
+                    self._host_counts[job.db_host] += 1
+                    queued_at = self._queued_at.pop(job.name, None)
+                    if queued_at is not None:
+                        metrics.observe("queue_wait_seconds", time.monotonic() - queued_at, job=job.name)
+                    self._running[job.name] = asyncio.create_task(self._run(job), name=f"job-{job.name}")
+
+    async def _backup(self, job: BackupJob, executor: _JobExecutor) -> bool:
+        loop = asyncio.get_running_loop()
+        if job.backup.get("use_streaming", False) or get_parallel_jobs(job) > 1:
+            return await loop.run_in_executor(executor, run_backup, job)
+        signature = get_sqlite_signature(job)
+        if change_tracker.unchanged(job.name, signature):
+            print(f"Skipping backup of {job.name}, the database didn't change since the last backup.")
+            return True
+        dump_start = time.monotonic()
+        dump_path = None
+        if job.backup.get("compression", "none").casefold() != "none" or use_encryption(job):
+            dump_path = await stream_to_file(job, executor)
+        if dump_path is None and use_native_sqlite(job):
+            # The online backup API copies the database in the executor, it doesn't run a dump tool
+            dump_path = await loop.run_in_executor(executor, create_db_dump, job)
+        if dump_path is None:
+            dump_path = await dump_to_file(job, executor)
+        succeeded = await loop.run_in_executor(executor, complete_backup, job, dump_path,
+                                               time.monotonic() - dump_start)
+        if succeeded:
+            change_tracker.backed_up(job.name, signature)
+        return succeeded
+
+    async def _run(self, job: BackupJob):
+        start = time.monotonic()
+        succeeded = False
+        cancelled = False
+        timeout = job.backup.get("job_timeout_minutes", 0) * 60 or None
+        executor = _JobExecutor(self._executor)
+        try:
+            succeeded = await asyncio.wait_for(self._backup(job, executor), timeout)
+        except asyncio.TimeoutError:
+            print(f"Backup job {job.name} timed out after {timeout / 60:g} minutes.")
+        except (asyncio.CancelledError, BackupCancelled):
+            cancelled = True
+        except Exception as e:
+            print(f"Backup job {job.name} failed: {e}")
+        finally:
+            # Work in the executor isn't stopped by the timeout or the task's cancellation. Its progress updates raise
+            # BackupCancelled from now on, and the job keeps its slots until it ended.
+            if executor.running:
+                cancellation.cancel_job(job.name)
+                print(f"Waiting for the backup job {job.name} to stop.")
+                await executor.wait()
+            cancellation.reset_job(job.name)
+            finish_run(job, start, succeeded, cancelled or cancellation.cancelled)
+            with self._condition:
+                del self._running[job.name]
+                self._host_counts[job.db_host] -= 1
+                self._condition.notify_all()
+            self._wakeup.set()
+
+    async def _finish(self):
+        """
+        Waits for the running jobs, and for the queued ones when draining. They are cancelled if the backups
+        were cancelled, e.g. by stop_service(cancel=True).
+        """
+        cancelled = False
+        while True:
+            if cancellation.cancelled and not cancelled:
+                # Only once, a second cancellation would interrupt the cleanup of the jobs
+                self._cancel_running()
+                cancelled = True
+            with self._condition:
+                if not self._draining:
+                    self._pending.clear()
+                    self._queued_at.clear()
+                tasks = list(self._running.values())
+                if not tasks and not self._pending:
+                    self._stopped = True
+                    return
+            if tasks:
+                await asyncio.wait(tasks, timeout=REPORT_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                # Queued jobs wait for a free slot
+                await asyncio.sleep(REPORT_INTERVAL)
+
+    async def _main(self):
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        dispatcher = asyncio.create_task(self._dispatch())
+        # Jobs queued before the loop started
+        self._wakeup.set()
+        try:
+            # The scheduler sleeps in its own thread until the next due job
+            await asyncio.to_thread(self.scheduler.run)
+            await self._finish()
+        finally:
+            dispatcher.cancel()
+
+    def run(self):
+        """
+        Schedules every job and runs the due ones on an event loop until shutdown() or drain() is called.
+        """
+        for job in self.jobs.values():
+            self._schedule(job)
+        self._executor = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="backup-io")
+        try:
+            asyncio.run(self._main())
+        finally:
+            self._loop = None
+            self._executor.shutdown(wait=False)
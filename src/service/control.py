@@ -0,0 +1,141 @@
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+from typing import Callable, Dict, Optional
+
+# Seconds a client waits for the service to answer
+DEFAULT_TIMEOUT = 5.0
+# Longest request line the service reads
+MAX_REQUEST_SIZE = 4096
+
+
+class ControlError(Exception):
+    """Raised by a command handler, the message is sent back to the client."""
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    server: "ControlServer"
+
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_SIZE).decode(errors="replace").strip()
+        if not line:
+            return
+        command, *args = line.split()
+        handler = self.server.commands.get(command)
+        if handler is None:
+            response = {"ok": False, "error": f"Unknown command '{command}', "
+                                              f"expected one of: {', '.join(sorted(self.server.commands))}"}
+        else:
+            try:
+                response = {"ok": True, **(handler(*args) or {})}
+            except ControlError as e:
+                response = {"ok": False, "error": str(e)}
+            except Exception as e:
+                print(f"Error running control command {command}: {e}")
+                response = {"ok": False, "error": str(e)}
+        self.wfile.write(json.dumps(response, default=str).encode() + b"\n")
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class ControlServer(socketserver.ThreadingUnixStreamServer):
+        """
+        Answers control commands on a Unix domain socket. A request is one line, the command followed by its
+        arguments separated by spaces, e.g. 'run-now mydb'. The response is one line of JSON with 'ok' and either
+        the result of the command or an 'error'.
+        """
+        daemon_threads = True
+
+        def __init__(self, path: str, commands: Dict[str, Callable[..., Optional[dict]]]):
+            """
+            :param path: Path of the socket file.
+            :param commands: Handler of every command, called with the arguments of the request.
+            """
+            self.path = path
+            self.commands = commands
+            super().__init__(path, _ControlHandler, bind_and_activate=False)
+            try:
+                self.server_bind()
+                # Only the user running the service may control it. Nobody can connect before listen(), so the
+                # socket is never open to other users.
+                os.chmod(path, 0o600)
+                self.server_activate()
+            except BaseException:
+                self.server_close()
+                raise
+
+        def server_close(self):
+            super().server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+else:
+    ControlServer = None
+
+
+def send_command(path: str, command: str, timeout: float = DEFAULT_TIMEOUT) -> dict:
+    """
+    Sends a control command to the running service.
+    :param path: Path of the service's socket file.
+    :param command: Command line, e.g. 'status' or 'run-now mydb'.
+    :param timeout: Seconds to wait for the answer.
+    :return: Response of the service.
+    :raises ConnectionError: If no service listens on the socket.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise ConnectionError("Unix domain sockets are not supported on this platform.")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        try:
+            client.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise ConnectionError(f"No backup service is listening on {path}.") from e
+        client.sendall(command.encode() + b"\n")
+        with client.makefile("rb") as response:
+            line = response.readline()
+    if not line:
+        raise ConnectionError("The backup service closed the connection without an answer.")
+    return json.loads(line)
+
+
+def default_socket_path() -> str:
+    """
+    Returns the path of the control socket in the user's runtime directory, or in a directory of the user in the
+    temp directory if there is none.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        user = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "")
+        runtime_dir = os.path.join(tempfile.gettempdir(), f"db-backupbot-{user}")
+    return os.path.join(runtime_dir, "backup_service.sock")
+
+
+def start_control_server(path: str, commands: Dict[str, Callable[..., Optional[dict]]]) -> Optional[ControlServer]:
+    """
+    Answers control commands on a Unix domain socket in a background thread. A socket file left behind by a
+    service that didn't exit cleanly is replaced.
+    :param path: Path of the socket file.
+    :param commands: Handler of every command.
+    :return: The running server, stop it with shutdown() and server_close(). None if the platform has no
+        Unix domain sockets or another service already listens on the socket.
+    """
+    if ControlServer is None:
+        print("Unix domain sockets are not supported on this platform, the control socket is disabled.")
+        return None
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    # A directory in the shared temp directory could have been created by another user to intercept the commands
+    if hasattr(os, "getuid") and os.stat(directory).st_uid != os.getuid():
+        print(f"{directory} belongs to another user, the control socket is disabled.")
+        return None
+    if os.path.exists(path):
+        try:
+            send_command(path, "ping", timeout=1.0)
+            print(f"Another backup service is listening on {path}, the control socket is disabled.")
+            return None
+        except (ConnectionError, OSError, ValueError):
+            os.remove(path)
+    server = ControlServer(path, {"ping": lambda: None, **commands})
+    threading.Thread(target=server.serve_forever, name="control-server", daemon=True).start()
+    return server
@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Dict, List
+
+from src.db.database_backup import BackupJob, scheduled_backup
+from src.service.metrics import metrics
+from src.service.scheduler import Scheduler, create_trigger
+
+DEFAULT_MAX_CONCURRENT_DUMPS = 4
+DEFAULT_MAX_DUMPS_PER_HOST = 1
+
+
+def load_jobs(jobs_config: dict, defaults: dict) -> List[BackupJob]:
+    """
+    Creates the backup jobs listed in the jobs configuration.
+    Every section of a job ('db', 'backup', 'api', 'ssh') only needs the settings that differ
+    from the default configuration files.
+    :param jobs_config: Jobs configuration with a 'jobs' list.
+    :param defaults: Default configurations as returned by load_all_configs.
+    :return: List of backup jobs.
+    """
+    jobs = []
+    for target in jobs_config.get("jobs", []):
+        sections = {section: {**defaults[section], **target.get(section, {})}
+                    for section in ("db", "backup", "api", "ssh")}
+        jobs.append(BackupJob.from_configs(
+            sections,
+            name=target.get("name"),
+            send_to_api=target.get("send_to_api", sections["api"].get("use_api", False)),
+            send_to_server=target.get("send_to_server", sections["ssh"].get("use_ssh", False)),
+            use_local_backup=target.get("use_local_backup", sections["backup"].get("use_local_backup", False))
+        ))
+    names = [job.name for job in jobs]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Job names must be unique: {', '.join(sorted(duplicates))}")
+    return jobs
+
+
+class JobEngine:
+    """
+    Runs backup jobs in a shared worker pool. A due job is queued and started as soon as both a global
+    slot (max_concurrent_dumps) and a slot on its database host (max_dumps_per_host) are free,
+    so a busy host doesn't block jobs on other hosts. A job that is still queued or running isn't queued twice.
+    """
+
+    def __init__(self, jobs: List[BackupJob], max_concurrent_dumps: int = DEFAULT_MAX_CONCURRENT_DUMPS,
+                 max_dumps_per_host: int = DEFAULT_MAX_DUMPS_PER_HOST,
+                 run_job: Callable[[BackupJob], None] = scheduled_backup):
+        self.jobs = {job.name: job for job in jobs}
+        self.max_concurrent_dumps = max_concurrent_dumps
+        self.max_dumps_per_host = max_dumps_per_host
+        self.run_job = run_job
+        self._pending = deque()
+        # Time each pending job was queued, for the queue wait metric
+        self._queued_at: Dict[str, float] = {}
+        self._running: Dict[str, threading.Thread] = {}
+        self._host_counts = Counter()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._draining = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name="job-dispatcher", daemon=True)
+        self.scheduler = Scheduler()
+
+    def submit(self, job: BackupJob) -> bool:
+        """
+        Queues a run of the job.
+        :return: False if the job is already queued or running or the engine is draining.
+        """
+        with self._condition:
+            if self._draining or job.name in self._running or any(pending.name == job.name for pending in self._pending):
+                return False
+            self._pending.append(job)
+            self._queued_at[job.name] = time.monotonic()
+            self._condition.notify_all()
+            return True
+
+    def _next_runnable(self):
+        if len(self._running) >= self.max_concurrent_dumps:
+            return None
+        for job in self._pending:
+            if self._host_counts[job.db_host] < self.max_dumps_per_host:
+                self._pending.remove(job)
+                return job
+        return None
+
+    def _dispatch(self):
+        with self._condition:
+            while not self._stopped:
+                job = self._next_runnable()
+                if job is None:
+                    self._condition.wait()
+                    continue
+                self._host_counts[job.db_host] += 1
+                queued_at = self._queued_at.pop(job.name, None)
+                if queued_at is not None:
+                    metrics.observe("queue_wait_seconds", time.monotonic() - queued_at, job=job.name)
+                worker = threading.Thread(target=self._run, args=(job,), name=f"job-{job.name}", daemon=True)
+                self._running[job.name] = worker
+                worker.start()
+
+    def _run(self, job: BackupJob):
+        try:
+            self.run_job(job)
+        except Exception as e:
+            print(f"Backup job {job.name} failed: {e}")
+        finally:
+            with self._condition:
+                del self._running[job.name]
+                self._host_counts[job.db_host] -= 1
+                self._condition.notify_all()
+
+    def status(self) -> dict:
+        with self._condition:
+            status = {"running": sorted(self._running), "queued": [job.name for job in self._pending],
+                      "draining": self._draining}
+        status["next_runs"] = {name: self.scheduler.next_run(name) for name in sorted(self.jobs)}
+        return status
+
+    def start(self):
+        self._dispatcher.start()
+
+    def stop(self, wait: bool = True, drain: bool = False):
+        """
+        Stops dispatching queued jobs. Running jobs finish their current backup.
+        :param wait: Wait for the running jobs to finish.
+        :param drain: Run the queued jobs before stopping.
+        """
+        with self._condition:
+            while drain and self._pending and self._dispatcher.is_alive():
+                self._condition.wait()
+            self._stopped = True
+            self._pending.clear()
+            self._queued_at.clear()
+            workers = list(self._running.values())
+            self._condition.notify_all()
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _schedule(self, job: BackupJob):
+        try:
+            trigger = create_trigger(job.backup)
+        except ValueError as e:
+            print(f"Job {job.name} is not scheduled: {e}")
+            self.scheduler.remove(job.name)
+            return
+        entry = self.scheduler.get(job.name)
+        # Keep the next run time of jobs whose schedule didn't change
+        due = entry.due if entry and entry.trigger == trigger else None
+        self.scheduler.add(job.name, trigger, lambda: self.submit(self.jobs[job.name]), due=due)
+        next_run = trigger.next_after(time.time())
+        metrics.set("job_interval_seconds", trigger.next_after(next_run) - next_run, job=job.name)
+        print(f"Scheduled job {job.name} {trigger}, next run at {self.scheduler.next_run(job.name):%Y-%m-%d %H:%M:%S}")
+
+    def set_limits(self, max_concurrent_dumps: int, max_dumps_per_host: int):
+        """
+        Changes the number of dump slots, queued jobs start as soon as the new limits allow it.
+        """
+        with self._condition:
+            self.max_concurrent_dumps = max_concurrent_dumps
+            self.max_dumps_per_host = max_dumps_per_host
+            self._condition.notify_all()
+
+    def run_now(self, name: str) -> bool:
+        """
+        Queues a run of the job immediately, without changing its schedule.
+        :return: False if there is no job with that name.
+        """
+        return self.scheduler.run_now(name)
+
+    def reload(self, jobs: List[BackupJob]):
+        """
+        Replaces the jobs without restarting the service. Jobs with an unchanged schedule keep their next run time.
+        :param jobs: The new list of backup jobs.
+        """
+        new_jobs = {job.name: job for job in jobs}
+        for name in set(self.jobs) - set(new_jobs):
+            self.scheduler.remove(name)
+        self.jobs = new_jobs
+        for job in jobs:
+            self._schedule(job)
+
+    def shutdown(self):
+        """
+        Wakes up and ends run() immediately.
+        """
+        self.scheduler.stop()
+
+    def drain(self):
+        """
+        Ends run() once the queued and running jobs are done. No new runs are queued meanwhile.
+        """
+        with self._condition:
+            self._draining = True
+        self.scheduler.stop()
+
+    def run(self):
+        """
+        Schedules every job on its interval or cron expression and dispatches due runs until shutdown() is called.
+        The scheduler sleeps until the next due job, so an idle service doesn't use any CPU.
+        """
+        for job in self.jobs.values():
+            self._schedule(job)
+        self.start()
+        self.scheduler.run()
+        self.stop(drain=self._draining)
@@ -0,0 +1,175 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, Optional, Tuple
+
+PREFIX = "dbbackup_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds, from quick SQLite dumps up to backups that take hours
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Name: (type, help)
+METRICS = {
+    "runs_total": (COUNTER, "Backup runs per job and result."),
+    "last_success_timestamp_seconds": (GAUGE, "Time of the last successful backup run."),
+    "job_interval_seconds": (GAUGE, "Time between two scheduled runs of the job."),
+    "queue_wait_seconds": (HISTOGRAM, "Time a due job waited for a free dump slot."),
+    "backup_duration_seconds": (HISTOGRAM, "Duration of the whole backup run."),
+    "dump_duration_seconds": (HISTOGRAM, "Duration of the dump, including compression when it is streamed."),
+    "dump_bytes": (GAUGE, "Size of the last backup in bytes."),
+    "dump_bytes_total": (COUNTER, "Bytes of all backups."),
+    "compression_ratio": (GAUGE, "Compression ratio of the last backup."),
+    "compression_throughput_bytes_per_second": (GAUGE, "Uncompressed bytes per second of the last compression."),
+    "encryption_seconds": (GAUGE, "Seconds spent encrypting the last backup, summed over the threads."),
+    "upload_duration_seconds": (HISTOGRAM, "Duration of the upload per destination."),
+    "upload_throughput_bytes_per_second": (GAUGE, "Throughput of the last upload per destination."),
+    "uploads_total": (COUNTER, "Uploads per destination and status."),
+    "retention_duration_seconds": (HISTOGRAM, "Duration of the retention run."),
+    "verification_duration_seconds": (HISTOGRAM, "Duration of the backup verification."),
+    "verifications_total": (COUNTER, "Backup verifications per result."),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Labels, extra: Tuple[str, str] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-memory store of the service metrics, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, list]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _check(name: str, metric_type: str):
+        if METRICS.get(name, (None,))[0] != metric_type:
+            raise ValueError(f"Unknown {metric_type} metric: {name}")
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._check(name, COUNTER)
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            key = _labels(labels)
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self._check(name, GAUGE)
+        with self._lock:
+            self._values.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        self._check(name, HISTOGRAM)
+        with self._lock:
+            # Bucket counts, then sum and count
+            histogram = self._histograms.setdefault(name, {}).setdefault(
+                _labels(labels), [0] * len(DURATION_BUCKETS) + [0.0, 0])
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """
+        Observes the duration of the with block in a histogram.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def get(self, name: str, **labels) -> Optional[float]:
+        with self._lock:
+            return self._values.get(name, {}).get(_labels(labels))
+
+    def get_histogram(self, name: str, **labels) -> Optional[Tuple[float, int]]:
+        """
+        Returns the sum and count of a histogram.
+        """
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(_labels(labels))
+            return (histogram[-2], histogram[-1]) if histogram else None
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in METRICS.items():
+                full_name = PREFIX + name
+                values = self._values.get(name)
+                histograms = self._histograms.get(name)
+                if not values and not histograms:
+                    continue
+                lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {metric_type}")
+                for labels, value in sorted((values or {}).items()):
+                    lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+                for labels, histogram in sorted((histograms or {}).items()):
+                    for bound, count in zip(DURATION_BUCKETS, histogram):
+                        lines.append(f"{full_name}_bucket{_format_labels(labels, ('le', _format_value(bound)))} {count}")
+                    lines.append(f"{full_name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram[-1]}")
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(histogram[-2])}")
+                    lines.append(f"{full_name}_count{_format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the console
+        pass
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serves the metrics on http://<host>:<port>/metrics in a background thread.
+    :param host: Address to listen on, e.g. 127.0.0.1.
+    :param port: Port to listen on.
+    :return: The running server, stop it with shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
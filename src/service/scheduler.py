@@ -0,0 +1,183 @@
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+
+class IntervalTrigger:
+    """
+    Fires every interval_minutes, the first time one interval after it was scheduled.
+    """
+
+    def __init__(self, interval_minutes: float):
+        if interval_minutes <= 0:
+            raise ValueError("The interval must be greater than 0 minutes.")
+        self.interval = interval_minutes * 60
+
+    def next_after(self, timestamp: float) -> float:
+        return timestamp + self.interval
+
+    def __eq__(self, other):
+        return isinstance(other, IntervalTrigger) and other.interval == self.interval
+
+    def __str__(self):
+        return f"every {self.interval / 60:g} minutes"
+
+
+class CronTrigger:
+    """
+    Fires at the times of a cron expression.
+    """
+
+    def __init__(self, cron_expression: str):
+        from croniter import croniter
+
+        if not croniter.is_valid(cron_expression):
+            raise ValueError(f"Invalid cron expression: {cron_expression}")
+        self.cron_expression = cron_expression
+
+    def next_after(self, timestamp: float) -> float:
+        from croniter import croniter
+
+        return croniter(self.cron_expression, datetime.fromtimestamp(timestamp)).get_next(float)
+
+    def __eq__(self, other):
+        return isinstance(other, CronTrigger) and other.cron_expression == self.cron_expression
+
+    def __str__(self):
+        return f"with cron expression: {self.cron_expression}"
+
+
+def create_trigger(backup_config: dict):
+    """
+    Creates the trigger configured in a backup configuration.
+    :param backup_config: Backup configuration with interval_minutes or use_cron and cron_expression.
+    :raises ValueError: If the cron expression or the interval is invalid.
+    """
+    if backup_config.get("use_cron"):
+        return CronTrigger(backup_config.get("cron_expression", ""))
+    return IntervalTrigger(backup_config["interval_minutes"])
+
+
+class _Entry:
+    def __init__(self, name: str, trigger, callback: Callable[[], None], due: float):
+        self.name = name
+        self.trigger = trigger
+        self.callback = callback
+        self.due = due
+        self.cancelled = False
+
+
+class Scheduler:
+    """
+    Timer heap scheduler. The scheduler thread sleeps on a condition variable exactly until the next
+    due entry across all jobs, so it doesn't wake up while nothing is due.
+    Adding, removing or running an entry now and stopping notify the condition and take effect immediately.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries: Dict[str, _Entry] = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def _push(self, entry: _Entry):
+        heapq.heappush(self._heap, (entry.due, next(self._sequence), entry))
+
+    def add(self, name: str, trigger, callback: Callable[[], None], due: Optional[float] = None):
+        """
+        Schedules a callback, replacing an existing entry with the same name.
+        :param name: Unique name of the entry, e.g. the job name.
+        :param trigger: IntervalTrigger or CronTrigger.
+        :param callback: Called in the scheduler thread when the entry is due, must not block.
+        :param due: Timestamp of the first run, defaults to the trigger's next time.
+        """
+        with self._condition:
+            if name in self._entries:
+                self._entries[name].cancelled = True
+            entry = _Entry(name, trigger, callback, due if due is not None else trigger.next_after(time.time()))
+            self._entries[name] = entry
+            self._push(entry)
+            self._condition.notify_all()
+
+    def remove(self, name: str):
+        with self._condition:
+            entry = self._entries.pop(name, None)
+            if entry:
+                # Cancelled entries are dropped when they reach the top of the heap
+                entry.cancelled = True
+                self._condition.notify_all()
+
+    def get(self, name: str) -> Optional[_Entry]:
+        with self._condition:
+            return self._entries.get(name)
+
+    def next_run(self, name: str) -> Optional[datetime]:
+        entry = self.get(name)
+        return datetime.fromtimestamp(entry.due) if entry else None
+
+    def run_now(self, name: str) -> bool:
+        """
+        Runs an entry immediately, its regular schedule stays the same.
+        :return: False if no entry with that name exists.
+        """
+        with self._condition:
+            entry = self._entries.get(name)
+            if entry is None:
+                return False
+            self._push(_Entry(name, None, entry.callback, time.time()))
+            self._condition.notify_all()
+            return True
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    def _pop_due(self) -> Optional[_Entry]:
+        """
+        Waits until an entry is due or the scheduler is stopped.
+        """
+        with self._condition:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, _sequence, entry = self._heap[0]
+                if entry.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                delay = due - time.time()
+                if delay > 0:
+                    self._condition.wait(timeout=delay)
+                    continue
+                heapq.heappop(self._heap)
+                if entry.trigger is not None:
+                    now = time.time()
+                    entry.due = entry.trigger.next_after(entry.due)
+                    if entry.due <= now:
+                        # Don't catch up on runs that were missed, e.g. while the machine was suspended
+                        entry.due = entry.trigger.next_after(now)
+                    self._push(entry)
+                return entry
+            return None
+
+    def run(self):
+        """
+        Calls the due callbacks until stop() is called.
+        """
+        while True:
+            entry = self._pop_due()
+            if entry is None:
+                return
+            try:
+                entry.callback()
+            except Exception as e:
+                print(f"Error running scheduled {entry.name}: {e}")
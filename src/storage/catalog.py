@@ -0,0 +1,277 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+CATALOG_FILE_NAME = "catalog.db"
+
+STORAGE_FILE = "file"
+STORAGE_REPOSITORY = "repository"
+# Backups that were only sent to the API or the SSH server
+STORAGE_REMOTE = "remote"
+
+STATUS_COMPLETE = "complete"
+STATUS_FAILED = "failed"
+# Kept on disk for the moment (e.g. an upload is still reading it), removed by the next retention run
+STATUS_EXPIRED = "expired"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    name TEXT NOT NULL,
+    storage TEXT NOT NULL,
+    path TEXT,
+    created REAL NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    checksum TEXT,
+    destinations TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    verification TEXT,
+    verification_details TEXT NOT NULL DEFAULT '{}',
+    verified REAL,
+    UNIQUE (job, storage, name)
+);
+CREATE INDEX IF NOT EXISTS backups_by_job ON backups (job, storage, created);
+"""
+# Period of a backup per retention bucket, in local time like RetentionPolicy.expired. The weekly period is the
+# Thursday of the ISO week, so a week that spans two years is still one period.
+_PERIODS = {
+    "hourly": "strftime('%Y%m%d%H', created, 'unixepoch', 'localtime')",
+    "daily": "strftime('%Y%m%d', created, 'unixepoch', 'localtime')",
+    "weekly": "date(created, 'unixepoch', 'localtime', '-3 days', 'weekday 4')",
+    "monthly": "strftime('%Y%m', created, 'unixepoch', 'localtime')",
+}
+# Keeps the newest backups and the newest backup of each of the newest periods, see RetentionPolicy
+_KEPT = f"""
+SELECT id FROM (
+    SELECT id, ROW_NUMBER() OVER (ORDER BY created DESC) AS newest,
+        {", ".join(f"ROW_NUMBER() OVER (PARTITION BY {period} ORDER BY created DESC) AS {name}_newest, "
+                   f"DENSE_RANK() OVER (ORDER BY {period} DESC) AS {name}_period" for name, period in _PERIODS.items())}
+    FROM backups WHERE job = :job AND storage = :storage AND status = '{STATUS_COMPLETE}'
+) WHERE newest <= :keep_last
+    {" ".join(f"OR ({name}_newest = 1 AND {name}_period <= :{name})" for name in _PERIODS)}
+"""
+# Columns added after the first version of the catalog, with their definition
+_MIGRATIONS = {
+    "verification": "TEXT",
+    "verification_details": "TEXT NOT NULL DEFAULT '{}'",
+    "verified": "REAL",
+}
+
+
+@dataclass
+class CatalogEntry:
+    id: int
+    job: str
+    name: str
+    storage: str
+    path: Optional[str]
+    created: float
+    size: int = 0
+    checksum: Optional[str] = None
+    destinations: Dict[str, str] = field(default_factory=dict)
+    status: str = STATUS_COMPLETE
+    verification: Optional[str] = None
+    verification_details: dict = field(default_factory=dict)
+    verified: Optional[float] = None
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    Grandfather-father-son retention: the newest keep_last backups are kept, and for each of the
+    last hourly/daily/weekly/monthly periods that contain a backup, the newest backup of that period.
+    """
+    keep_last: int = 5
+    hourly: int = 0
+    daily: int = 0
+    weekly: int = 0
+    monthly: int = 0
+
+    @classmethod
+    def from_config(cls, backup_config: dict) -> "RetentionPolicy":
+        return cls(
+            keep_last=backup_config.get("max_backup_files", 5),
+            hourly=backup_config.get("retention_hourly", 0),
+            daily=backup_config.get("retention_daily", 0),
+            weekly=backup_config.get("retention_weekly", 0),
+            monthly=backup_config.get("retention_monthly", 0)
+        )
+
+    def expired(self, entries: List[CatalogEntry]) -> List[CatalogEntry]:
+        """
+        Returns the entries the policy doesn't keep. Failed and expired entries are never kept.
+        :param entries: Catalog entries of one job and storage.
+        """
+        complete = sorted((entry for entry in entries if entry.status == STATUS_COMPLETE),
+                          key=lambda entry: entry.created, reverse=True)
+        keep = {entry.id for entry in complete[:max(self.keep_last, 0)]}
+        # ISO week, so a week that spans two years is still one period
+        for period_format, count in (("%Y%m%d%H", self.hourly), ("%Y%m%d", self.daily),
+                                     ("%G%V", self.weekly), ("%Y%m", self.monthly)):
+            periods = set()
+            for entry in complete:
+                period = datetime.fromtimestamp(entry.created).strftime(period_format)
+                if period in periods:
+                    continue
+                if len(periods) >= count:
+                    break
+                periods.add(period)
+                keep.add(entry.id)
+        return [entry for entry in entries if entry.id not in keep]
+
+
+class BackupCatalog:
+    """
+    SQLite index of all backups with their job, time, size, checksum, destinations and status.
+    Listing and retention read the index of one job instead of scanning and sorting the backup folder.
+    Every call uses its own connection, so the catalog can be shared by the jobs running in parallel.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(backups)")}
+            for column, definition in _MIGRATIONS.items():
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE backups ADD COLUMN {column} {definition}")
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _execute(self, sql: str, parameters=()) -> List[sqlite3.Row]:
+        with self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    return connection.execute(sql, parameters).fetchall()
+            finally:
+                connection.close()
+
+    @staticmethod
+    def _entry(row: sqlite3.Row) -> CatalogEntry:
+        values = dict(row)
+        values["destinations"] = json.loads(values["destinations"])
+        values["verification_details"] = json.loads(values["verification_details"])
+        return CatalogEntry(**values)
+
+    def record(self, job: str, name: str, storage: str, path: Optional[str] = None, size: int = 0,
+               checksum: Optional[str] = None, destinations: Dict[str, str] = None,
+               status: str = STATUS_COMPLETE, created: Optional[float] = None):
+        """
+        Adds a backup to the catalog or updates the entry with the same job, storage and name.
+        :param job: Name of the backup job.
+        :param name: Name of the backup, e.g. the file name.
+        :param storage: STORAGE_FILE, STORAGE_REPOSITORY or STORAGE_REMOTE.
+        :param path: Path of the backup file.
+        :param size: Size of the backup in bytes.
+        :param checksum: Checksum of the backup.
+        :param destinations: Status of the backup per destination, e.g. {"ssh": "success"}.
+        :param status: STATUS_COMPLETE, STATUS_FAILED or STATUS_EXPIRED.
+        :param created: Timestamp of the backup, defaults to now.
+        """
+        self._execute(
+            "INSERT INTO backups (job, name, storage, path, created, size, checksum, destinations, status) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (job, storage, name) DO UPDATE SET path = excluded.path, size = excluded.size, "
+            "checksum = excluded.checksum, destinations = excluded.destinations, status = excluded.status",
+            (job, name, storage, path, created if created is not None else time.time(), size, checksum,
+             json.dumps(destinations or {}), status)
+        )
+
+    def list_backups(self, job: str, storage: Optional[str] = None) -> List[CatalogEntry]:
+        """
+        Returns the backups of a job, oldest first.
+        :param job: Name of the backup job.
+        :param storage: Only return backups of this storage.
+        """
+        if storage is None:
+            rows = self._execute("SELECT * FROM backups WHERE job = ? ORDER BY created", (job,))
+        else:
+            rows = self._execute("SELECT * FROM backups WHERE job = ? AND storage = ? ORDER BY created",
+                                 (job, storage))
+        return [self._entry(row) for row in rows]
+
+    def set_verification(self, job: str, storage: str, name: str, status: str, details: dict):
+        """
+        Records the result of a backup verification.
+        :param job: Name of the backup job.
+        :param storage: Storage of the backup.
+        :param name: Name of the backup.
+        :param status: Result of the verification, e.g. 'passed' or 'failed'.
+        :param details: Result of every check and the measured values, e.g. the number of rows.
+        """
+        self._execute(
+            "UPDATE backups SET verification = ?, verification_details = ?, verified = ? "
+            "WHERE job = ? AND storage = ? AND name = ?",
+            (status, json.dumps(details), time.time(), job, storage, name)
+        )
+
+    def last_verified(self, job: str, status: str) -> Optional[CatalogEntry]:
+        """
+        Returns the newest backup of a job whose verification ended with the status.
+        """
+        rows = self._execute("SELECT * FROM backups WHERE job = ? AND verification = ? ORDER BY created DESC LIMIT 1",
+                             (job, status))
+        return self._entry(rows[0]) if rows else None
+
+    def has_backups(self, job: str, storage: Optional[str] = None) -> bool:
+        if storage is None:
+            return bool(self._execute("SELECT 1 FROM backups WHERE job = ? LIMIT 1", (job,)))
+        return bool(self._execute("SELECT 1 FROM backups WHERE job = ? AND storage = ? LIMIT 1", (job, storage)))
+
+    def remove(self, entries: Iterable[CatalogEntry]):
+        ids = [(entry.id,) for entry in entries]
+        with self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany("DELETE FROM backups WHERE id = ?", ids)
+            finally:
+                connection.close()
+
+    def expired(self, job: str, storage: str, policy: RetentionPolicy) -> List[CatalogEntry]:
+        """
+        Returns the backups of a job that the retention policy doesn't keep, like RetentionPolicy.expired.
+        SQLite selects the kept backups from the job's rows of the index, only the expired ones are read.
+        """
+        rows = self._execute(
+            f"SELECT * FROM backups WHERE job = :job AND storage = :storage AND id NOT IN ({_KEPT}) ORDER BY created",
+            {"job": job, "storage": storage, "keep_last": max(policy.keep_last, 0),
+             **{name: max(getattr(policy, name), 0) for name in _PERIODS}}
+        )
+        return [self._entry(row) for row in rows]
+
+
+_catalogs: Dict[str, BackupCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def open_catalog(backup_config: dict) -> BackupCatalog:
+    """
+    Opens the catalog in the backup path. The catalog of a path is shared by all jobs of the process, the schema is
+    only checked when it is opened for the first time.
+    :param backup_config: Backup configuration.
+    """
+    path = os.path.realpath(os.path.join(backup_config["backup_path"], CATALOG_FILE_NAME))
+    with _catalogs_lock:
+        catalog = _catalogs.get(path)
+        # A catalog file that was deleted is created again
+        if catalog is None or not os.path.exists(path):
+            catalog = _catalogs[path] = BackupCatalog(path)
+        return catalog
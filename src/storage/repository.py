@@ -0,0 +1,356 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set
+
+from src.pipeline.stream import StreamSink
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_MIN_CHUNK_SIZE = 256 * 1024
+DEFAULT_AVG_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Chunk boundaries are only considered right after one of these bytes. Line ends and row/statement ends
+# are frequent in SQL dumps, so a boundary candidate shows up every few dozen bytes.
+_ANCHORS = re.compile(rb"[\n);]")
+# Bytes in front of a candidate that decide whether it becomes a boundary
+_WINDOW_SIZE = 48
+# Average distance between two boundary candidates, used to derive the mask for the target chunk size
+_ANCHOR_SPACING = 64
+
+
+class ContentDefinedChunker:
+    """
+    Splits a byte stream into chunks whose boundaries depend on the content, not on the offset.
+    An insert near the beginning of a dump only changes the chunks around it, all following chunks
+    stay identical and deduplicate against the previous backup.
+
+    Boundary candidates are found with a regular expression and a candidate becomes a boundary when the
+    CRC32 of the bytes in front of it matches the mask. Both run in C, so the chunker isn't limited
+    by a per-byte rolling hash loop in Python.
+    """
+
+    def __init__(self, min_size: int = DEFAULT_MIN_CHUNK_SIZE, avg_size: int = DEFAULT_AVG_CHUNK_SIZE,
+                 max_size: int = DEFAULT_MAX_CHUNK_SIZE):
+        if not _WINDOW_SIZE <= min_size <= avg_size <= max_size:
+            raise ValueError("Chunk sizes must satisfy min_size <= avg_size <= max_size.")
+        self.min_size = min_size
+        self.max_size = max_size
+        bits = max(0, (avg_size // _ANCHOR_SPACING).bit_length() - 1)
+        self.mask = (1 << bits) - 1
+
+    def _next_cut(self, buffer: bytearray, view: memoryview, start: int, end: int) -> int:
+        for match in _ANCHORS.finditer(buffer, start + self.min_size, end):
+            position = match.end()
+            if not zlib.crc32(view[position - _WINDOW_SIZE:position]) & self.mask:
+                return position
+        return end
+
+    def split(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Re-chunks a byte stream into content-defined chunks.
+        :param chunks: Iterator of byte chunks of any size.
+        :return: Iterator of content-defined chunks.
+        """
+        buffer = bytearray()
+        for data in chunks:
+            buffer += data
+            if len(buffer) < self.max_size:
+                continue
+            start = 0
+            with memoryview(buffer) as view:
+                while len(buffer) - start >= self.max_size:
+                    cut = self._next_cut(buffer, view, start, start + self.max_size)
+                    yield bytes(view[start:cut])
+                    start = cut
+            del buffer[:start]
+
+        start = 0
+        with memoryview(buffer) as view:
+            while start < len(buffer):
+                cut = self._next_cut(buffer, view, start, len(buffer))
+                yield bytes(view[start:cut])
+                start = cut
+
+
+class _RepositoryLock:
+    """
+    Lets any number of backups be stored at the same time, but the garbage collection only while none is stored.
+    A running store may have written chunks that no manifest references yet, or skipped chunks because they exist,
+    so the garbage collection would delete chunks its manifest is about to reference.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._stores = 0
+        self._collecting = False
+        # A garbage collection was skipped because backups were being stored
+        self.gc_pending = False
+
+    def acquire_store(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._collecting)
+            self._stores += 1
+
+    def release_store(self):
+        with self._condition:
+            self._stores -= 1
+
+    def try_acquire_collect(self) -> bool:
+        with self._condition:
+            if self._stores or self._collecting:
+                self.gc_pending = True
+                return False
+            self._collecting = True
+            self.gc_pending = False
+            return True
+
+    def release_collect(self):
+        with self._condition:
+            self._collecting = False
+            self._condition.notify_all()
+
+
+# Repositories are opened per backup, the jobs running in parallel share the lock of the same path
+_locks: Dict[str, _RepositoryLock] = {}
+_locks_lock = threading.Lock()
+
+
+def _repository_lock(path: str) -> _RepositoryLock:
+    with _locks_lock:
+        return _locks.setdefault(os.path.realpath(path), _RepositoryLock())
+
+
+@contextmanager
+def _file_lock(path: str, exclusive: bool, blocking: bool = True) -> Iterator[bool]:
+    """
+    Locks the lock file of a repository against other processes, e.g. a garbage collection started by hand while the
+    service stores a backup. Without fcntl (Windows) only the lock within the process protects the repository.
+    :param exclusive: Lock exclusively, for the garbage collection, instead of shared, for storing backups.
+    :param blocking: Wait for the lock. Otherwise False is yielded if another process holds it.
+    :return: Context manager that yields whether the lock is held.
+    """
+    if fcntl is None:
+        yield True
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+
+@dataclass
+class StoreResult:
+    name: str
+    size: int = 0
+    chunks: int = 0
+    new_chunks: int = 0
+    new_bytes: int = 0
+
+    @property
+    def dedup_ratio(self) -> float:
+        return self.size / self.new_bytes if self.new_bytes else float("inf")
+
+
+class BackupRepository:
+    """
+    Deduplicating backup repository. Every unique chunk is stored once under its SHA-256 in 'chunks/',
+    every backup is a manifest in 'manifests/' that lists its chunks in order. Chunks are written
+    before the manifest, so an interrupted backup only leaves unreferenced chunks behind,
+    which the next garbage collection removes. The garbage collection never runs while a backup is stored, also not
+    by another process, which is excluded through the lock file 'lock' of the repository.
+    """
+
+    def __init__(self, path: str, chunker: ContentDefinedChunker = None):
+        self.path = path
+        self.chunks_path = os.path.join(path, "chunks")
+        self.manifests_path = os.path.join(path, "manifests")
+        self.lock_path = os.path.join(path, "lock")
+        self.chunker = chunker or ContentDefinedChunker()
+        self._lock = _repository_lock(path)
+        os.makedirs(self.chunks_path, exist_ok=True)
+        os.makedirs(self.manifests_path, exist_ok=True)
+
+    def _chunk_path(self, digest: str) -> str:
+        return os.path.join(self.chunks_path, digest[:2], digest)
+
+    def _manifest_path(self, name: str) -> str:
+        return os.path.join(self.manifests_path, f"{name}.json")
+
+    def _write_chunk(self, digest: str, data: bytes) -> bool:
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Jobs storing the same chunk at the same time each write their own temporary file
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{digest}.", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return True
+
+    def store(self, name: str, chunks: Iterator[bytes]) -> StoreResult:
+        """
+        Stores a backup in the repository.
+        :param name: Name of the backup, usually the backup file name.
+        :param chunks: Iterator of the backup's bytes.
+        :return: StoreResult with the size of the backup and the number of new bytes written.
+        """
+        result = StoreResult(name)
+        references = []
+        self._lock.acquire_store()
+        try:
+            with _file_lock(self.lock_path, exclusive=False):
+                for chunk in self.chunker.split(chunks):
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    references.append([digest, len(chunk)])
+                    result.size += len(chunk)
+                    result.chunks += 1
+                    if self._write_chunk(digest, chunk):
+                        result.new_chunks += 1
+                        result.new_bytes += len(chunk)
+
+                manifest = {"name": name, "created": time.time(), "size": result.size, "chunks": references}
+                tmp_path = f"{self._manifest_path(name)}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(manifest, f)
+                os.replace(tmp_path, self._manifest_path(name))
+        finally:
+            self._lock.release_store()
+        return result
+
+    def store_file(self, name: str, path: str, read_size: int = DEFAULT_MAX_CHUNK_SIZE) -> StoreResult:
+        """
+        Stores an existing backup file in the repository.
+        """
+        with open(path, "rb") as f:
+            return self.store(name, iter(lambda: f.read(read_size), b""))
+
+    def load_manifest(self, name: str) -> dict:
+        with open(self._manifest_path(name), "r") as f:
+            return json.load(f)
+
+    def restore(self, name: str, target: BinaryIO):
+        """
+        Writes a backup from the repository into a file object.
+        :param name: Name of the backup.
+        :param target: Binary file object the backup is written to.
+        """
+        for digest, _size in self.load_manifest(name)["chunks"]:
+            with open(self._chunk_path(digest), "rb") as f:
+                target.write(f.read())
+
+    def list_backups(self, prefix: str = "") -> List[str]:
+        """
+        Returns the names of all backups starting with the prefix, oldest first.
+        Backup names end with their timestamp, so sorting by name sorts by age.
+        """
+        names = [f[:-len(".json")] for f in os.listdir(self.manifests_path) if f.endswith(".json")]
+        return sorted(name for name in names if name.startswith(prefix))
+
+    def delete_backup(self, name: str):
+        os.remove(self._manifest_path(name))
+
+    def _referenced_chunks(self) -> Set[str]:
+        referenced = set()
+        for name in self.list_backups():
+            referenced.update(digest for digest, _size in self.load_manifest(name)["chunks"])
+        return referenced
+
+    @property
+    def gc_pending(self) -> bool:
+        """
+        True if a garbage collection was skipped because backups were being stored.
+        """
+        return self._lock.gc_pending
+
+    def collect_garbage(self) -> Optional[int]:
+        """
+        Deletes all chunks that aren't referenced by any manifest, and temporary files of interrupted backups.
+        Backups can't be stored during the garbage collection. If a backup is being stored, by this or another
+        process, nothing is deleted and gc_pending is set, so a later call collects the garbage.
+        :return: Number of freed bytes, None if the garbage collection was skipped.
+        """
+        if not self._lock.try_acquire_collect():
+            return None
+        try:
+            with _file_lock(self.lock_path, exclusive=True, blocking=False) as locked:
+                if not locked:
+                    self._lock.gc_pending = True
+                    return None
+                referenced = self._referenced_chunks()
+                freed = 0
+                for directory in os.listdir(self.chunks_path):
+                    directory_path = os.path.join(self.chunks_path, directory)
+                    for chunk_file in os.listdir(directory_path):
+                        if chunk_file not in referenced:
+                            chunk_path = os.path.join(directory_path, chunk_file)
+                            freed += os.path.getsize(chunk_path)
+                            os.remove(chunk_path)
+                # Manifests of interrupted backups that were never renamed to their final name
+                for manifest_file in os.listdir(self.manifests_path):
+                    if manifest_file.endswith(".tmp"):
+                        manifest_path = os.path.join(self.manifests_path, manifest_file)
+                        freed += os.path.getsize(manifest_path)
+                        os.remove(manifest_path)
+                return freed
+        finally:
+            self._lock.release_collect()
+
+
+def create_chunker(backup_config: dict) -> ContentDefinedChunker:
+    """
+    Creates a chunker with the chunk sizes configured in the backup configuration.
+    :param backup_config: Backup configuration.
+    """
+    return ContentDefinedChunker(
+        min_size=backup_config.get("repository_min_chunk_kb", DEFAULT_MIN_CHUNK_SIZE // 1024) * 1024,
+        avg_size=backup_config.get("repository_avg_chunk_kb", DEFAULT_AVG_CHUNK_SIZE // 1024) * 1024,
+        max_size=backup_config.get("repository_max_chunk_kb", DEFAULT_MAX_CHUNK_SIZE // 1024) * 1024
+    )
+
+
+def open_repository(backup_config: dict) -> BackupRepository:
+    """
+    Opens the repository configured in the backup configuration, inside the backup path.
+    :param backup_config: Backup configuration.
+    """
+    return BackupRepository(os.path.join(backup_config["backup_path"], "repository"), create_chunker(backup_config))
+
+
+class RepositorySink(StreamSink):
+    """
+    Stores the dump stream in the deduplicating repository instead of a local backup file.
+    """
+    name = "repository"
+
+    def __init__(self, repository: BackupRepository, backup_name: str):
+        self.repository = repository
+        self.backup_name = backup_name
+
+    def consume(self, chunks: Iterator[bytes]):
+        result = self.repository.store(self.backup_name, chunks)
+        print(f"Stored {self.backup_name} in the repository: {result.size} bytes, "
+              f"{result.new_bytes} new bytes in {result.new_chunks} of {result.chunks} chunks")
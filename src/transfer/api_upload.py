@@ -0,0 +1,276 @@
+import base64
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Iterator, Optional
+
+import requests
+
+from src.pipeline.stream import StreamSink
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_RETRIES = 5
+TUS_VERSION = "1.0.0"
+
+# requests doesn't guarantee that a Session can be used by several threads at once, every thread gets its own
+_sessions = threading.local()
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the HTTP session of the calling thread, so the uploads of a job reuse keep-alive connections to the API.
+    """
+    session = getattr(_sessions, "session", None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    return session
+
+
+def _auth_headers(api_config: dict) -> dict:
+    headers = {}
+    if api_config.get('api_key'):
+        headers['Authorization'] = f"Bearer {api_config['api_key']}"
+    return headers
+
+
+def _multipart_head(file_name: str, boundary: str) -> bytes:
+    return (f"--{boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"file\"; filename=\"{file_name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode()
+
+
+def _multipart_tail(boundary: str) -> bytes:
+    return f"\r\n--{boundary}--\r\n".encode()
+
+
+def multipart_body(chunks: Iterator[bytes], file_name: str, boundary: str) -> Iterator[bytes]:
+    """
+    Wraps a byte stream in the same multipart/form-data body that requests builds for files={'file': f}.
+    """
+    yield _multipart_head(file_name, boundary)
+    yield from chunks
+    yield _multipart_tail(boundary)
+
+
+class MultipartFileReader:
+    """
+    File-like multipart/form-data body that reads the backup file while it is sent.
+    Its length is known up front, so the request gets a Content-Length and memory use stays flat.
+    http.client reads it in blocks of its own size.
+    """
+
+    def __init__(self, path: str, boundary: str, progress: Callable[[int], None] = None):
+        self._file = open(path, "rb")
+        self._parts = [_multipart_head(os.path.basename(path), boundary), None, _multipart_tail(boundary)]
+        self._length = len(self._parts[0]) + os.path.getsize(path) + len(self._parts[2])
+        self._index = 0
+        self._offset = 0
+        self._progress = progress
+        self._sent = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = DEFAULT_CHUNK_SIZE
+        while self._index < len(self._parts):
+            part = self._parts[self._index]
+            if part is None:
+                data = self._file.read(size)
+                if data:
+                    self._sent += len(data)
+                    if self._progress is not None:
+                        self._progress(self._sent)
+                    return data
+            elif self._offset < len(part):
+                data = part[self._offset:self._offset + size]
+                self._offset += len(data)
+                return data
+            self._index += 1
+            self._offset = 0
+        return b""
+
+    def close(self):
+        self._file.close()
+
+
+def stream_upload(api_config: dict, path: str, progress: Callable[[int], None] = None):
+    """
+    Uploads a backup file as multipart/form-data without loading it into memory.
+    :param api_config: API configuration.
+    :param path: Path to the backup file.
+    :param progress: Called with the number of bytes of the file sent so far.
+    :raises IOError: If the API didn't accept the upload.
+    """
+    boundary = uuid.uuid4().hex
+    headers = _auth_headers(api_config)
+    headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+    body = MultipartFileReader(path, boundary, progress)
+    try:
+        response = get_session().post(api_config['url'], headers=headers, data=body)
+    finally:
+        body.close()
+    if response.status_code != 200:
+        raise IOError(f"{response.status_code} - {response.text}")
+
+
+def upload_data(api_config: dict, file_name: str, data: bytes):
+    """
+    Uploads a small in-memory file, e.g. the manifest of a backup, as multipart/form-data.
+    :param api_config: API configuration.
+    :param file_name: File name sent to the API.
+    :param data: Content of the file.
+    :raises IOError: If the API didn't accept the upload.
+    """
+    response = get_session().post(api_config['url'], headers=_auth_headers(api_config),
+                                  files={'file': (file_name, data)})
+    if response.status_code != 200:
+        raise IOError(f"{response.status_code} - {response.text}")
+
+
+class ChunkedUpload:
+    """
+    Resumable upload following the tus 1.0 core protocol:
+    POST creates the upload, HEAD asks the server for the last committed offset and
+    every PATCH appends one chunk at that offset. After a connection error the upload continues
+    at the offset the server reports, and the upload URL is kept next to the backup in '<path>.upload',
+    so a later attempt resumes instead of starting from byte zero.
+    """
+
+    def __init__(self, api_config: dict, path: str, progress: Callable[[int], None] = None):
+        """
+        :param api_config: API configuration.
+        :param path: Path to the backup file.
+        :param progress: Called with the number of bytes the server committed so far.
+        """
+        self.api_config = api_config
+        self.path = path
+        self.progress = progress
+        self.size = os.path.getsize(path)
+        self.chunk_size = api_config.get("chunk_size_mb", 8) * 1024 * 1024
+        self.max_retries = api_config.get("max_retries", DEFAULT_MAX_RETRIES)
+        self.state_path = f"{path}.upload"
+        self.session = get_session()
+
+    def _headers(self, **extra) -> dict:
+        headers = _auth_headers(self.api_config)
+        headers["Tus-Resumable"] = TUS_VERSION
+        headers.update(extra)
+        return headers
+
+    def _load_location(self) -> Optional[str]:
+        try:
+            with open(self.state_path, "r") as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return state.get("location") if state.get("size") == self.size else None
+
+    def _create(self) -> str:
+        file_name = base64.b64encode(os.path.basename(self.path).encode()).decode()
+        response = self.session.post(
+            self.api_config['url'],
+            headers=self._headers(**{"Upload-Length": str(self.size), "Upload-Metadata": f"filename {file_name}"})
+        )
+        if response.status_code != 201 or "Location" not in response.headers:
+            raise IOError(f"Could not create upload: {response.status_code} - {response.text}")
+        location = requests.compat.urljoin(self.api_config['url'], response.headers["Location"])
+        with open(self.state_path, "w") as state_file:
+            json.dump({"location": location, "size": self.size}, state_file)
+        return location
+
+    def _committed_offset(self, location: str) -> Optional[int]:
+        response = self.session.head(location, headers=self._headers())
+        if response.status_code in (404, 410):
+            return None
+        if response.status_code not in (200, 204):
+            raise IOError(f"Could not read upload offset: {response.status_code}")
+        return int(response.headers["Upload-Offset"])
+
+    def _send_chunks(self, location: str, offset: int):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while offset < self.size:
+                chunk = f.read(self.chunk_size)
+                response = self.session.patch(
+                    location,
+                    headers=self._headers(**{"Upload-Offset": str(offset),
+                                             "Content-Type": "application/offset+octet-stream"}),
+                    data=chunk
+                )
+                if response.status_code != 204:
+                    raise IOError(f"Chunk at offset {offset} was rejected: {response.status_code} - {response.text}")
+                offset = int(response.headers["Upload-Offset"])
+                if self.progress is not None:
+                    self.progress(offset)
+                f.seek(offset)
+
+    def run(self):
+        """
+        Uploads the file, resuming from the server's committed offset after connection errors.
+        :raises IOError: If the upload failed after all retries.
+        """
+        location = self._load_location()
+        for attempt in range(self.max_retries + 1):
+            try:
+                offset = self._committed_offset(location) if location else None
+                if offset is None:
+                    location = self._create()
+                    offset = 0
+                elif offset:
+                    print(f"Resuming API upload at byte {offset} of {self.size}.")
+                self._send_chunks(location, offset)
+                break
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise IOError(f"Upload failed after {self.max_retries} retries: {e}")
+                # Back off before asking the server how far the upload got
+                time.sleep(min(2 ** attempt, 30))
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+
+def upload_file(api_config: dict, path: str, progress: Callable[[int], None] = None):
+    """
+    Uploads a backup file to the API using the configured upload mode.
+    :param api_config: API configuration.
+    :param path: Path to the backup file.
+    :param progress: Called with the number of bytes sent so far.
+    :raises IOError: If the upload failed.
+    """
+    mode = api_config.get("upload_mode", "stream").casefold()
+    match mode:
+        case "stream":
+            stream_upload(api_config, path, progress)
+        case "chunked":
+            ChunkedUpload(api_config, path, progress).run()
+        case _:
+            raise ValueError(f"Unsupported API upload mode: {mode}")
+
+
+class ApiStreamSink(StreamSink):
+    """
+    Sends the dump stream to the API as a multipart upload with chunked transfer encoding.
+    """
+    name = "api"
+
+    def __init__(self, api_config: dict, file_name: str):
+        self.api_config = api_config
+        self.file_name = file_name
+
+    def consume(self, chunks: Iterator[bytes]):
+        boundary = uuid.uuid4().hex
+        headers = _auth_headers(self.api_config)
+        headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+
+        response = get_session().post(
+            self.api_config['url'],
+            headers=headers,
+            data=multipart_body(chunks, self.file_name, boundary)
+        )
+        if response.status_code != 200:
+            raise IOError(f"{response.status_code} - {response.text}")
+        print("Backup successfully streamed to the API.")
@@ -0,0 +1,58 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+
+
+@dataclass
+class DestinationResult:
+    name: str
+    status: str
+    duration: float
+    error: Optional[Exception] = None
+
+
+def run_destinations(destinations: Dict[str, Callable[[], Optional[bool]]],
+                     timeout: Optional[float] = None) -> List[DestinationResult]:
+    """
+    Runs all destination uploads in parallel worker threads, so a run takes as long as its slowest upload.
+    :param destinations: Upload callables by destination name. A callable fails by raising or returning False.
+    :param timeout: Seconds to wait for all uploads, None waits forever.
+    :return: One DestinationResult per destination, in the order of the given destinations.
+    """
+    if not destinations:
+        return []
+
+    start = time.monotonic()
+    finished_at = {}
+
+    def _run(name, upload):
+        try:
+            return upload()
+        finally:
+            finished_at[name] = time.monotonic()
+
+    executor = ThreadPoolExecutor(max_workers=len(destinations), thread_name_prefix="destination")
+    futures = {name: executor.submit(_run, name, upload) for name, upload in destinations.items()}
+    wait(futures.values(), timeout=timeout)
+    # Don't block on uploads that exceeded the timeout, their threads finish in the background
+    executor.shutdown(wait=False)
+
+    results = []
+    for name, future in futures.items():
+        if not future.done():
+            results.append(DestinationResult(name, STATUS_TIMEOUT, time.monotonic() - start))
+            continue
+        duration = finished_at.get(name, time.monotonic()) - start
+        error = future.exception()
+        if error is not None:
+            results.append(DestinationResult(name, STATUS_FAILED, duration, error))
+        elif future.result() is False:
+            results.append(DestinationResult(name, STATUS_FAILED, duration))
+        else:
+            results.append(DestinationResult(name, STATUS_SUCCESS, duration))
+    return results
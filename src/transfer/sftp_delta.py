@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import struct
+import sys
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+import paramiko
+
+from src.storage.repository import ContentDefinedChunker
+
+DELTA_SUFFIX = ".delta"
+SIGNATURE_SUFFIX = ".sig"
+BASE_POINTER_NAME = "delta_base.json"
+DEFAULT_FULL_EVERY = 24
+DEFAULT_MAX_LITERAL_RATIO = 0.5
+
+_COPY = b"C"
+_LITERAL = b"L"
+_COPY_FORMAT = ">QI"
+_LITERAL_FORMAT = ">I"
+
+
+@dataclass
+class DeltaResult:
+    remote_path: str
+    full: bool
+    size: int = 0
+    sent_bytes: int = 0
+    literal_bytes: int = 0
+    # Size and SHA-256 of the file written to remote_path, to check it on the server
+    file_size: int = 0
+    file_sha256: str = ""
+
+
+def _remote_join(folder: str, name: str) -> str:
+    return folder + name if folder.endswith("/") else f"{folder}/{name}"
+
+
+def _read_remote_json(sftp: paramiko.SFTPClient, path: str) -> Optional[dict]:
+    try:
+        with sftp.open(path, "rb") as f:
+            f.prefetch()
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_remote(sftp: paramiko.SFTPClient, path: str, data: bytes):
+    with sftp.open(f"{path}.part", "wb") as f:
+        f.set_pipelined(True)
+        f.write(data)
+    sftp.posix_rename(f"{path}.part", path)
+
+
+class SignatureCache:
+    """
+    Local copies of the signatures of the remote base backups, so they are only downloaded once.
+    """
+
+    def __init__(self, path: str, prefix: str = ""):
+        """
+        :param path: Directory of the signatures, it can be shared by several databases.
+        :param prefix: Name prefix of the database's backups, only their signatures are replaced by save().
+        """
+        self.path = path
+        self.prefix = prefix
+
+    def _file(self, base_name: str) -> str:
+        return os.path.join(self.path, f"{base_name}{SIGNATURE_SUFFIX}")
+
+    def load(self, base_name: str) -> Optional[dict]:
+        try:
+            with open(self._file(base_name), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, base_name: str, signature: dict):
+        os.makedirs(self.path, exist_ok=True)
+        # Only the signature of the current base is needed. The name continues with the backup's timestamp, so the
+        # signatures of a job whose name starts with this job's prefix are kept.
+        for name in os.listdir(self.path):
+            if (name.endswith(SIGNATURE_SUFFIX) and name.startswith(self.prefix)
+                    and name[len(self.prefix):][:1].isdigit()):
+                os.remove(os.path.join(self.path, name))
+        with open(self._file(base_name), "w") as f:
+            json.dump(signature, f)
+
+
+class DeltaUploader:
+    """
+    Uploads backups to the SSH server as differences against the last full backup on the server.
+
+    The first upload (and every full_every-th one) sends the full backup together with its signature,
+    the SHA-256 of every content-defined chunk and its offset. Later uploads only send a '.delta' file
+    with references to chunks of that base and the literal data of the changed chunks, so the bytes sent
+    over the WAN scale with the changes instead of the database size.
+    Every delta refers to the full base, never to another delta, so a restore only needs the base and one delta.
+    A delta whose literal data exceeds max_literal_ratio of the backup makes the next upload a full one.
+    """
+
+    def __init__(self, sftp: paramiko.SFTPClient, folder: str, prefix: str, cache: SignatureCache,
+                 chunker: ContentDefinedChunker = None, full_every: int = DEFAULT_FULL_EVERY,
+                 max_literal_ratio: float = DEFAULT_MAX_LITERAL_RATIO):
+        """
+        :param sftp: SFTP session of the SSH server.
+        :param folder: Backup folder on the SSH server.
+        :param prefix: Name prefix of the database's backups, keeps bases of different databases apart.
+        :param cache: Local signature cache.
+        :param chunker: Chunker used for signatures and deltas.
+        :param full_every: Number of deltas after which a new full backup is uploaded.
+        :param max_literal_ratio: Literal share of a delta that triggers a full upload next time.
+        """
+        self.sftp = sftp
+        self.folder = folder
+        self.pointer_path = _remote_join(folder, f"{prefix}{BASE_POINTER_NAME}")
+        self.cache = cache
+        self.chunker = chunker or ContentDefinedChunker()
+        self.full_every = full_every
+        self.max_literal_ratio = max_literal_ratio
+
+    def _load_base(self) -> Tuple[Optional[dict], Optional[dict]]:
+        pointer = _read_remote_json(self.sftp, self.pointer_path)
+        if not pointer or pointer.get("deltas", 0) >= self.full_every:
+            return pointer, None
+        base_name = pointer["base"]
+        signature = self.cache.load(base_name)
+        if signature is None:
+            signature = _read_remote_json(self.sftp, _remote_join(self.folder, f"{base_name}{SIGNATURE_SUFFIX}"))
+            if signature is None:
+                return pointer, None
+            self.cache.save(base_name, signature)
+        return pointer, signature
+
+    def _upload_full(self, file_name: str, chunks: Iterator[bytes]) -> DeltaResult:
+        remote_path = _remote_join(self.folder, file_name)
+        result = DeltaResult(remote_path, full=True)
+        references = []
+        file_sha256 = hashlib.sha256()
+        with self.sftp.open(f"{remote_path}.part", "wb") as remote_file:
+            remote_file.set_pipelined(True)
+            for chunk in self.chunker.split(chunks):
+                references.append([hashlib.sha256(chunk).hexdigest(), result.size, len(chunk)])
+                file_sha256.update(chunk)
+                remote_file.write(chunk)
+                result.size += len(chunk)
+        self.sftp.posix_rename(f"{remote_path}.part", remote_path)
+        result.sent_bytes = result.literal_bytes = result.file_size = result.size
+        result.file_sha256 = file_sha256.hexdigest()
+
+        signature = {"base": file_name, "size": result.size, "chunks": references}
+        signature_data = json.dumps(signature).encode()
+        _write_remote(self.sftp, f"{remote_path}{SIGNATURE_SUFFIX}", signature_data)
+        result.sent_bytes += len(signature_data)
+        self.cache.save(file_name, signature)
+        _write_remote(self.sftp, self.pointer_path, json.dumps({"base": file_name, "deltas": 0}).encode())
+        return result
+
+    def _upload_delta(self, file_name: str, chunks: Iterator[bytes], pointer: dict, signature: dict) -> DeltaResult:
+        remote_path = _remote_join(self.folder, f"{file_name}{DELTA_SUFFIX}")
+        result = DeltaResult(remote_path, full=False)
+        base_chunks: Dict[str, Tuple[int, int]] = {digest: (offset, length)
+                                                   for digest, offset, length in signature["chunks"]}
+        sha256 = hashlib.sha256()
+        file_sha256 = hashlib.sha256()
+
+        def _write(data: bytes):
+            remote_file.write(data)
+            file_sha256.update(data)
+            result.sent_bytes += len(data)
+
+        with self.sftp.open(f"{remote_path}.part", "wb") as remote_file:
+            remote_file.set_pipelined(True)
+            _write(json.dumps({"base": signature["base"], "file": file_name}).encode() + b"\n")
+            for chunk in self.chunker.split(chunks):
+                sha256.update(chunk)
+                result.size += len(chunk)
+                match = base_chunks.get(hashlib.sha256(chunk).hexdigest())
+                if match:
+                    op = _COPY + struct.pack(_COPY_FORMAT, *match)
+                else:
+                    op = _LITERAL + struct.pack(_LITERAL_FORMAT, len(chunk)) + chunk
+                    result.literal_bytes += len(chunk)
+                _write(op)
+            # The trailer lets apply_delta verify the rebuilt file
+            _write(_LITERAL + struct.pack(_LITERAL_FORMAT, 0) + sha256.hexdigest().encode())
+        self.sftp.posix_rename(f"{remote_path}.part", remote_path)
+        result.file_size = result.sent_bytes
+        result.file_sha256 = file_sha256.hexdigest()
+
+        deltas = pointer.get("deltas", 0) + 1
+        if result.size and result.literal_bytes / result.size > self.max_literal_ratio:
+            deltas = self.full_every
+        _write_remote(self.sftp, self.pointer_path, json.dumps({"base": pointer["base"], "deltas": deltas}).encode())
+        return result
+
+    def upload(self, file_name: str, chunks: Iterator[bytes]) -> DeltaResult:
+        """
+        Uploads a backup either in full or as a delta against the current base.
+        :param file_name: Name of the backup file.
+        :param chunks: Iterator of the backup's bytes.
+        :return: DeltaResult with the number of bytes sent.
+        """
+        pointer, signature = self._load_base()
+        if signature is None:
+            return self._upload_full(file_name, chunks)
+        return self._upload_delta(file_name, chunks, pointer, signature)
+
+
+def apply_delta(base: BinaryIO, delta: BinaryIO, target: BinaryIO):
+    """
+    Rebuilds a backup from its full base and a delta file.
+    :param base: The base backup the delta refers to, opened for binary reading.
+    :param delta: The delta file, opened for binary reading.
+    :param target: File object the rebuilt backup is written to.
+    :raises ValueError: If the delta is corrupt or the rebuilt backup doesn't match its checksum.
+    """
+    delta.readline()
+    sha256 = hashlib.sha256()
+    while True:
+        op = delta.read(1)
+        if op == _COPY:
+            offset, length = struct.unpack(_COPY_FORMAT, delta.read(struct.calcsize(_COPY_FORMAT)))
+            base.seek(offset)
+            data = base.read(length)
+        elif op == _LITERAL:
+            (length,) = struct.unpack(_LITERAL_FORMAT, delta.read(struct.calcsize(_LITERAL_FORMAT)))
+            if length == 0:
+                if delta.read().decode() != sha256.hexdigest():
+                    raise ValueError("The rebuilt backup doesn't match the checksum of the delta.")
+                return
+            data = delta.read(length)
+        else:
+            raise ValueError("Corrupt delta file.")
+        sha256.update(data)
+        target.write(data)
+
+
+if __name__ == '__main__':
+    # Usage: python -m src.transfer.sftp_delta <base backup> <delta file> <output file>
+    with open(sys.argv[1], "rb") as base_file, open(sys.argv[2], "rb") as delta_file, \
+            open(sys.argv[3], "wb") as target_file:
+        apply_delta(base_file, delta_file, target_file)
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import shlex
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+import paramiko
+
+from src.transfer.ssh_pool import SSHConnectionPool
+
+DEFAULT_STREAMS = 4
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# sha256sum on the server gets this many seconds plus the time to read the file at HASH_MIN_RATE
+HASH_BASE_TIMEOUT = 60
+HASH_MIN_RATE = 20 * 1024 * 1024
+
+
+@dataclass
+class ParallelUploadResult:
+    remote_path: str
+    size: int = 0
+    streams: int = 0
+    duration: float = 0.0
+    checksum_verified: Optional[bool] = None
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def throughput(self) -> float:
+        """
+        MB per second over the whole upload.
+        """
+        return self.size / (1024 * 1024) / self.duration if self.duration else 0.0
+
+
+def remote_sha256(sftp: paramiko.SFTPClient, remote_path: str, size: int = 0,
+                  timeout: float = None) -> Optional[str]:
+    """
+    Lets the SSH server hash a file with sha256sum, so the file doesn't travel back over the network.
+    :param size: Size of the file, the default timeout grows with it.
+    :param timeout: Seconds to wait for the checksum, e.g. when the file is on a hanging network mount of the server.
+    :return: SHA-256 of the remote file or None if the server doesn't allow running commands or timed out.
+    """
+    if timeout is None:
+        timeout = HASH_BASE_TIMEOUT + size / HASH_MIN_RATE
+    deadline = time.monotonic() + timeout
+    try:
+        channel = sftp.get_channel().get_transport().open_session()
+    except paramiko.SSHException:
+        return None
+    try:
+        channel.settimeout(timeout)
+        channel.exec_command(f"sha256sum -- {shlex.quote(remote_path)}")
+        output = b""
+        while True:
+            data = channel.recv(65536)
+            if not data:
+                break
+            output += data
+        # recv_exit_status() would wait without a timeout
+        if not channel.status_event.wait(max(0.0, deadline - time.monotonic())):
+            raise TimeoutError()
+        if channel.recv_exit_status() != 0 or not output:
+            return None
+        return output.split()[0].decode()
+    except TimeoutError:
+        print(f"sha256sum of {remote_path} on the SSH server didn't finish within {timeout:.0f} seconds.")
+        return None
+    except (paramiko.SSHException, OSError):
+        return None
+    finally:
+        channel.close()
+
+
+class ParallelUploader:
+    """
+    Uploads a large file over several SSH connections at once. The file is split into parts, and every
+    stream takes the next part, writes it at its offset into the same remote file with pipelined write
+    requests and continues until all parts are sent. Separate connections get separate TCP windows,
+    so a high-latency link isn't limited by the window of a single connection.
+    The assembled file is written as '<name>.part' and only renamed after its size and checksum were verified.
+    """
+
+    def __init__(self, pool: SSHConnectionPool, ssh_config: dict, streams: int = DEFAULT_STREAMS,
+                 part_size: int = DEFAULT_PART_SIZE, block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        :param pool: Connection pool the streams borrow their connections from.
+        :param ssh_config: SSH configuration.
+        :param streams: Number of parallel connections.
+        :param part_size: Number of bytes a stream takes at once.
+        :param block_size: Number of bytes read from the local file and written at once.
+        """
+        self.pool = pool
+        self.ssh_config = ssh_config
+        self.streams = max(1, streams)
+        self.part_size = max(block_size, part_size)
+        self.block_size = block_size
+
+    def _send_parts(self, path: str, part_path: str, parts: deque, lock: threading.Lock, result: ParallelUploadResult,
+                    sent: List[int], progress: Optional[Callable[[int], None]]):
+        try:
+            with self.pool.sftp(self.ssh_config) as sftp, open(path, "rb") as local_file, \
+                    sftp.open(part_path, "r+b") as remote_file:
+                # Don't wait for the acknowledgement of every write, close() collects them
+                remote_file.set_pipelined(True)
+                while True:
+                    with lock:
+                        if not parts or result.errors:
+                            break
+                        offset, length = parts.popleft()
+                    local_file.seek(offset)
+                    remote_file.seek(offset)
+                    remaining = length
+                    while remaining:
+                        data = local_file.read(min(self.block_size, remaining))
+                        if not data:
+                            raise IOError(f"{path} changed during the upload.")
+                        remote_file.write(data)
+                        remaining -= len(data)
+                        if progress is not None:
+                            with lock:
+                                sent[0] += len(data)
+                                done = sent[0]
+                            progress(done)
+        except Exception as e:
+            with lock:
+                result.errors.append(str(e))
+
+    def upload(self, path: str, remote_path: str, sha256: Optional[str] = None,
+               progress: Callable[[int], None] = None) -> ParallelUploadResult:
+        """
+        Uploads a file in parallel streams and verifies the assembled file.
+        :param path: Path to the local file.
+        :param remote_path: Path of the file on the SSH server.
+        :param sha256: SHA-256 of the local file, e.g. from its manifest, computed if not given.
+        :param progress: Called with the number of bytes written by all streams so far.
+        :return: ParallelUploadResult with the throughput and whether the checksum was verified.
+        :raises IOError: If a stream failed or the assembled file doesn't match the local file.
+        """
+        size = os.path.getsize(path)
+        result = ParallelUploadResult(remote_path, size=size)
+        part_path = f"{remote_path}.part"
+        parts = deque((offset, min(self.part_size, size - offset)) for offset in range(0, size, self.part_size))
+        result.streams = min(self.streams, len(parts)) or 1
+        start = time.monotonic()
+
+        with self.pool.sftp(self.ssh_config) as sftp:
+            # Create the empty target, the streams open it without truncating
+            sftp.open(part_path, "wb").close()
+
+        lock = threading.Lock()
+        sent = [0]
+        workers = [threading.Thread(target=self._send_parts, args=(path, part_path, parts, lock, result, sent, progress),
+                                    name=f"sftp-stream-{index}", daemon=True)
+                   for index in range(result.streams)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        with self.pool.sftp(self.ssh_config) as sftp:
+            try:
+                if result.errors:
+                    raise IOError(f"Parallel upload failed: {'; '.join(result.errors)}")
+                remote_size = sftp.stat(part_path).st_size
+                if remote_size != size:
+                    raise IOError(f"The uploaded file has {remote_size} bytes instead of {size} bytes.")
+                remote_checksum = remote_sha256(sftp, part_path, size)
+                if remote_checksum is not None:
+                    if sha256 is None:
+                        digest = hashlib.sha256()
+                        with open(path, "rb") as f:
+                            for data in iter(lambda: f.read(self.block_size), b""):
+                                digest.update(data)
+                        sha256 = digest.hexdigest()
+                    if remote_checksum != sha256:
+                        raise IOError("The checksum of the uploaded file doesn't match the local file.")
+                    result.checksum_verified = True
+                else:
+                    result.checksum_verified = False
+            except Exception:
+                try:
+                    sftp.remove(part_path)
+                except IOError:
+                    pass
+                raise
+            sftp.posix_rename(part_path, remote_path)
+
+        result.duration = time.monotonic() - start
+        return result
+
+
+def create_parallel_uploader(pool: SSHConnectionPool, ssh_config: dict) -> ParallelUploader:
+    """
+    Creates the parallel uploader with the stream settings of the SSH configuration.
+    :param pool: Connection pool.
+    :param ssh_config: SSH configuration.
+    """
+    return ParallelUploader(
+        pool, ssh_config,
+        streams=ssh_config.get("upload_streams", 1),
+        part_size=ssh_config.get("upload_part_mb", DEFAULT_PART_SIZE // (1024 * 1024)) * 1024 * 1024
+    )
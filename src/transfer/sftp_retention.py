@@ -0,0 +1,224 @@
+import stat
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+
+import paramiko
+from paramiko.sftp import CMD_REMOVE, CMD_STATUS
+
+from src.pipeline.checksum import MANIFEST_SUFFIX
+from src.storage.catalog import STATUS_COMPLETE, STATUS_FAILED, STORAGE_REMOTE, CatalogEntry, RetentionPolicy
+from src.transfer.sftp_delta import DELTA_SUFFIX, SIGNATURE_SUFFIX
+
+# Where the age of a backup on the server comes from, RETENTION_NONE keeps all backups
+RETENTION_NONE = "none"
+RETENTION_CATALOG = "catalog"
+RETENTION_MTIME = "mtime"
+# Remove requests sent before the first answer is awaited
+DEFAULT_MAX_PENDING = 64
+# Files of a backup on the server, by the suffix they add to the backup's name
+_SIDECAR_SUFFIXES = (MANIFEST_SUFFIX, SIGNATURE_SUFFIX, DELTA_SUFFIX)
+# Internals of paramiko's SFTPClient the pipelined removes need, paramiko only pipelines file reads itself
+_PIPELINE_METHODS = ("_async_request", "_read_response", "_convert_status", "_adjust_cwd")
+
+
+@dataclass
+class RemoteBackup:
+    """
+    A backup on the SSH server with all of its files: the backup itself or its delta, the manifest and the signature.
+    """
+    name: str
+    files: List[str] = field(default_factory=list)
+    size: int = 0
+    mtime: float = 0.0
+
+    @property
+    def is_base(self) -> bool:
+        """
+        True for a full backup that deltas refer to.
+        """
+        return f"{self.name}{SIGNATURE_SUFFIX}" in self.files
+
+    @property
+    def is_delta(self) -> bool:
+        return f"{self.name}{DELTA_SUFFIX}" in self.files
+
+
+@dataclass
+class RemoteRetentionResult:
+    backups: int = 0
+    deleted: List[str] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)
+    list_duration: float = 0.0
+    delete_duration: float = 0.0
+
+
+def _backup_name(file_name: str) -> str:
+    for suffix in _SIDECAR_SUFFIXES:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
+def list_remote_backups(sftp: paramiko.SFTPClient, folder: str, prefix: str,
+                        suffixes: Tuple[str, ...]) -> List[RemoteBackup]:
+    """
+    Lists the backups of a database on the SSH server with a single directory listing, no file is opened or stat'ed.
+    Partial uploads ('.part') and the delta base pointer don't belong to a backup and are never listed.
+    :param sftp: SFTP session of the SSH server.
+    :param folder: Backup folder on the SSH server.
+    :param prefix: Name prefix of the database's backups.
+    :param suffixes: File name endings of backups, e.g. '.sql.gz'.
+    :return: Backups with their files, size and newest modification time.
+    """
+    backups: Dict[str, RemoteBackup] = {}
+    for attributes in sftp.listdir_attr(folder):
+        file_name = attributes.filename
+        if not file_name.startswith(prefix) or (attributes.st_mode and not stat.S_ISREG(attributes.st_mode)):
+            continue
+        name = _backup_name(file_name)
+        if not name.endswith(suffixes):
+            continue
+        backup = backups.setdefault(name, RemoteBackup(name))
+        backup.files.append(file_name)
+        backup.size += attributes.st_size or 0
+        backup.mtime = max(backup.mtime, attributes.st_mtime or 0)
+    return list(backups.values())
+
+
+def expired_remote_backups(backups: List[RemoteBackup], policy: RetentionPolicy, created: Dict[str, float] = None,
+                           failed: Iterable[str] = (), protected: Iterable[str] = ()) -> List[RemoteBackup]:
+    """
+    Returns the backups the retention policy doesn't keep.
+    A delta can only be restored with its base, the newest full backup before it, so the base of every kept delta is
+    kept too. The newest base is always kept, the next delta upload refers to it.
+    :param backups: Backups of one database on the server.
+    :param policy: Retention policy of the server.
+    :param created: Creation time per backup name, e.g. from the catalog. Other backups use their modification time.
+    :param failed: Names of backups that failed, they are never kept.
+    :param protected: Names of backups that are always kept, e.g. the one that was just uploaded.
+    """
+    created = created or {}
+    failed, protected = set(failed), set(protected)
+    ordered = sorted(backups, key=lambda backup: created.get(backup.name, backup.mtime))
+    entries = [CatalogEntry(id=index, job="", name=backup.name, storage=STORAGE_REMOTE, path=None,
+                            created=created.get(backup.name, backup.mtime), size=backup.size,
+                            status=STATUS_FAILED if backup.name in failed else STATUS_COMPLETE)
+               for index, backup in enumerate(ordered)]
+    expired = {entry.id for entry in policy.expired(entries)}
+    keep = {index for index, backup in enumerate(ordered) if backup.name in protected}
+
+    base = None
+    bases = {}
+    for index, backup in enumerate(ordered):
+        if backup.is_base:
+            base = index
+        elif backup.is_delta:
+            bases[index] = base
+    if base is not None:
+        keep.add(base)
+    for index, base in bases.items():
+        if base is not None and (index not in expired or index in keep):
+            keep.add(base)
+    return [backup for index, backup in enumerate(ordered) if index in expired and index not in keep]
+
+
+class _RemoveBatch:
+    """
+    Collects the answers of pipelined remove requests, the SFTP client hands them over like file read answers.
+    """
+
+    def __init__(self, sftp: paramiko.SFTPClient):
+        self.sftp = sftp
+        self.paths: Dict[int, str] = {}
+        self.errors: Dict[str, str] = {}
+        self.answered = 0
+
+    def _async_response(self, t: int, msg: paramiko.Message, num: int):
+        self.answered += 1
+        path = self.paths.pop(num, None)
+        try:
+            if t != CMD_STATUS:
+                raise paramiko.SFTPError(f"Expected a status answer, got {t}")
+            self.sftp._convert_status(msg)
+        except FileNotFoundError:
+            # Already removed by someone else
+            pass
+        except (IOError, paramiko.SFTPError) as e:
+            self.errors[path] = str(e)
+
+
+def _remove_one_by_one(sftp: paramiko.SFTPClient, paths: List[str]) -> Dict[str, str]:
+    errors = {}
+    for path in paths:
+        try:
+            sftp.remove(path)
+        except FileNotFoundError:
+            pass
+        except (IOError, paramiko.SFTPError) as e:
+            errors[path] = str(e)
+    return errors
+
+
+def remove_remote_files(sftp: paramiko.SFTPClient, paths: List[str],
+                        max_pending: int = DEFAULT_MAX_PENDING) -> Dict[str, str]:
+    """
+    Removes files on the SSH server without waiting for every answer before sending the next request, so removing
+    thousands of files takes a few round trips instead of one per file.
+    The pipelining uses internals of paramiko (pinned in requirements.txt). If a paramiko version lacks them, the
+    files are removed one by one.
+    :param sftp: SFTP session of the SSH server.
+    :param paths: Remote paths of the files.
+    :param max_pending: Number of requests sent ahead of their answers.
+    :return: Error message per path that couldn't be removed, files that don't exist are no error.
+    """
+    if not all(hasattr(sftp, name) for name in _PIPELINE_METHODS):
+        return _remove_one_by_one(sftp, paths)
+    batch = _RemoveBatch(sftp)
+    sent = 0
+    for path in paths:
+        while sent - batch.answered >= max_pending:
+            sftp._read_response()
+        batch.paths[sftp._async_request(batch, CMD_REMOVE, sftp._adjust_cwd(path))] = path
+        sent += 1
+    while batch.answered < sent:
+        sftp._read_response()
+    return batch.errors
+
+
+def apply_remote_retention(sftp: paramiko.SFTPClient, folder: str, prefix: str, suffixes: Tuple[str, ...],
+                           policy: RetentionPolicy, created: Dict[str, float] = None, failed: Iterable[str] = (),
+                           protected: Iterable[str] = (),
+                           max_pending: int = DEFAULT_MAX_PENDING) -> RemoteRetentionResult:
+    """
+    Deletes the backups of a database from the SSH server that the retention policy doesn't keep, together with their
+    manifests, signatures and deltas. See expired_remote_backups for the parameters.
+    :param sftp: SFTP session of the SSH server.
+    :param folder: Backup folder on the SSH server.
+    :param prefix: Name prefix of the database's backups.
+    :param suffixes: File name endings of backups.
+    :param max_pending: Number of remove requests sent ahead of their answers.
+    :return: RemoteRetentionResult with the deleted backups.
+    """
+    result = RemoteRetentionResult()
+    start = time.monotonic()
+    backups = list_remote_backups(sftp, folder, prefix, suffixes)
+    result.backups = len(backups)
+    result.list_duration = time.monotonic() - start
+
+    expired = expired_remote_backups(backups, policy, created, failed, protected)
+    folder = folder if folder.endswith("/") else f"{folder}/"
+    # The manifest goes last, so a backup that is only partly removed is still listed by the next run
+    paths = [folder + file_name for backup in expired
+             for file_name in sorted(backup.files, key=lambda file_name: file_name.endswith(MANIFEST_SUFFIX))]
+    start = time.monotonic()
+    errors = remove_remote_files(sftp, paths, max_pending) if paths else {}
+    result.delete_duration = time.monotonic() - start
+    for backup in expired:
+        backup_errors = {file_name: errors[folder + file_name] for file_name in backup.files
+                         if folder + file_name in errors}
+        if backup_errors:
+            result.errors[backup.name] = "; ".join(f"{name}: {error}" for name, error in backup_errors.items())
+        else:
+            result.deleted.append(backup.name)
+    return result
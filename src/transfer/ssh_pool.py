@@ -0,0 +1,169 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+import paramiko
+
+DEFAULT_KEEPALIVE_SECONDS = 30
+DEFAULT_IDLE_TIMEOUT_SECONDS = 60 * 60
+DEFAULT_MAX_IDLE_PER_KEY = 4
+
+
+class _PooledConnection:
+    def __init__(self, client: paramiko.SSHClient, sftp: paramiko.SFTPClient):
+        self.client = client
+        self.sftp = sftp
+        self.last_used = time.monotonic()
+
+    def is_alive(self) -> bool:
+        transport = self.client.get_transport()
+        return (transport is not None and transport.is_active()
+                and not self.sftp.get_channel().closed)
+
+    def close(self):
+        try:
+            self.sftp.close()
+        finally:
+            self.client.close()
+
+
+class SSHConnectionPool:
+    """
+    Keeps authenticated SSH transports with an open SFTP session alive between backup runs.
+    Connections are keyed on host, port and user, kept alive with SSH keepalives and replaced
+    lazily when a transport died. The pool is thread-safe and shared by all scheduled runs.
+    """
+
+    def __init__(self, keepalive_seconds: int = DEFAULT_KEEPALIVE_SECONDS,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT_SECONDS, max_idle_per_key: int = DEFAULT_MAX_IDLE_PER_KEY,
+                 window_size: int = None, max_packet_size: int = None):
+        """
+        :param keepalive_seconds: Interval of the SSH keepalive packets, 0 disables them.
+        :param idle_timeout: Seconds after which an unused connection is closed.
+        :param max_idle_per_key: Maximum number of idle connections kept per host/port/user.
+        :param window_size: SSH channel window of the SFTP sessions, None keeps paramiko's default.
+            A window below the bandwidth-delay product of the link limits the throughput.
+        :param max_packet_size: Maximum SSH packet size of the SFTP sessions, None keeps paramiko's default.
+        """
+        self.keepalive_seconds = keepalive_seconds
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_key = max_idle_per_key
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.handshakes = 0
+        self.acquisitions = 0
+        self._idle: Dict[Tuple, List[_PooledConnection]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(ssh_config: dict) -> Tuple:
+        return ssh_config["host"], int(ssh_config.get("port", 22)), ssh_config["username"]
+
+    def _connect(self, ssh_config: dict) -> _PooledConnection:
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            hostname=ssh_config["host"],
+            port=int(ssh_config.get("port", 22)),
+            username=ssh_config["username"],
+            # Use private key for authentication
+            key_filename=ssh_config["private_key_path"]
+        )
+        try:
+            if self.keepalive_seconds:
+                client.get_transport().set_keepalive(self.keepalive_seconds)
+            sftp = paramiko.SFTPClient.from_transport(client.get_transport(), window_size=self.window_size,
+                                                      max_packet_size=self.max_packet_size)
+        except Exception:
+            client.close()
+            raise
+        with self._lock:
+            self.handshakes += 1
+        return _PooledConnection(client, sftp)
+
+    def _checkout(self, ssh_config: dict) -> _PooledConnection:
+        key = self._key(ssh_config)
+        stale = []
+        connection = None
+        with self._lock:
+            self.acquisitions += 1
+            idle = self._idle.get(key, [])
+            now = time.monotonic()
+            while idle:
+                candidate = idle.pop()
+                if now - candidate.last_used < self.idle_timeout and candidate.is_alive():
+                    connection = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        return connection or self._connect(ssh_config)
+
+    def _checkin(self, ssh_config: dict, connection: _PooledConnection):
+        if not connection.is_alive():
+            connection.close()
+            return
+        connection.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(self._key(ssh_config), [])
+            if len(idle) < self.max_idle_per_key:
+                idle.append(connection)
+                return
+        connection.close()
+
+    @contextmanager
+    def sftp(self, ssh_config: dict) -> Iterator[paramiko.SFTPClient]:
+        """
+        Borrows an SFTP session for the given SSH configuration, connecting only if no live one is pooled.
+        A connection whose transport broke while it was borrowed is not returned to the pool.
+        :param ssh_config: SSH configuration with host, port, username and private_key_path.
+        """
+        connection = self._checkout(ssh_config)
+        try:
+            yield connection.sftp
+        finally:
+            self._checkin(ssh_config, connection)
+
+    @property
+    def reuse_ratio(self) -> float:
+        """
+        Share of acquisitions that were served by an already authenticated connection.
+        """
+        with self._lock:
+            if not self.acquisitions:
+                return 0.0
+            return (self.acquisitions - self.handshakes) / self.acquisitions
+
+    def stats(self) -> dict:
+        reuse_ratio = self.reuse_ratio
+        with self._lock:
+            return {
+                "handshakes": self.handshakes,
+                "acquisitions": self.acquisitions,
+                "reuse_ratio": reuse_ratio,
+                "idle_connections": sum(len(idle) for idle in self._idle.values()),
+            }
+
+    def close_all(self):
+        with self._lock:
+            connections = [connection for idle in self._idle.values() for connection in idle]
+            self._idle.clear()
+        for connection in connections:
+            connection.close()
+
+
+ssh_pool = SSHConnectionPool()
+
+
+def configure_pool(ssh_config: dict):
+    """
+    Applies the pool settings of the SSH configuration to the shared pool.
+    :param ssh_config: SSH configuration.
+    """
+    ssh_pool.keepalive_seconds = ssh_config.get("keepalive_seconds", DEFAULT_KEEPALIVE_SECONDS)
+    ssh_pool.idle_timeout = ssh_config.get("pool_idle_timeout_minutes", DEFAULT_IDLE_TIMEOUT_SECONDS // 60) * 60
+    # Keep a connection for every parallel upload stream and one for the control session
+    ssh_pool.max_idle_per_key = max(DEFAULT_MAX_IDLE_PER_KEY, ssh_config.get("upload_streams", 1) + 1)
+    ssh_pool.window_size = ssh_config.get("window_size_mb", 0) * 1024 * 1024 or None
+    ssh_pool.max_packet_size = ssh_config.get("max_packet_kb", 0) * 1024 or None
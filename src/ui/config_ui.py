@@ -1,28 +1,68 @@
 import os
 import sys
-import threading
 
 from src.ui.style import set_dark_mode
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
 
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QFileDialog,
     QLineEdit, QComboBox, QProgressBar, QSpinBox, QColorDialog, QSlider, QHBoxLayout, QGroupBox, QCheckBox, QFrame
 )
-from src.configuration.config import load_all_configs, save_all_configs
+from src.configuration.config import config_store, load_all_configs, save_all_configs
 from src.db.database_backup import run_backup_service, start_service, stop_service
+from src.pipeline.progress import STAGE_DONE, ProgressEvent, progress
 
 db_types = ["PostgreSQL", "MySQL", "SQLite", "MSSQL", "Oracle"]
+# Seconds without further edits before the changed settings are written
+CONFIG_SAVE_DELAY = 0.5
+
+
+class ServiceWorker(QThread):
+    """
+    Runs the backup service and hands its progress events to the UI thread.
+    """
+    progress_changed = pyqtSignal(object)
+
+    def __init__(self, configs: dict):
+        super().__init__()
+        self.configs = configs
+
+    def run(self):
+        # Emitting a signal queues the event for the UI thread, so the backup thread never waits for the UI
+        progress.subscribe(self.progress_changed.emit)
+        try:
+            run_backup_service(send_to_api=self.configs["api"]["use_api"],
+                               send_to_server=self.configs["ssh"]["use_ssh"],
+                               use_local_backup=self.configs["backup"]["use_local_backup"])
+        finally:
+            progress.unsubscribe(self.progress_changed.emit)
+
+
+def format_progress(event: ProgressEvent) -> str:
+    mb = 1024 * 1024
+    text = f"{event.job}: {event.stage}"
+    if event.destination:
+        text += f" to {event.destination}"
+    text += f" {event.done / mb:.1f}"
+    if event.total:
+        text += f" / {event.total / mb:.1f}"
+    text += f" MB, {event.rate / mb:.1f} MB/s"
+    if event.eta is not None:
+        text += f", {int(event.eta)} s left"
+    return text
 
 
 class ConfigUI(QWidget):
     def __init__(self):
         super().__init__()
         self.configs = load_all_configs()
-        self.backup_thread = None
+        self.backup_worker = None
         self.service_running = False
+        self.close_requested = False
+        # Set while a backup is running, the progress bar shows its progress instead of the countdown
+        self.backup_active = False
         self.backup_interval = self.configs["backup"]["interval_minutes"] * 60
         if self.backup_interval <= 0:
             self.backup_interval = 60
@@ -118,6 +158,7 @@ class ConfigUI(QWidget):
 
         self.progress_bar = QProgressBar()
         self.progress_bar.setValue(0)
+        self.progress_label = QLabel("")
 
         self.ssh_checkbox = QCheckBox("Use SSH")
         self.ssh_checkbox.setChecked(self.configs["ssh"]["use_ssh"])
@@ -287,6 +328,7 @@ class ConfigUI(QWidget):
         main_layout.addWidget(ssh_group)
         main_layout.addWidget(self.start_button)
         main_layout.addWidget(self.progress_bar)
+        main_layout.addWidget(self.progress_label)
 
         self.add_tooltips()
 
@@ -327,7 +369,7 @@ class ConfigUI(QWidget):
         # Because Qt is strange...
         is_checked = bool(state) if isinstance(state, bool) else state == 2
         self.configs["backup"]["use_local_backup"] = is_checked
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
 
         # Disable the backup path input field if local backup is not used
         self.backup_path_input.setEnabled(is_checked)
@@ -340,7 +382,7 @@ class ConfigUI(QWidget):
         # Because Qt is strange...
         is_checked = bool(state) if isinstance(state, bool) else state == 2
         self.configs["backup"]["use_cron"] = is_checked
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
         # Disable the cron input field if cron is not used
@@ -365,27 +407,27 @@ class ConfigUI(QWidget):
         elif _text.strip() and croniter.is_valid(_text):
             self.cron_result.setText("Valid cron expression.")
             self.cron_result.setStyleSheet("QLabel { color : green }")
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_schema_changed(self, text):
         self.configs["db"]["schema"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_home_changed(self, text):
         self.configs["db"]["home"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_service_name_changed(self, text):
         self.configs["db"]["service_name"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_extra_options_changed(self, text):
         self.configs["db"]["extra_options"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def can_start_service(self) -> bool:
@@ -422,7 +464,7 @@ class ConfigUI(QWidget):
         # Because Qt is strange...
         is_checked = bool(state) if isinstance(state, bool) else state == 2
         self.configs["ssh"]["use_ssh"] = is_checked
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
         # Disable SSH Port, SSH User, SSH Private Key Path, and Server Save Path if SSH is not used
@@ -437,7 +479,7 @@ class ConfigUI(QWidget):
         # Because Qt is strange...
         is_checked = bool(state) if isinstance(state, bool) else state == 2
         self.configs["api"]["use_api"] = is_checked
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
         # Disable API URL and API Token inputs if the API is not used
@@ -446,42 +488,44 @@ class ConfigUI(QWidget):
 
     def ssh_host_changed(self, text):
         self.configs["ssh"]["host"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def ssh_port_changed(self, value):
         self.configs["ssh"]["port"] = int(value)
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def ssh_user_changed(self, text):
         self.configs["ssh"]["user"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def ssh_key_changed(self, text):
         self.configs["ssh"]["private_key_path"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def select_ssh_key(self):
         path = QFileDialog.getOpenFileName(self, "Select SSH Private Key")[0]
         self.ssh_key_input.setText(path)
         self.configs["ssh"]["private_key_path"] = path
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def change_ssh_server_save_path(self, text):
         self.configs["ssh"]["server_folder_path"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def max_backups_changed(self, value):
         self.configs["backup"]["max_backup_files"] = int(value)
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def update_progress_bar(self):
+        if self.backup_active:
+            return
         if self.remaining_time > 0:
             self.remaining_time -= 1
             progress = ((self.backup_interval - self.remaining_time) / self.backup_interval) * 100
@@ -491,52 +535,70 @@ class ConfigUI(QWidget):
             self.remaining_time = self.backup_interval
             self.progress_bar.setValue(0)
 
+    def backup_progress_changed(self, event: ProgressEvent):
+        if event.stage == STAGE_DONE:
+            self.backup_active = False
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(0)
+            self.progress_label.setText("")
+            self.remaining_time = self.backup_interval
+            return
+        self.backup_active = True
+        if event.fraction is None:
+            # Size unknown, e.g. of a database dump, show a busy bar
+            self.progress_bar.setRange(0, 0)
+        else:
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(int(event.fraction * 100))
+        self.progress_label.setText(format_progress(event))
+
     def interval_changed(self, value):
         self.configs["backup"]["interval_minutes"] = int(value)
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def api_url_changed(self, text):
         self.configs["api"]["url"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def api_token_changed(self, text):
         self.configs["api"]["api_key"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_username_changed(self, text):
         self.configs["db"]["user"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_password_changed(self, text):
         self.configs["db"]["password"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_host_changed(self, text):
         self.configs["db"]["host"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_port_changed(self, text):
         self.configs["db"]["port"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def db_name_changed(self, text):
         self.configs["db"]["dbname"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def update_start_button_state(self):
-        self.start_button.setEnabled(self.can_start_service())
+        stopping = self.backup_worker is not None and not self.service_running
+        self.start_button.setEnabled(self.can_start_service() and not stopping)
 
     def db_type_changed(self, text):
         self.configs["db"]["type"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
         if text.casefold() in ["postgresql", "oracle"]:
@@ -559,29 +621,44 @@ class ConfigUI(QWidget):
 
     def start_service(self):
         self.service_running = True
+        # The service reads the settings from the files
+        config_store.flush()
         start_service()
         self.start_button.setText("Stop Backup Service")
-        self.backup_thread = threading.Thread(target=self.run_backup_service_ui)
-        self.backup_thread.start()
+        self.backup_worker = ServiceWorker(self.configs)
+        self.backup_worker.progress_changed.connect(self.backup_progress_changed)
+        self.backup_worker.finished.connect(self.service_stopped)
+        self.backup_worker.start()
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_progress_bar)
         self.timer.start(1000)
 
     def stop_service(self):
+        """
+        Cancels the running backups without waiting for them, service_stopped() resets the UI once they ended.
+        """
         self.service_running = False
-        stop_service()
+        stop_service(cancel=True)
         self.timer.stop()
+        self.start_button.setText("Stopping...")
+        self.start_button.setEnabled(False)
+
+    def service_stopped(self):
+        self.backup_worker = None
+        self.backup_active = False
+        self.progress_bar.setRange(0, 100)
         self.progress_bar.setValue(0)
+        self.progress_label.setText("")
         self.remaining_time = self.configs["backup"]["interval_minutes"] * 60
         self.start_button.setText("Start Backup Service")
-        if self.backup_thread:
-            self.backup_thread.join()
-            self.backup_thread = None
+        self.update_start_button_state()
         print("Backup service stopped.")
+        if self.close_requested:
+            self.close()
 
     def backup_path_changed(self, text):
         self.configs["backup"]["backup_path"] = text
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         valid_path = self.validate_path(text)
         if valid_path:
             self.backup_path_valid_label.setText("Valid Path")
@@ -598,24 +675,27 @@ class ConfigUI(QWidget):
         path = QFileDialog.getExistingDirectory(self, "Select Backup Path")
         self.backup_path_input.setText(path)
         self.configs["backup"]["backup_path"] = path
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def select_backup_path(self):
         path = QFileDialog.getExistingDirectory(self, "Select Backup Path")
         self.backup_path_input.setText(path)
         self.configs["backup"]["backup_path"] = path
-        save_all_configs(self.configs)
+        save_all_configs(self.configs, delay=CONFIG_SAVE_DELAY)
         self.update_start_button_state()
 
     def closeEvent(self, event):
-        """Stop the backup service when the window is closed."""
-        self.stop_service()
+        """Stop the backup service when the window is closed, the window closes once it stopped."""
+        config_store.flush()
+        if self.backup_worker is not None:
+            self.close_requested = True
+            if self.service_running:
+                self.stop_service()
+            event.ignore()
+            return
         event.accept()
 
-    def run_backup_service_ui(self):
-        run_backup_service(send_to_api=self.configs["api"]["use_api"], send_to_server=self.configs["ssh"]["use_ssh"], use_local_backup=self.configs["backup"]["use_local_backup"])
-
 
 if __name__ == '__main__':
     app = QApplication([])